@@ -6,6 +6,7 @@
 	use App\Http\Controllers\UpscaleAndNotesController;
 	use App\Models\Prompt;
 	use Illuminate\Http\Request;
+	use Illuminate\Support\Facades\DB;
 
 	class PromptApiController extends Controller
 	{
@@ -55,6 +56,215 @@ public function getPendingPrompts()
 			]);
 		}
 
+		/**
+		 * Columns the render workers need to build a job, so the pending-jobs payload stays small.
+		 */
+		private const WORKER_PROMPT_COLUMNS = [
+			'id',
+			'user_id',
+			'render_status',
+			'prompt_setting_id',
+			'generated_prompt',
+			'width',
+			'height',
+			'model',
+			'lora_name',
+			'strength_model',
+			'guidance',
+			'upload_to_s3',
+			'generation_type',
+			'input_image_1',
+			'input_image_1_strength',
+			'input_image_2',
+			'input_image_2_strength',
+			'created_at',
+		];
+
+		/**
+		 * Lean pending queue for the render workers: only the generation types and models a worker
+		 * handles, oldest first, one page at a time. Pass the returned next_cursor to get the next page.
+		 */
+		public function getPendingJobs(Request $request)
+		{
+			$validated = $request->validate([
+				'generation_types' => 'nullable|array',
+				'generation_types.*' => 'string',
+				'models' => 'nullable|array',
+				'models.*' => 'string',
+				'limit' => 'nullable|integer|min:1|max:500',
+				'cursor' => 'nullable|integer|min:0'
+			]);
+
+			$limit = $validated['limit'] ?? 100;
+
+			$query = Prompt::select(self::WORKER_PROMPT_COLUMNS)
+				->whereIn('render_status', [0, 1, 3])
+				->where('id', '>', $validated['cursor'] ?? 0);
+
+			if (!empty($validated['generation_types'])) {
+				$query->whereIn('generation_type', $validated['generation_types']);
+			}
+			if (!empty($validated['models'])) {
+				$query->whereIn('model', $validated['models']);
+			}
+
+			$prompts = $query->orderBy('id')->limit($limit)->get();
+
+			return response()->json([
+				'success' => true,
+				'prompts' => $prompts,
+				'next_cursor' => $prompts->count() === $limit ? $prompts->last()->id : null
+			]);
+		}
+
+		/**
+		 * Validation rules shared by the worker claim endpoints.
+		 */
+		private function validateWorkerScope(Request $request, array $rules = []): array
+		{
+			return $request->validate(array_merge([
+				'worker_id' => 'required|string|max:128',
+				'generation_types' => 'nullable|array',
+				'generation_types.*' => 'string',
+				'models' => 'nullable|array',
+				'models.*' => 'string'
+			], $rules));
+		}
+
+		/**
+		 * Restricts a query to unfinished prompts of the generation types and models a worker handles.
+		 */
+		private function workerScope(array $validated): \Closure
+		{
+			return function ($query) use ($validated) {
+				$query->whereIn('render_status', [0, 1, 3]);
+				if (!empty($validated['generation_types'])) {
+					$query->whereIn('generation_type', $validated['generation_types']);
+				}
+				if (!empty($validated['models'])) {
+					$query->whereIn('model', $validated['models']);
+				}
+			};
+		}
+
+		/**
+		 * Claims up to 'limit' unclaimed (or lease-expired) prompts for a worker and renews the lease on
+		 * everything it already holds. Returns all prompts the worker now holds, oldest first.
+		 * New prompts are taken with conditional UPDATEs, so two workers never get the same prompt.
+		 * With 'per_user' every user with waiting prompts first gets up to that many claimed (users with
+		 * the oldest waiting prompt first), and only the rest of the limit goes to the oldest prompts overall,
+		 * so one user's large batch can't take all of a worker's claims.
+		 */
+		public function claimPrompts(Request $request)
+		{
+			$validated = $this->validateWorkerScope($request, [
+				'limit' => 'nullable|integer|min:0|max:500',
+				'per_user' => 'nullable|integer|min:0|max:500',
+				'lease_seconds' => 'nullable|integer|min:10|max:3600'
+			]);
+
+			$workerId = $validated['worker_id'];
+			$scope = $this->workerScope($validated);
+			$now = now();
+			$leaseExpiresAt = $now->copy()->addSeconds($validated['lease_seconds'] ?? 120);
+
+			Prompt::where($scope)
+				->where('claimed_by', $workerId)
+				->update(['lease_expires_at' => $leaseExpiresAt]);
+
+			$unclaimed = function ($query) use ($now) {
+				$query->whereNull('claimed_by')
+					->orWhereNull('lease_expires_at')
+					->orWhere('lease_expires_at', '<', $now);
+			};
+
+			$limit = $validated['limit'] ?? 0;
+			$perUser = $validated['per_user'] ?? 0;
+			if ($limit > 0 && $perUser > 0) {
+				$userIds = Prompt::where($scope)
+					->where($unclaimed)
+					->groupBy('user_id')
+					->orderByRaw('MIN(id)')
+					->limit($limit)
+					->pluck('user_id');
+
+				foreach ($userIds as $userId) {
+					if ($limit <= 0) {
+						break;
+					}
+					$limit -= Prompt::where($scope)
+						->where($unclaimed)
+						->where('user_id', $userId)
+						->orderBy('id')
+						->limit(min($perUser, $limit))
+						->update(['claimed_by' => $workerId, 'lease_expires_at' => $leaseExpiresAt]);
+				}
+			}
+			if ($limit > 0) {
+				Prompt::where($scope)
+					->where($unclaimed)
+					->orderBy('id')
+					->limit($limit)
+					->update(['claimed_by' => $workerId, 'lease_expires_at' => $leaseExpiresAt]);
+			}
+
+			$prompts = Prompt::select(self::WORKER_PROMPT_COLUMNS)
+				->where($scope)
+				->where('claimed_by', $workerId)
+				->orderBy('id')
+				->get();
+
+			return response()->json([
+				'success' => true,
+				'prompts' => $prompts,
+				'lease_expires_at' => $leaseExpiresAt->toIso8601String()
+			]);
+		}
+
+		/**
+		 * Extends the lease on prompts a worker is still working on.
+		 */
+		public function heartbeatPrompts(Request $request)
+		{
+			$validated = $this->validateWorkerScope($request, [
+				'ids' => 'required|array',
+				'ids.*' => 'integer',
+				'lease_seconds' => 'nullable|integer|min:10|max:3600'
+			]);
+
+			$renewed = Prompt::whereIn('id', $validated['ids'])
+				->where('claimed_by', $validated['worker_id'])
+				->whereIn('render_status', [0, 1, 3])
+				->update(['lease_expires_at' => now()->addSeconds($validated['lease_seconds'] ?? 120)]);
+
+			return response()->json([
+				'success' => true,
+				'renewed' => $renewed
+			]);
+		}
+
+		/**
+		 * Gives up a worker's claims, e.g. on shutdown, so other workers can pick the prompts up immediately.
+		 */
+		public function releasePrompts(Request $request)
+		{
+			$validated = $this->validateWorkerScope($request, [
+				'ids' => 'nullable|array',
+				'ids.*' => 'integer'
+			]);
+
+			$released = Prompt::where('claimed_by', $validated['worker_id'])
+				->when(!empty($validated['ids']), function ($query) use ($validated) {
+					$query->whereIn('id', $validated['ids']);
+				})
+				->update(['claimed_by' => null, 'lease_expires_at' => null]);
+
+			return response()->json([
+				'success' => true,
+				'released' => $released
+			]);
+		}
+
 		public function updateFilename(Request $request)
 		{
 			$validated = $request->validate([
@@ -90,6 +300,54 @@ public function updateRenderStatus(Request $request)
 			return response()->json(['success' => true]);
 		}
 
+		/**
+		 * Applies a batch of render status and filename updates from the render workers in one request.
+		 * Each update carries an id plus a filename (which also marks the prompt as rendered) and/or a status.
+		 */
+		public function updateBatch(Request $request)
+		{
+			$validated = $request->validate([
+				'updates' => 'required|array',
+				'updates.*.id' => 'required|integer',
+				'updates.*.status' => 'nullable|integer',
+				'updates.*.filename' => 'nullable|string'
+			]);
+
+			$updates = collect($validated['updates'])->keyBy('id');
+			$prompts = Prompt::whereIn('id', $updates->keys())->get()->keyBy('id');
+
+			$updatedIds = [];
+			$missingIds = [];
+
+			DB::transaction(function () use ($updates, $prompts, &$updatedIds, &$missingIds) {
+				foreach ($updates as $id => $update) {
+					$prompt = $prompts->get($id);
+					if (!$prompt) {
+						$missingIds[] = $id;
+						continue;
+					}
+
+					if (!empty($update['filename'])) {
+						$prompt->filename = $update['filename'];
+						$prompt->render_status = 2;
+					}
+					// A status sent alongside a filename was queued after it, so it wins.
+					if (isset($update['status'])) {
+						$prompt->render_status = $update['status'];
+					}
+
+					$prompt->save();
+					$updatedIds[] = $id;
+				}
+			});
+
+			return response()->json([
+				'success' => true,
+				'updated' => $updatedIds,
+				'missing' => $missingIds
+			]);
+		}
+
 		public function getQueueCount()
 		{
 			// Get pending renders count
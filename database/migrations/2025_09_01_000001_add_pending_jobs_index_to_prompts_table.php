@@ -0,0 +1,29 @@
+<?php
+
+	use Illuminate\Database\Migrations\Migration;
+	use Illuminate\Database\Schema\Blueprint;
+	use Illuminate\Support\Facades\Schema;
+
+	return new class extends Migration
+	{
+		/**
+		 * Run the migrations.
+		 */
+		public function up(): void
+		{
+			Schema::table('prompts', function (Blueprint $table) {
+				// Covers the render workers' filtered, id-ordered fetch from /prompts/pending-jobs.
+				$table->index(['render_status', 'generation_type', 'model', 'id'], 'prompts_pending_jobs_index');
+			});
+		}
+
+		/**
+		 * Reverse the migrations.
+		 */
+		public function down(): void
+		{
+			Schema::table('prompts', function (Blueprint $table) {
+				$table->dropIndex('prompts_pending_jobs_index');
+			});
+		}
+	};
@@ -0,0 +1,32 @@
+<?php
+
+	use Illuminate\Database\Migrations\Migration;
+	use Illuminate\Database\Schema\Blueprint;
+	use Illuminate\Support\Facades\Schema;
+
+	return new class extends Migration
+	{
+		/**
+		 * Run the migrations.
+		 */
+		public function up(): void
+		{
+			Schema::table('prompts', function (Blueprint $table) {
+				// Which render worker holds the prompt and until when; an expired lease can be claimed by any worker.
+				$table->string('claimed_by', 128)->nullable()->after('render_status');
+				$table->timestamp('lease_expires_at')->nullable()->after('claimed_by');
+				$table->index(['claimed_by', 'render_status'], 'prompts_claimed_by_index');
+			});
+		}
+
+		/**
+		 * Reverse the migrations.
+		 */
+		public function down(): void
+		{
+			Schema::table('prompts', function (Blueprint $table) {
+				$table->dropIndex('prompts_claimed_by_index');
+				$table->dropColumn(['claimed_by', 'lease_expires_at']);
+			});
+		}
+	};
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import workflow_templates
+
+# Orders the ComfyUI worker's new prompts so the GPU swaps models as rarely as possible.
+#
+# Prompts are grouped by what ComfyUI has to load for them: workflow file, model and LoRA.
+# The worker keeps submitting from the group it rendered last until that group is empty and
+# then moves on to the group whose oldest prompt has waited longest. Inside a group prompts
+# with the same text are kept together, so ComfyUI can reuse the cached text encoding.
+#
+# To bound starvation, a prompt that has waited AFFINITY_MAX_WAIT_SECONDS since the worker
+# first saw it goes ahead of every group, oldest first.
+#
+# The worker claims AFFINITY_LOOKAHEAD prompts more than ComfyUI has room for, so there is a
+# choice to make; 0 turns the reordering off and prompts go in the API's order.
+#
+#   AFFINITY_LOOKAHEAD         extra prompts held to choose from (default 8)
+#   AFFINITY_MAX_WAIT_SECONDS  wait after which a prompt skips the grouping (default 120)
+
+
+def group_key(prompt):
+    """What ComfyUI has to have loaded to render the prompt."""
+    try:
+        workflow_file = workflow_templates.get_plan(prompt['generation_type'], prompt['model'])['file']
+    except ValueError:
+        workflow_file = prompt['generation_type']
+    lora_name = prompt.get('lora_name') if prompt['generation_type'] == "kontext-lora" else None
+    return workflow_file, prompt['model'], lora_name or ""
+
+
+class AffinityScheduler:
+    def __init__(self, lookahead=None, max_wait_seconds=None):
+        self.lookahead = int(lookahead if lookahead is not None else os.getenv('AFFINITY_LOOKAHEAD') or 8)
+        self.max_wait = float(max_wait_seconds or os.getenv('AFFINITY_MAX_WAIT_SECONDS') or 120)
+        self.lock = threading.Lock()
+        # prompt id -> monotonic time the prompt was first seen
+        self.first_seen = {}
+        self.current_key = None
+
+        self.switches = 0
+        self.starved = 0
+
+    @property
+    def enabled(self):
+        return self.lookahead > 0
+
+    def order(self, prompts):
+        """
+        Return the prompts in the order to process them: running and re-check prompts first (as
+        they came), then new ones, starved first, then the current group, then the other groups.
+        """
+        now = time.monotonic()
+        new = [p for p in prompts if p['render_status'] == 0]
+        others = [p for p in prompts if p['render_status'] != 0]
+        if not self.enabled:
+            return others + new
+
+        with self.lock:
+            held = {p['id'] for p in new}
+            # Prompts we no longer hold were submitted or taken by another worker
+            for prompt_id in [i for i in self.first_seen if i not in held]:
+                del self.first_seen[prompt_id]
+            for prompt in new:
+                self.first_seen.setdefault(prompt['id'], now)
+            first_seen = dict(self.first_seen)
+            current_key = self.current_key
+
+        starved = sorted(
+            (p for p in new if now - first_seen[p['id']] >= self.max_wait),
+            key=lambda p: first_seen[p['id']]
+        )
+        starved_ids = {p['id'] for p in starved}
+
+        groups = {}
+        for prompt in new:
+            if prompt['id'] not in starved_ids:
+                groups.setdefault(group_key(prompt), []).append(prompt)
+
+        def group_order(item):
+            key, members = item
+            oldest = min(first_seen[p['id']] for p in members)
+            return (key != current_key, oldest)
+
+        ordered = []
+        for _, members in sorted(groups.items(), key=group_order):
+            # Same prompt text next to each other, texts in order of their oldest prompt
+            members = sorted(members, key=lambda p: (first_seen[p['id']], p['id']))
+            text_rank = {}
+            for prompt in members:
+                text_rank.setdefault(prompt.get('generated_prompt') or "", len(text_rank))
+            ordered.extend(sorted(members, key=lambda p: text_rank[p.get('generated_prompt') or ""]))
+
+        return others + starved + ordered
+
+    def submitted(self, prompt):
+        """Note the group of a prompt that was just queued on ComfyUI."""
+        key = group_key(prompt)
+        with self.lock:
+            seen = self.first_seen.pop(prompt['id'], None)
+            if seen is not None and time.monotonic() - seen >= self.max_wait:
+                self.starved += 1
+            if key != self.current_key:
+                if self.current_key is not None:
+                    self.switches += 1
+                self.current_key = key
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                'waiting': len(self.first_seen),
+                'oldest_wait_s': round(max((now - t for t in self.first_seen.values()), default=0), 1),
+                'group_switches': self.switches,
+                'starved': self.starved,
+            }
@@ -0,0 +1,432 @@
+import asyncio
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from fair_queue import FairQueue
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import rate_limit
+import render_backends
+import s3_transfer
+import variations
+import worker_logging
+import worker_metrics
+
+# asyncio mode of the remote worker (render-jobs.py --async-pipeline).
+#
+# A prompt passes through stages connected by bounded queues:
+#
+#   fetch -> generate (per provider) -> download -> upload -> callback
+#
+# Variations of a prompt (see variations.py) travel through generate as one item and one
+# provider call, then split up into one download/upload/callback item per image.
+# Each stage runs a fixed number of coroutines, so a full queue makes the stage before it
+# wait instead of piling up work. Generations go through the backends' async API (fal's
+# subscribe_async, Minimax and downloads on one httpx.AsyncClient), so hundreds of them can be
+# in flight on a single thread. Only the boto3 uploads run on threads, ASYNC_UPLOAD_CONCURRENCY at most.
+# With S3_STREAM_UPLOADS the upload stage downloads the image itself and pipes the body into
+# the boto3 upload as it arrives (s3_transfer.ChunkPipe), so it is never held in memory whole.
+# Provider calls are paced by the same rate limiters as the threaded mode (rate_limit.py), and
+# new prompts are taken from the users in turn like there (fair_queue.py).
+#
+#   ASYNC_FAL_CONCURRENCY       fal generations in flight (default 64)
+#   ASYNC_MINIMAX_CONCURRENCY   Minimax generations in flight (default 8)
+#   ASYNC_VERTEX_CONCURRENCY    Vertex generations in flight (default 2)
+#   ASYNC_DOWNLOAD_CONCURRENCY  downloads at once (default 16)
+#   ASYNC_UPLOAD_CONCURRENCY    S3 uploads at once (default 8)
+#   ASYNC_QUEUE_SIZE            prompts waiting between two stages (default 32)
+
+log = worker_logging.get_logger("async_pipeline")
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+class AsyncRemotePipeline:
+    def __init__(self, worker, models):
+        """
+        worker is the render-jobs module namespace, which provides the S3 client, the
+        callback buffer, the prompt leases, the job state and result cache.
+        """
+        self.worker = worker
+        self.models = models
+
+        self.concurrency = {
+            "fal": _env_int('ASYNC_FAL_CONCURRENCY', 64),
+            "minimax": _env_int('ASYNC_MINIMAX_CONCURRENCY', 8),
+            "vertex": _env_int('ASYNC_VERTEX_CONCURRENCY', 2),
+        }
+        self.limiters = {
+            provider: rate_limit.ProviderLimiter(provider, limit)
+            for provider, limit in self.concurrency.items()
+        }
+        self.fair_queue = FairQueue()
+        self.download_concurrency = _env_int('ASYNC_DOWNLOAD_CONCURRENCY', 16)
+        self.upload_concurrency = _env_int('ASYNC_UPLOAD_CONCURRENCY', 8)
+        self.queue_size = _env_int('ASYNC_QUEUE_SIZE', 32)
+        self.fal_timeout = worker.FAL_TIMEOUT
+
+        # prompt id -> stage name, for every prompt somewhere in the pipeline
+        self.in_flight = {}
+        # prompt id -> time it left the pipeline, see the sync worker's finished_at
+        self.finished_at = {}
+        # Claimed status 0 prompts left waiting for a provider slot on the last pass
+        self.claimed_waiting = 0
+        self.wake = None
+        self.http = None
+        self.upload_threads = None
+
+    # --- helpers ---
+
+    def provider_for(self, model):
+        if model not in self.models:
+            return None
+        return render_backends.backend_for(model).provider
+
+    def output_names(self, prompt):
+        output_filename = f"{prompt['generation_type']}_{prompt['model'].replace('/', '-')}_{prompt['id']}_{prompt['user_id']}.png"
+        return str(Path(self.worker.OUTPUT_DIR) / output_filename), f"images/{output_filename}"
+
+    def finish(self, prompt, state):
+        prompt_id = prompt['id']
+        self.in_flight.pop(prompt_id, None)
+        self.finished_at[prompt_id] = time.time()
+        self.worker.prompt_leases.untrack(prompt_id)
+        self.worker.job_state.mark_finished(prompt_id, state)
+        worker_metrics.job_finished(prompt, state)
+        self.wake.set()
+
+    def fail(self, prompt, reason):
+        log.error("Prompt %s failed: %s", prompt['id'], reason)
+        self.worker.update_render_status(prompt['id'], 4)
+        self.finish(prompt, "failed")
+
+    def export_metrics(self):
+        for provider, queue in self.generate_queues.items():
+            worker_metrics.set_queue_depth(f"generate_{provider}", queue.qsize())
+        worker_metrics.set_queue_depth("download", self.download_queue.qsize())
+        worker_metrics.set_queue_depth("upload", self.upload_queue.qsize())
+        worker_metrics.set_queue_depth("callback", self.callback_queue.qsize())
+        counts = self.stage_counts()
+        for stage in list(self.concurrency) + ["download", "upload", "callback"]:
+            worker_metrics.set_in_flight(stage, counts.get(stage, 0))
+        for provider, limiter in self.limiters.items():
+            worker_metrics.set_state(limiter.stats(), f"rate_limit_{provider}_")
+
+    # --- stages ---
+
+    async def fetch_stage(self):
+        """Claim new prompts whenever the generate queues have room."""
+        while True:
+            self.wake.clear()
+            try:
+                await self.fetch_once()
+            except Exception as e:
+                log.exception("Error in async fetch: %s", e)
+            try:
+                await asyncio.wait_for(self.wake.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fetch_once(self):
+        worker = self.worker
+        await asyncio.to_thread(worker.callback_buffer.flush)
+        fetch_started_at = time.time()
+        for prompt_id in [p for p, t in self.finished_at.items() if t < fetch_started_at - 60]:
+            del self.finished_at[prompt_id]
+
+        # Slots of providers without any of our models can't take a prompt
+        providers = {self.provider_for(model) for model in self.models}
+        free = sum(
+            max(0, limiter.concurrency - self.provider_in_flight(provider))
+            for provider, limiter in self.limiters.items() if provider in providers
+        )
+        fetch_started = time.monotonic()
+        try:
+            prompts = await asyncio.to_thread(worker.prompt_leases.claim, free - self.claimed_waiting)
+        except Exception:
+            worker_metrics.observe("fetch", time.monotonic() - fetch_started, outcome="error")
+            raise
+        self.claimed_waiting = 0
+        worker_metrics.observe("fetch", time.monotonic() - fetch_started)
+        log.info("Async pipeline: %d in flight, %d claimed prompts, stages %s", len(self.in_flight), len(prompts), self.stage_counts())
+        for provider, limiter in self.limiters.items():
+            log.info("Rate limit %s: %s", provider, limiter.stats())
+        self.export_metrics()
+        worker.job_state.compact()
+
+        ours = [
+            prompt for prompt in prompts
+            if prompt['generation_type'] == "prompt" and self.provider_for(prompt['model']) is not None
+        ]
+        candidates = [
+            prompt for prompt in ours
+            if prompt['id'] not in self.in_flight and self.finished_at.get(prompt['id'], 0) < fetch_started_at
+        ]
+        busy = [prompt for prompt in ours if prompt['id'] in self.in_flight]
+        new_prompts, capped = self.fair_queue.order([p for p in candidates if p['render_status'] == 0], busy)
+        candidates = [p for p in candidates if p['render_status'] != 0] + new_prompts
+        self.claimed_waiting += len(capped)
+        log.info("Fair queue: %s", self.fair_queue.stats())
+        worker_metrics.set_state(self.fair_queue.stats(), "fair_queue_")
+        limit = lambda prompt: render_backends.backend_for(prompt['model']).max_variations
+        for group in variations.group(candidates, limit):
+            prompt = group[0]
+            provider = self.provider_for(prompt['model'])
+
+            if prompt['render_status'] in (1, 3):
+                with worker_logging.job(prompt):
+                    await self.check_running_prompt(prompt)
+                continue
+
+            if self.provider_in_flight(provider) >= self.limiters[provider].concurrency:
+                # No free slot for this provider, leave the prompt for a later pass
+                self.claimed_waiting += len(group)
+                continue
+            # Only the first prompt takes a provider slot, its variations ride along
+            for member in group:
+                self.in_flight[member['id']] = provider if member is prompt else "variation"
+                worker.prompt_leases.track(member['id'])
+                worker.job_state.record_submit(member['id'], provider)
+                self.fair_queue.dispatched(member)
+            await self.generate_queues[provider].put((group, time.monotonic()))
+        worker_metrics.set_queue_depth("claimed_waiting", self.claimed_waiting)
+
+    async def check_running_prompt(self, prompt):
+        prompt_id = prompt['id']
+        worker = self.worker
+        worker.job_state.record_seen(prompt_id, f"status {prompt['render_status']}")
+        if worker.job_state.is_expired(prompt_id):
+            log.warning("Prompt %s has been stuck for too long, marking as failed", prompt_id)
+            worker.update_render_status(prompt_id, 4)
+            worker.job_state.mark_finished(prompt_id, "expired")
+            worker_metrics.job_finished(prompt, "expired")
+            return
+
+        output_file, s3_file_path = self.output_names(prompt)
+        if os.path.exists(output_file):
+            log.info("Found existing image for prompt %s, attempting re-upload", prompt_id)
+            if prompt['upload_to_s3']:
+                self.in_flight[prompt_id] = "upload"
+                worker.prompt_leases.track(prompt_id)
+                await self.upload_queue.put((prompt, None, output_file, None))
+            else:
+                worker.update_image_filename(prompt_id, output_file, False)
+
+    def provider_in_flight(self, provider):
+        return sum(1 for stage in self.in_flight.values() if stage == provider)
+
+    def stage_counts(self):
+        counts = {}
+        for stage in self.in_flight.values():
+            counts[stage] = counts.get(stage, 0) + 1
+        return counts
+
+    async def generate_stage(self, provider):
+        queue = self.generate_queues[provider]
+        while True:
+            prompts, queued_at = await queue.get()
+            prompt = prompts[0]
+            prompt_id = prompt['id']
+            with worker_logging.job(prompt):
+                try:
+                    cache_key = None
+                    # Variations differ only in their seed, which the cache key leaves out
+                    if self.worker.result_cache.enabled and prompt['upload_to_s3'] and len(prompts) == 1:
+                        cache_key = self.worker.result_cache_key(render_backends.backend_for(prompt['model']).model_name(prompt['model']), prompt)
+                        cached_url = self.worker.result_cache.lookup(cache_key)
+                        if cached_url:
+                            log.info("Result cache hit for prompt %s, reusing %s", prompt_id, cached_url)
+                            await self.callback_queue.put((prompt, cached_url, True, None, "cached"))
+                            continue
+
+                    limiter = self.limiters[provider]
+                    await limiter.acquire_async()
+                    started = time.monotonic()
+                    worker_metrics.observe("queue_wait", started - queued_at, prompt)
+                    outcome = rate_limit.ERROR
+                    try:
+                        backend = render_backends.backend_for(prompt['model'])
+                        if len(prompts) > 1:
+                            log.info("Generating %d variations of prompt %s in one call: prompts %s", len(prompts), prompt_id, [p['id'] for p in prompts])
+                        result = await backend.generate_async(variations.as_batch(prompts), self.fal_timeout, self.http)
+                        image_urls = result['urls']
+                        outcome = rate_limit.OK
+                        log.info("%s rendered prompt %s in %.1fs (~$%.4f)", backend.name, prompt_id, result['latency'], result['cost'])
+                    except Exception as e:
+                        outcome = rate_limit.outcome_for(e)
+                        raise
+                    finally:
+                        limiter.release(outcome)
+                        worker_metrics.observe("generation", time.monotonic() - started, prompt, "ok" if outcome == rate_limit.OK else outcome)
+
+                    for member, image_url in zip(prompts, image_urls + [None] * len(prompts)):
+                        if not image_url:
+                            self.fail(member, f"{provider} returned no image")
+                            continue
+                        self.in_flight[member['id']] = "download"
+                        await self.download_queue.put((member, image_url, cache_key))
+                except asyncio.TimeoutError:
+                    for member in prompts:
+                        self.fail(member, f"timeout calling {provider} after {self.fal_timeout} seconds")
+                except Exception as e:
+                    for member in prompts:
+                        if self.in_flight.get(member['id']) in (provider, "variation"):
+                            self.fail(member, f"error calling {provider}: {e}")
+                finally:
+                    queue.task_done()
+
+    async def download_stage(self):
+        while True:
+            prompt, image_url, cache_key = await self.download_queue.get()
+            prompt_id = prompt['id']
+            with worker_logging.job(prompt):
+                output_file, _ = self.output_names(prompt)
+                started = time.monotonic()
+                try:
+                    local_path = render_backends.file_url_path(image_url)
+                    if local_path:
+                        # Local backends (mock, Vertex) already wrote the image to disk
+                        if prompt['upload_to_s3']:
+                            self.in_flight[prompt_id] = "upload"
+                            await self.upload_queue.put((prompt, cache_key, local_path, None))
+                        else:
+                            await asyncio.to_thread(shutil.copyfile, local_path, output_file)
+                            worker_metrics.observe("output_download", time.monotonic() - started, prompt)
+                            await self.callback_queue.put((prompt, output_file, False, None, "done"))
+                        continue
+
+                    if prompt['upload_to_s3'] and s3_transfer.STREAM_UPLOADS:
+                        # No local copy, the upload stage pipes the download straight into S3
+                        self.in_flight[prompt_id] = "upload"
+                        await self.upload_queue.put((prompt, cache_key, None, image_url))
+                        continue
+
+                    async with self.http.stream('GET', image_url, timeout=60) as response:
+                        response.raise_for_status()
+                        with open(output_file, 'wb') as f:
+                            async for chunk in response.aiter_bytes(256 * 1024):
+                                f.write(chunk)
+                    log.info("Downloaded image from %s to %s", image_url, output_file)
+                    worker_metrics.observe("output_download", time.monotonic() - started, prompt)
+
+                    if prompt['upload_to_s3']:
+                        self.in_flight[prompt_id] = "upload"
+                        await self.upload_queue.put((prompt, cache_key, output_file, None))
+                    else:
+                        await self.callback_queue.put((prompt, output_file, False, None, "done"))
+                except Exception as e:
+                    worker_metrics.observe("output_download", time.monotonic() - started, prompt, "error")
+                    self.fail(prompt, f"error downloading {image_url}: {e}")
+                finally:
+                    self.download_queue.task_done()
+
+    async def upload_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            prompt, cache_key, output_file, image_url = await self.upload_queue.get()
+            prompt_id = prompt['id']
+            with worker_logging.job(prompt):
+                _, s3_file_path = self.output_names(prompt)
+                started = time.monotonic()
+                try:
+                    if image_url is not None:
+                        # The time includes the download, as the two overlap
+                        await self.stream_upload(image_url, s3_file_path)
+                    else:
+                        await loop.run_in_executor(self.upload_threads, self.upload, output_file, s3_file_path)
+                    worker_metrics.observe("s3_upload", time.monotonic() - started, prompt)
+                    s3_url = f"{self.worker.AWS_CLOUDFRONT_URL}/{s3_file_path}"
+                    self.in_flight[prompt_id] = "callback"
+                    await self.callback_queue.put((prompt, s3_url, True, cache_key, "done"))
+                except Exception as e:
+                    worker_metrics.observe("s3_upload", time.monotonic() - started, prompt, "error")
+                    self.fail(prompt, f"error uploading to S3: {e}")
+                finally:
+                    self.upload_queue.task_done()
+
+    def upload(self, output_file, s3_file_path):
+        worker = self.worker
+        worker.s3_client.upload_file(output_file, worker.AWS_BUCKET, s3_file_path, Config=s3_transfer.TRANSFER_CONFIG)
+
+    def upload_stream(self, pipe, content_type, s3_file_path):
+        worker = self.worker
+        try:
+            worker.s3_client.upload_fileobj(
+                pipe, worker.AWS_BUCKET, s3_file_path,
+                ExtraArgs={'ContentType': content_type}, Config=s3_transfer.TRANSFER_CONFIG
+            )
+        finally:
+            pipe.close()
+
+    async def stream_upload(self, image_url, s3_file_path):
+        """Download an image and upload it to S3 at the same time, the body passing through a ChunkPipe."""
+        loop = asyncio.get_running_loop()
+        pipe = s3_transfer.ChunkPipe()
+        async with self.http.stream('GET', image_url, timeout=60) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', 'image/png')
+            upload = loop.run_in_executor(self.upload_threads, self.upload_stream, pipe, content_type, s3_file_path)
+            try:
+                async for chunk in response.aiter_bytes(256 * 1024):
+                    # Waits on a thread while the upload is behind, never on the event loop
+                    await asyncio.to_thread(pipe.write, chunk)
+            except BaseException as e:
+                # The upload raises the error too and aborts, also when this task is cancelled
+                pipe.finish(e if isinstance(e, Exception) else IOError("download cancelled"))
+                if not isinstance(e, Exception):
+                    raise
+            else:
+                pipe.finish()
+            # Raises the upload's own error, or the download error the pipe handed on to it
+            await upload
+
+    async def callback_stage(self):
+        while True:
+            prompt, file_path, is_s3_url, cache_key, state = await self.callback_queue.get()
+            with worker_logging.job(prompt):
+                try:
+                    self.worker.update_image_filename(prompt['id'], file_path, is_s3_url)
+                    if cache_key:
+                        self.worker.result_cache.store(cache_key, file_path)
+                    self.finish(prompt, state)
+                except Exception as e:
+                    log.exception("Error reporting result for prompt %s: %s", prompt['id'], e)
+                finally:
+                    self.callback_queue.task_done()
+
+    # --- running ---
+
+    async def run(self):
+        if httpx is None:
+            raise RuntimeError("The async pipeline needs httpx (pip install httpx)")
+
+        self.wake = asyncio.Event()
+        self.generate_queues = {provider: asyncio.Queue(self.queue_size) for provider in self.concurrency}
+        self.download_queue = asyncio.Queue(self.queue_size)
+        self.upload_queue = asyncio.Queue(self.queue_size)
+        self.callback_queue = asyncio.Queue(self.queue_size)
+        self.upload_threads = ThreadPoolExecutor(max_workers=self.upload_concurrency, thread_name_prefix="s3-upload")
+
+        limits = httpx.Limits(max_connections=sum(self.concurrency.values()) + self.download_concurrency + self.upload_concurrency)
+        async with httpx.AsyncClient(limits=limits) as self.http:
+            tasks = [asyncio.create_task(self.fetch_stage())]
+            for provider, limit in self.concurrency.items():
+                tasks += [asyncio.create_task(self.generate_stage(provider)) for _ in range(limit)]
+            tasks += [asyncio.create_task(self.download_stage()) for _ in range(self.download_concurrency)]
+            tasks += [asyncio.create_task(self.upload_stage()) for _ in range(self.upload_concurrency)]
+            tasks.append(asyncio.create_task(self.callback_stage()))
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                self.upload_threads.shutdown(wait=True)
@@ -0,0 +1,352 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from render_backends import solid_png
+
+# Local stand-ins for everything a render worker talks to, used by run_benchmark.py:
+#
+#   FakeApi       the Laravel worker endpoints (/api/prompts/claim, heartbeat, release,
+#                 pending-jobs, pending, update-batch, update-status, update-filename)
+#   FakeComfyUI   /prompt, /queue and /history; renders one prompt at a time and writes
+#                 a small PNG where the real save nodes would
+#   FakeS3        enough of the S3 REST API for boto3 uploads (PutObject and multipart)
+#
+# Each service runs a ThreadingHTTPServer on a background thread and counts what it saw.
+# Imported by run_benchmark.py, which puts python/ on sys.path first.
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.service.handle(self, 'GET', self.read_body())
+
+    def do_POST(self):
+        self.service.handle(self, 'POST', self.read_body())
+
+    def do_PUT(self):
+        self.service.handle(self, 'PUT', self.read_body())
+
+    def do_DELETE(self):
+        self.service.handle(self, 'DELETE', self.read_body())
+
+
+class FakeService:
+    def __init__(self):
+        handler = type(f"{type(self).__name__}Handler", (_Handler,), {'service': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request, method, body):
+        raise NotImplementedError
+
+
+class FakeApi(FakeService):
+    """Holds the prompt queue in memory and records every callback the worker makes."""
+
+    def __init__(self, prompts):
+        super().__init__()
+        self.started_at = time.time()
+        # id -> prompt row; 'available_at' (seconds after start) delays a prompt's arrival
+        self.prompts = {p['id']: dict(p, render_status=0, filename=None, claimed_by=None, lease_expires_at=0) for p in prompts}
+        self.finished_at = {}
+        self.counts = {'claims': 0, 'heartbeats': 0, 'releases': 0, 'batches': 0, 'batch_updates': 0, 'single_updates': 0}
+
+    def start(self):
+        self.started_at = time.time()
+        return super().start()
+
+    def arrived_at(self, prompt):
+        return self.started_at + prompt.get('available_at', 0)
+
+    def visible(self, prompt, now):
+        return self.arrived_at(prompt) <= now
+
+    def in_scope(self, prompt, data):
+        types = data.get('generation_types') or data.get('generation_types[]')
+        models = data.get('models') or data.get('models[]')
+        return (not types or prompt['generation_type'] in types) and (not models or prompt['model'] in models)
+
+    def public(self, prompt):
+        return {k: v for k, v in prompt.items() if k not in ('available_at', 'claimed_by', 'lease_expires_at')}
+
+    def apply_update(self, prompt_id, status=None, filename=None):
+        prompt = self.prompts.get(int(prompt_id))
+        if prompt is None:
+            return False
+        if filename:
+            prompt['filename'] = filename
+            prompt['render_status'] = 2
+        if status is not None:
+            prompt['render_status'] = int(status)
+        if prompt['render_status'] in (2, 4) and prompt['id'] not in self.finished_at:
+            self.finished_at[prompt['id']] = time.time()
+        return True
+
+    def done(self):
+        with self.lock:
+            return all(p['render_status'] in (2, 4) for p in self.prompts.values())
+
+    def handle(self, request, method, body):
+        url = urlparse(request.path)
+        data = json.loads(body) if body else {}
+        if method == 'GET':
+            data = {k.rstrip('[]'): (v if k.endswith('[]') else v[0]) for k, v in parse_qs(url.query).items()}
+        route = url.path.rstrip('/')
+        now = time.time()
+
+        with self.lock:
+            if route == '/api/prompts/claim':
+                self.counts['claims'] += 1
+                worker_id = data['worker_id']
+                lease = now + data.get('lease_seconds', 120)
+                held = []
+                for prompt in self.prompts.values():
+                    if prompt['claimed_by'] == worker_id and prompt['lease_expires_at'] > now and prompt['render_status'] in (0, 1, 3):
+                        prompt['lease_expires_at'] = lease
+                        held.append(prompt)
+                limit = data.get('limit', 0)
+                for prompt in sorted(self.prompts.values(), key=lambda p: p['id']):
+                    if limit <= 0:
+                        break
+                    if prompt in held or not self.visible(prompt, now) or not self.in_scope(prompt, data):
+                        continue
+                    if prompt['render_status'] == 0 and (prompt['claimed_by'] is None or prompt['lease_expires_at'] <= now):
+                        prompt['claimed_by'] = worker_id
+                        prompt['lease_expires_at'] = lease
+                        held.append(prompt)
+                        limit -= 1
+                return request.send(200, {'success': True, 'prompts': [self.public(p) for p in held]})
+
+            if route == '/api/prompts/heartbeat':
+                self.counts['heartbeats'] += 1
+                for prompt_id in data.get('ids', []):
+                    prompt = self.prompts.get(prompt_id)
+                    if prompt and prompt['claimed_by'] == data['worker_id']:
+                        prompt['lease_expires_at'] = now + data.get('lease_seconds', 120)
+                return request.send(200, {'success': True})
+
+            if route == '/api/prompts/release':
+                self.counts['releases'] += 1
+                for prompt in self.prompts.values():
+                    if prompt['claimed_by'] == data['worker_id']:
+                        prompt['claimed_by'] = None
+                return request.send(200, {'success': True})
+
+            if route in ('/api/prompts/pending-jobs', '/api/prompts/pending'):
+                prompts = [
+                    self.public(p) for p in sorted(self.prompts.values(), key=lambda p: p['id'])
+                    if p['render_status'] in (0, 1, 3) and self.visible(p, now) and self.in_scope(p, data)
+                ]
+                return request.send(200, {'success': True, 'prompts': prompts, 'next_cursor': None})
+
+            if route == '/api/prompts/update-batch':
+                self.counts['batches'] += 1
+                updated, missing = [], []
+                for update in data.get('updates', []):
+                    self.counts['batch_updates'] += 1
+                    ok = self.apply_update(update['id'], update.get('status'), update.get('filename'))
+                    (updated if ok else missing).append(update['id'])
+                return request.send(200, {'success': True, 'updated': updated, 'missing': missing})
+
+            if route in ('/api/prompts/update-status', '/api/prompts/update-filename'):
+                self.counts['single_updates'] += 1
+                self.apply_update(data['id'], data.get('status'), data.get('filename'))
+                return request.send(200, {'success': True})
+
+        request.send(404, {'success': False})
+
+    def results(self):
+        """(end-to-end latency in seconds, final status) for every prompt that reached a final status."""
+        with self.lock:
+            return [
+                (self.finished_at[p['id']] - self.arrived_at(p), p['render_status'])
+                for p in self.prompts.values() if p['id'] in self.finished_at
+            ]
+
+
+class FakeComfyUI(FakeService):
+    """A single simulated GPU: queued prompts are rendered one after another in render_seconds each."""
+
+    def __init__(self, output_dir, comfy_output_dir, render_seconds=0.5, jitter=0.1, seed=0):
+        super().__init__()
+        self.output_dir = Path(output_dir)
+        self.comfy_output_dir = Path(comfy_output_dir)
+        self.render_seconds = render_seconds
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.queue = []
+        self.running = None
+        self.history = {}
+        self.wake = threading.Event()
+        self.prompts_queued = 0
+        self.gpu = threading.Thread(target=self._render_loop, name="fake-comfy-gpu", daemon=True)
+
+    def start(self):
+        self.gpu.start()
+        return super().start()
+
+    def handle(self, request, method, body):
+        url = urlparse(request.path)
+        with self.lock:
+            if url.path == '/prompt' and method == 'POST':
+                data = json.loads(body)
+                prompt_id = data.get('prompt_id') or str(uuid.uuid4())
+                self.queue.append((prompt_id, data['prompt']))
+                self.prompts_queued += 1
+                self.wake.set()
+                return request.send(200, {'prompt_id': prompt_id, 'number': self.prompts_queued, 'node_errors': {}})
+
+            if url.path == '/queue' and method == 'GET':
+                running = [[0, self.running]] if self.running else []
+                pending = [[i, prompt_id] for i, (prompt_id, _) in enumerate(self.queue)]
+                return request.send(200, {'queue_running': running, 'queue_pending': pending})
+
+            if url.path == '/queue' and method == 'POST':
+                deleted = set(json.loads(body).get('delete', []))
+                self.queue = [job for job in self.queue if job[0] not in deleted]
+                return request.send(200, {})
+
+            if url.path.startswith('/history/'):
+                prompt_id = url.path[len('/history/'):]
+                entry = self.history.get(prompt_id)
+                return request.send(200, {prompt_id: entry} if entry else {})
+
+        request.send(404, {'error': 'not found'})
+
+    def _render_loop(self):
+        while True:
+            with self.lock:
+                job = self.queue.pop(0) if self.queue else None
+                self.running = job[0] if job else None
+                delay = max(0.0, self.render_seconds + self.rng.uniform(-self.jitter, self.jitter))
+            if job is None:
+                self.wake.wait(0.5)
+                self.wake.clear()
+                continue
+            time.sleep(delay)
+            outputs = self._save_outputs(job[1])
+            with self.lock:
+                self.history[job[0]] = {'outputs': outputs, 'status': {'status_str': 'success', 'completed': True}}
+                self.running = None
+
+    def _save_outputs(self, workflow):
+        outputs = {}
+        image = solid_png(8, 8, (128, 128, 128))
+        batch_size = max([node.get('inputs', {}).get('batch_size', 1) for node in workflow.values()] or [1])
+        for node_id, node in workflow.items():
+            inputs = node.get('inputs', {})
+            if 'file_name_template' in inputs:
+                # FL_SaveImages: one file per image of the batch, {index} counted from start_index
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                for index in range(batch_size):
+                    file_name = inputs['file_name_template'].replace('{index}', str(inputs.get('start_index', 1) + index))
+                    (self.output_dir / file_name).write_bytes(image)
+            elif node.get('class_type') == 'SaveImage':
+                self.comfy_output_dir.mkdir(parents=True, exist_ok=True)
+                filename = f"{inputs.get('filename_prefix', 'ComfyUI')}_{uuid.uuid4().hex[:8]}_.png"
+                (self.comfy_output_dir / filename).write_bytes(image)
+                outputs[node_id] = {'images': [{'filename': filename, 'subfolder': '', 'type': 'output'}]}
+        return outputs
+
+
+class FakeS3(FakeService):
+    """Accepts PutObject and multipart uploads for any bucket and keeps only object sizes."""
+
+    def __init__(self):
+        super().__init__()
+        self.objects = {}
+        self.parts = {}
+
+    def handle(self, request, method, body):
+        url = urlparse(request.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        key = url.path.lstrip('/')
+        size = int(request.headers.get('x-amz-decoded-content-length') or len(body))
+        etag = {'ETag': f'"{uuid.uuid4().hex}"'}
+
+        with self.lock:
+            if method == 'PUT' and 'partNumber' in query:
+                self.parts.setdefault(query['uploadId'][0], 0)
+                self.parts[query['uploadId'][0]] += size
+                return request.send(200, headers=etag)
+            if method == 'PUT':
+                self.objects[key] = size
+                return request.send(200, headers=etag)
+            if method == 'POST' and 'uploads' in query:
+                upload_id = uuid.uuid4().hex
+                bucket, _, object_key = key.partition('/')
+                return request.send(200, (
+                    '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<Bucket>{bucket}</Bucket><Key>{object_key}</Key><UploadId>{upload_id}</UploadId>'
+                    '</InitiateMultipartUploadResult>'
+                ), 'application/xml')
+            if method == 'POST' and 'uploadId' in query:
+                self.objects[key] = self.parts.pop(query['uploadId'][0], 0)
+                bucket, _, object_key = key.partition('/')
+                return request.send(200, (
+                    '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    f'<Bucket>{bucket}</Bucket><Key>{object_key}</Key><ETag>{etag["ETag"]}</ETag>'
+                    '</CompleteMultipartUploadResult>'
+                ), 'application/xml')
+            if method == 'DELETE' and 'uploadId' in query:
+                self.parts.pop(query['uploadId'][0], None)
+                return request.send(204)
+
+        request.send(404, '<Error><Code>NoSuchKey</Code></Error>', 'application/xml')
+
+    def stats(self):
+        with self.lock:
+            return {'objects': len(self.objects), 'bytes': sum(self.objects.values())}
+
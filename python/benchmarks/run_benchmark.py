@@ -0,0 +1,266 @@
+import argparse
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PYTHON_DIR))
+
+from fake_services import FakeApi, FakeComfyUI, FakeS3
+
+# Throughput benchmark for the render workers.
+#
+# Starts a fake API, ComfyUI and S3 on localhost, fills the queue from a seeded generator and
+# runs render-jobs.py (with mock provider backends) and/or render-jobs-comfy-only.py against
+# them until every prompt is done, then writes a JSON report:
+#
+#   python benchmarks/run_benchmark.py --jobs 200 --seed 1 --output bench.json
+#   python benchmarks/run_benchmark.py --workers remote --async-pipeline --compare bench.json
+#
+# The report has jobs/sec, p50/p95/p99 end-to-end latency (prompt available -> filename
+# callback received), callback and claim counts, S3 objects and the worker's CPU time and
+# peak memory, so runs can be compared between commits with --compare.
+
+REMOTE_MODELS = [("imagen3", 3), ("minimax", 1), ("minimax-expand", 1)]
+COMFY_MODELS = [("schnell", 3), ("dev", 1)]
+SIZES = [(1024, 1024), (1344, 768), (768, 1344), (1152, 896)]
+
+
+def generate_prompts(worker, count, seed, rate, first_id=1):
+    """A repeatable queue: same seed, same prompts and arrival times. rate is prompts/sec, 0 means all at once."""
+    rng = random.Random(f"{seed}-{worker}")
+    models = REMOTE_MODELS if worker == "remote" else COMFY_MODELS
+    prompts = []
+    arrival = 0.0
+    for i in range(count):
+        model = rng.choices([m for m, _ in models], weights=[w for _, w in models])[0]
+        width, height = rng.choice(SIZES)
+        if rate:
+            arrival += rng.expovariate(rate)
+        prompts.append({
+            'id': first_id + i,
+            'user_id': rng.randint(1, 20),
+            'prompt_setting_id': rng.randint(1, count // 4 + 1),
+            'generation_type': "prompt",
+            'model': model,
+            'generated_prompt': f"benchmark prompt {i} " + " ".join(rng.choice(["red", "castle", "forest", "portrait", "city", "night"]) for _ in range(12)),
+            'width': width,
+            'height': height,
+            'upload_to_s3': True,
+            'lora_name': None,
+            'strength_model': None,
+            'guidance': None,
+            'input_image_1': None,
+            'input_image_1_strength': None,
+            'input_image_2': None,
+            'input_image_2_strength': None,
+            'available_at': arrival,
+        })
+    return prompts
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    # nearest-rank
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def worker_env(args, worker, api, s3, comfy, work_dir):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONUNBUFFERED': '1',
+        'API_BASE_URL': f"{api.url}/api",
+        'OUTPUT_DIR': str(work_dir / "output"),
+        'COMFY_DEFAULT_OUTPUT_DIR': str(work_dir / "comfy-output"),
+        'COMFY_URL': comfy[0].url if comfy else "",
+        'COMFY_INSTANCES': ",".join(instance.url for instance in comfy) if comfy else "",
+        'AWS_ACCESS_KEY_ID': "benchmark",
+        'AWS_SECRET_ACCESS_KEY': "benchmark",
+        'AWS_DEFAULT_REGION': "us-east-1",
+        'AWS_BUCKET': "benchmark",
+        'AWS_ENDPOINT_URL': s3.url,
+        'AWS_CLOUDFRONT_URL': "https://cdn.benchmark.invalid",
+        'AWS_REQUEST_CHECKSUM_CALCULATION': "when_required",
+        'RENDER_BACKEND_OVERRIDE': "mock",
+        'MOCK_LATENCY_SECONDS': str(args.provider_latency),
+        'MOCK_LATENCY_JITTER': str(args.provider_latency / 4),
+        'MOCK_FAILURE_RATE': str(args.failure_rate),
+        'MOCK_SEED': str(args.seed),
+        'MOCK_IMAGE_SIZE': "256x256",
+        'RESULT_CACHE_ENABLED': "false",
+        'JOB_STATE_DB': str(work_dir / f"job-state-{worker}.sqlite3"),
+        'WORKER_ID': f"benchmark-{worker}",
+    })
+    return env
+
+
+def run_worker(args, worker, work_dir):
+    prompts = generate_prompts(worker, args.jobs, args.seed, args.rate)
+    api = FakeApi(prompts).start()
+    s3 = FakeS3().start()
+    comfy = None
+    if worker == "comfy":
+        # One fake ComfyUI per simulated GPU, sharing the output directories like a multi-GPU box
+        comfy = [
+            FakeComfyUI(work_dir / "output", work_dir / "comfy-output", args.comfy_latency, args.comfy_latency / 4, args.seed + i).start()
+            for i in range(args.comfy_instances)
+        ]
+
+    script = "render-jobs.py" if worker == "remote" else "render-jobs-comfy-only.py"
+    command = [sys.executable, str(PYTHON_DIR / script)]
+    if worker == "remote" and args.async_pipeline:
+        command.append('--async-pipeline')
+
+    log_path = work_dir / f"{worker}.log"
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    started = time.time()
+    peak_rss = 0
+    print(f"Running {script} on {args.jobs} jobs (log: {log_path})")
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command, cwd=PYTHON_DIR, env=worker_env(args, worker, api, s3, comfy, work_dir), stdout=log, stderr=subprocess.STDOUT)
+        watched = psutil.Process(process.pid) if psutil else None
+        timed_out = False
+        while not api.done():
+            if process.poll() is not None:
+                print(f"{script} exited early with code {process.returncode}, see {log_path}")
+                break
+            if time.time() - started > args.timeout:
+                timed_out = True
+                print(f"Timed out after {args.timeout}s")
+                break
+            if watched:
+                try:
+                    peak_rss = max(peak_rss, watched.memory_info().rss)
+                except psutil.Error:
+                    pass
+            time.sleep(0.2)
+        duration = time.time() - api.started_at
+
+        if process.poll() is None:
+            # SIGINT lets the worker flush callbacks and release its leases on the way out
+            if os.name == 'nt':
+                process.terminate()
+            else:
+                process.send_signal(signal.SIGINT)
+            try:
+                process.wait(20)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    results = api.results()
+    latencies = [latency for latency, status in results if status == 2]
+    report = {
+        'script': script,
+        'jobs': args.jobs,
+        'completed': len(latencies),
+        'failed': sum(1 for _, status in results if status == 4),
+        'timed_out': timed_out,
+        'duration_s': round(duration, 3),
+        'jobs_per_sec': round(len(latencies) / duration, 3) if duration else 0,
+        'latency_ms': {
+            name: round(percentile(latencies, pct) * 1000, 1) if latencies else None
+            for name, pct in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+        },
+        'api': dict(api.counts),
+        's3': s3.stats(),
+    }
+    if comfy:
+        report['comfy_prompts_queued'] = [instance.prompts_queued for instance in comfy]
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report['cpu_seconds'] = round((usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime), 3)
+        # ru_maxrss is the largest child so far, in KB on Linux
+        peak_rss = max(peak_rss, usage.ru_maxrss * 1024)
+    report['max_rss_mb'] = round(peak_rss / (1024 * 1024), 1) if peak_rss else None
+
+    for service in [api, s3] + (comfy or []):
+        service.stop()
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PYTHON_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_path} (commit {baseline.get('commit')}):")
+    for worker, result in report['workers'].items():
+        before = baseline.get('workers', {}).get(worker)
+        if not before:
+            continue
+        for name, now, then in (
+            ('jobs/sec', result['jobs_per_sec'], before['jobs_per_sec']),
+            ('p95 ms', result['latency_ms']['p95'], before['latency_ms']['p95']),
+            ('cpu s', result.get('cpu_seconds'), before.get('cpu_seconds')),
+        ):
+            if now is None or not then:
+                continue
+            print(f"  {worker:6} {name:8} {then:>10} -> {now:>10} ({(now - then) / then * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the render workers against local fake services.")
+    parser.add_argument('--workers', nargs='+', choices=['remote', 'comfy'], default=['remote', 'comfy'])
+    parser.add_argument('--jobs', type=int, default=100, help='prompts per worker run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=0, help='prompt arrivals per second, 0 queues everything at the start')
+    parser.add_argument('--provider-latency', type=float, default=1.0, help='mean mock provider generation time (s)')
+    parser.add_argument('--comfy-latency', type=float, default=0.2, help='mean fake ComfyUI render time (s)')
+    parser.add_argument('--comfy-instances', type=int, default=1, help='fake ComfyUI instances (GPUs) for the ComfyUI worker')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of mock provider calls that fail')
+    parser.add_argument('--async-pipeline', action='store_true', help='run render-jobs.py in its asyncio mode')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', default='benchmark-report.json')
+    parser.add_argument('--compare', help='earlier report to compare this run against')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'workers': {},
+    }
+    # Kept after the run so the worker logs can be read
+    tmp = Path(tempfile.mkdtemp(prefix="render-benchmark-"))
+    for worker in args.workers:
+        work_dir = tmp / worker
+        work_dir.mkdir()
+        report['workers'][worker] = run_worker(args, worker, work_dir)
+        print(json.dumps(report['workers'][worker], indent=2))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
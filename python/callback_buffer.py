@@ -0,0 +1,143 @@
+import atexit
+import os
+import threading
+import time
+
+import worker_logging
+import worker_metrics
+from worker_http import get_api_session
+
+# Coalesces render status and filename callbacks into bulk requests.
+#
+# update_render_status() / update_image_filename() in the render workers only record the
+# latest state for a prompt here; a background thread sends everything recorded so far to
+# /prompts/update-batch every CALLBACK_FLUSH_INTERVAL seconds, or sooner once
+# CALLBACK_BATCH_SIZE prompts are waiting. If the API does not know the bulk route yet the
+# buffer falls back to the single-prompt endpoints.
+
+log = worker_logging.get_logger("callback_buffer")
+
+
+class CallbackBuffer:
+    def __init__(self, api_base_url, flush_interval=None, max_size=None):
+        self.api_base_url = api_base_url
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv('CALLBACK_FLUSH_INTERVAL', 0.3))
+        self.max_size = max_size if max_size is not None else int(os.getenv('CALLBACK_BATCH_SIZE', 100))
+
+        # prompt id -> {'id': ..., 'status': ..., 'filename': ...}, in the order they were first queued
+        self.pending = {}
+        # prompt id -> when its oldest unsent update was queued, for the callback stage timing
+        self.queued_at = {}
+        self.condition = threading.Condition()
+        # Serialises flushes so two batches for the same prompt can never land out of order
+        self.flush_lock = threading.Lock()
+        self.bulk_supported = True
+
+        self.thread = threading.Thread(target=self._run, name="callback-flusher", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def set_status(self, prompt_id, status):
+        with self.condition:
+            update = self.pending.setdefault(prompt_id, {'id': prompt_id})
+            update['status'] = status
+            self.queued_at.setdefault(prompt_id, time.monotonic())
+            self._notify_if_full()
+
+    def set_filename(self, prompt_id, filename):
+        with self.condition:
+            # A filename marks the prompt as rendered, so any status queued before it is obsolete
+            self.pending[prompt_id] = {'id': prompt_id, 'filename': filename}
+            self.queued_at.setdefault(prompt_id, time.monotonic())
+            self._notify_if_full()
+
+    def _notify_if_full(self):
+        if len(self.pending) >= self.max_size:
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) >= self.max_size, timeout=self.flush_interval)
+            if not self.flush():
+                # Back off before retrying, outside flush_lock so other flush() callers aren't held up
+                time.sleep(self.flush_interval)
+
+    def _take(self):
+        with self.condition:
+            updates = list(self.pending.values())
+            queued_at = {update['id']: self.queued_at.pop(update['id'], time.monotonic()) for update in updates}
+            self.pending = {}
+            return updates, queued_at
+
+    def _requeue(self, updates, queued_at):
+        with self.condition:
+            for update in updates:
+                # Keep anything queued while the failed request was in flight, it is newer
+                if update['id'] not in self.pending:
+                    self.pending[update['id']] = update
+                self.queued_at[update['id']] = queued_at[update['id']]
+
+    def _observe_sent(self, queued_at):
+        now = time.monotonic()
+        for started in queued_at.values():
+            worker_metrics.observe("callback", now - started)
+
+    def flush(self):
+        """
+        Send everything buffered so far. Safe to call from any thread. Returns False if the
+        batch request failed and the updates were queued again for the next flush.
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        updates, queued_at = self._take()
+        worker_metrics.set_queue_depth("callbacks", len(updates))
+        if not updates:
+            return True
+
+        if not self.bulk_supported:
+            self._send_individually(updates)
+            self._observe_sent(queued_at)
+            return True
+
+        try:
+            response = get_api_session().post(f"{self.api_base_url}/prompts/update-batch", json={'updates': updates})
+            if response.status_code == 200:
+                result = response.json()
+                log.info("Flushed %d prompt updates in one batch", len(result.get('updated', [])))
+                self._observe_sent(queued_at)
+                for prompt_id in result.get('missing', []):
+                    log.warning("Prompt %s not found while applying batch update", prompt_id)
+            elif response.status_code in (404, 405):
+                log.warning("Batch update endpoint not available, falling back to single prompt updates")
+                self.bulk_supported = False
+                self._send_individually(updates)
+                self._observe_sent(queued_at)
+            else:
+                log.error("Error flushing prompt updates: %s %s", response.status_code, response.text[:200])
+                self._requeue(updates, queued_at)
+                return False
+        except Exception as err:
+            log.error("Error flushing prompt updates via API: %s", err)
+            self._requeue(updates, queued_at)
+            return False
+        return True
+
+    def _send_individually(self, updates):
+        session = get_api_session()
+        for update in updates:
+            try:
+                if 'filename' in update:
+                    session.post(f"{self.api_base_url}/prompts/update-filename", json={
+                        'id': update['id'],
+                        'filename': update['filename']
+                    })
+                if 'status' in update:
+                    session.post(f"{self.api_base_url}/prompts/update-status", json={
+                        'id': update['id'],
+                        'status': update['status']
+                    })
+            except Exception as err:
+                log.error("Error updating prompt %s via API: %s", update['id'], err)
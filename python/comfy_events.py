@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+import worker_logging
+
+# Listens on ComfyUI's /ws endpoint and reports when prompts we submitted finish.
+#
+# ComfyUI only sends execution events to the client id a prompt was queued with, so
+# queue_prompt() must pass the same client_id given here. Prompts have to be registered
+# with watch() before they are queued; events for anything else are ignored.
+# on_started (optional) is called when ComfyUI starts executing a watched prompt.
+#
+# ComfyUI does not replay events missed while the socket was down. Every (re)connect marks
+# the prompts watched at that moment as missed, and will_report() is False for them, so the
+# worker's polling pass checks them on disk or in /history. Their events are still handled
+# if they arrive, whichever side gets there first finalizes the prompt.
+
+log = worker_logging.get_logger("comfy_events")
+
+
+class ComfyEventListener:
+    def __init__(self, server_url, client_id, on_finished, on_failed, reconnect_delay=5, on_started=None):
+        self.ws_url = server_url.replace('http', 'ws', 1).rstrip('/') + f"/ws?clientId={client_id}"
+        self.on_finished = on_finished
+        self.on_failed = on_failed
+        self.on_started = on_started
+        self.reconnect_delay = reconnect_delay
+
+        # prompt id (str) -> {node id: output} collected from 'executed' messages
+        self.outputs = {}
+        # watched prompt ids whose events may have been sent while we were not connected
+        self.missed = set()
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.thread = None
+
+    @property
+    def available(self):
+        return websocket is not None
+
+    def start(self):
+        if not self.available:
+            log.warning("websocket-client is not installed, falling back to polling for ComfyUI results")
+            return
+        self.thread = threading.Thread(target=self._run, name="comfy-events", daemon=True)
+        self.thread.start()
+
+    def watch(self, prompt_id):
+        with self.lock:
+            self.outputs[str(prompt_id)] = {}
+
+    def forget(self, prompt_id):
+        with self.lock:
+            self.outputs.pop(str(prompt_id), None)
+            self.missed.discard(str(prompt_id))
+
+    def will_report(self, prompt_id):
+        """True if the prompt's result is sure to come over the websocket, False if it needs polling."""
+        with self.lock:
+            prompt_id = str(prompt_id)
+            return self.connected.is_set() and prompt_id in self.outputs and prompt_id not in self.missed
+
+    def _connected(self):
+        with self.lock:
+            # Anything watched so far may have finished while no socket was listening
+            if self.outputs:
+                log.info("Polling %d prompt(s) that were in flight before the connection", len(self.outputs))
+            self.missed.update(self.outputs)
+        self.connected.set()
+
+    def _run(self):
+        while True:
+            ws = None
+            try:
+                ws = websocket.create_connection(self.ws_url, timeout=10)
+                ws.settimeout(60)
+                self._connected()
+                log.info("Connected to ComfyUI events at %s", self.ws_url)
+                while True:
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    # Binary frames are preview images, only the JSON events matter here
+                    if isinstance(message, str):
+                        self._handle(json.loads(message))
+            except Exception as e:
+                if self.connected.is_set():
+                    log.warning("Lost connection to ComfyUI events: %s", e)
+                self.connected.clear()
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+                time.sleep(self.reconnect_delay)
+
+    def _handle(self, message):
+        message_type = message.get('type')
+        data = message.get('data') or {}
+        if 'prompt_id' not in data:
+            return
+        prompt_id = str(data['prompt_id'])
+
+        with self.lock:
+            if prompt_id not in self.outputs:
+                return
+
+            if message_type == 'executed':
+                self.outputs[prompt_id][str(data.get('node'))] = data.get('output') or {}
+                return
+
+            started = message_type == 'execution_start'
+
+            # Newer ComfyUI sends execution_success, older versions only 'executing' with no node
+            finished = message_type == 'execution_success' or (message_type == 'executing' and data.get('node') is None)
+            failed = message_type in ('execution_error', 'execution_interrupted')
+            if not finished and not failed and not started:
+                return
+            outputs = None if started else self.outputs.pop(prompt_id)
+            if not started:
+                self.missed.discard(prompt_id)
+
+        try:
+            if started:
+                if self.on_started:
+                    self.on_started(prompt_id)
+            elif finished:
+                self.on_finished(prompt_id, outputs)
+            else:
+                self.on_failed(prompt_id, data)
+        except Exception as e:
+            log.exception("Error handling ComfyUI result for prompt %s: %s", prompt_id, e)
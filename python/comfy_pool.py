@@ -0,0 +1,171 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from comfy_events import ComfyEventListener
+import worker_logging
+from worker_http import get_session
+
+# A pool of ComfyUI instances driven by one ComfyUI worker, e.g. one per GPU.
+#
+# COMFY_INSTANCES lists them, comma separated, each as
+#
+#   url[|output_dir[|comfy_output_dir]]
+#
+# where output_dir is where the instance's FL_SaveImages files show up on this machine and
+# comfy_output_dir its SaveImage output directory (defaults OUTPUT_DIR and
+# COMFY_DEFAULT_OUTPUT_DIR). Instances on other hosts need those directories mounted here.
+# Without COMFY_INSTANCES the pool is the single COMFY_URL instance.
+#
+# Every pass refresh() reads each instance's /queue, which doubles as the health check; an
+# instance that does not answer is skipped until it answers again. pick() routes a new prompt
+# to the healthy instance with the least work queued, keeping at most COMFY_QUEUE_DEPTH
+# prompts waiting on each; among equally loaded instances it prefers one whose last prompt had
+# the same affinity key, as that one has the right model loaded already. An idle GPU always
+# wins over a busy one with the model loaded, so same-model work still spreads out. A prompt
+# stays on the instance it was submitted to: the worker records the instance name in its job
+# state and reads history and outputs from there.
+#
+#   COMFY_INSTANCES        the instances, see above (default COMFY_URL)
+#   COMFY_HEALTH_TIMEOUT   seconds to wait for /queue before an instance counts as down (default 5)
+
+log = worker_logging.get_logger("comfy_pool")
+
+
+class ComfyInstance:
+    def __init__(self, name, url, output_dir, comfy_output_dir, listener):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.output_dir = output_dir
+        self.comfy_output_dir = comfy_output_dir
+        self.listener = listener
+
+        self.healthy = True
+        self.running = 0
+        self.pending = 0
+        # Prompts routed here since the last refresh, not yet visible in /queue
+        self.routed = 0
+        self.submitted = 0
+        self.failures = 0
+        # Affinity key (see affinity_scheduler.py) of the last prompt routed here
+        self.last_key = None
+
+    @property
+    def load(self):
+        return self.running + self.pending + self.routed
+
+    def queue_prompt(self, workflow, prompt_id, client_id):
+        p = {"prompt": workflow, "prompt_id": prompt_id, "client_id": client_id}
+        response = get_session().post(f"{self.url}/prompt", json=p)
+        response.raise_for_status()
+        self.submitted += 1
+
+    def history(self, prompt_id):
+        response = get_session().get(f"{self.url}/history/{prompt_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def refresh(self, timeout):
+        """Read the queue counts from /queue; an error marks the instance unhealthy."""
+        try:
+            response = get_session().get(f"{self.url}/queue", timeout=timeout)
+            response.raise_for_status()
+            queue = response.json()
+        except Exception as e:
+            self.failures += 1
+            if self.healthy:
+                log.warning("ComfyUI instance %s is down: %s", self.name, e)
+            self.healthy = False
+            return
+        if not self.healthy:
+            log.info("ComfyUI instance %s is back", self.name)
+        self.healthy = True
+        self.running = len(queue.get('queue_running', []))
+        self.pending = len(queue.get('queue_pending', []))
+        self.routed = 0
+
+
+def parse_instances(value, default_url, output_dir, comfy_output_dir):
+    """Return (url, output_dir, comfy_output_dir) tuples from a COMFY_INSTANCES value."""
+    instances = []
+    for entry in (value or default_url).split(','):
+        parts = [part.strip() for part in entry.strip().split('|')]
+        if not parts[0]:
+            continue
+        instances.append((
+            parts[0],
+            parts[1] if len(parts) > 1 and parts[1] else output_dir,
+            parts[2] if len(parts) > 2 and parts[2] else comfy_output_dir,
+        ))
+    return instances
+
+
+class ComfyPool:
+    def __init__(self, client_id, on_finished, on_failed, on_started, queue_depth, default_url, output_dir, comfy_output_dir):
+        self.client_id = client_id
+        self.queue_depth = queue_depth
+        self.health_timeout = float(os.getenv('COMFY_HEALTH_TIMEOUT') or 5)
+        self.lock = threading.Lock()
+
+        self.instances = {}
+        for url, instance_output_dir, instance_comfy_output_dir in parse_instances(
+            os.getenv('COMFY_INSTANCES'), default_url, output_dir, comfy_output_dir
+        ):
+            name = url.split('://', 1)[-1].rstrip('/')
+            listener = ComfyEventListener(url, client_id, on_finished, on_failed, on_started=on_started)
+            self.instances[name] = ComfyInstance(name, url, instance_output_dir, instance_comfy_output_dir, listener)
+        self.default = next(iter(self.instances.values()))
+        self.checker = ThreadPoolExecutor(max_workers=len(self.instances), thread_name_prefix="comfy-health")
+
+    def start(self):
+        for instance in self.instances.values():
+            instance.listener.start()
+
+    def get(self, name):
+        """The instance a prompt was submitted to; prompts from before the pool existed ran on the first one."""
+        return self.instances.get(name) or self.default
+
+    def refresh(self):
+        """Health check every instance at once and return the total number of free queue slots."""
+        list(self.checker.map(lambda instance: instance.refresh(self.health_timeout), self.instances.values()))
+        return self.free_slots()
+
+    def free_slots(self):
+        with self.lock:
+            return sum(self._free(instance) for instance in self.instances.values() if instance.healthy)
+
+    def _free(self, instance):
+        # One running plus queue_depth waiting, like a single instance
+        return max(0, self.queue_depth + 1 - instance.load)
+
+    def pick(self, key=None):
+        """Reserve a queue slot on the least loaded healthy instance, or return None if all are full."""
+        with self.lock:
+            candidates = [i for i in self.instances.values() if i.healthy and self._free(i) > 0]
+            if not candidates:
+                return None
+            instance = min(candidates, key=lambda i: (i.load, key is not None and i.last_key != key, i.submitted))
+            instance.routed += 1
+            instance.last_key = key
+            return instance
+
+    def unpick(self, instance):
+        """Give back a slot reserved by pick() for a prompt that was not queued after all."""
+        with self.lock:
+            instance.routed = max(0, instance.routed - 1)
+
+    def forget(self, prompt_id):
+        for instance in self.instances.values():
+            instance.listener.forget(prompt_id)
+
+    def stats(self):
+        return {
+            name: {
+                'healthy': instance.healthy,
+                'running': instance.running,
+                'pending': instance.pending,
+                'submitted': instance.submitted,
+                'failures': instance.failures,
+            }
+            for name, instance in self.instances.items()
+        }
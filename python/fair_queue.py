@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import worker_metrics
+
+# Shares a worker's render slots fairly between users.
+#
+# Prompts used to go out oldest first, so a user who queued a few hundred prompts had every
+# slot until the last of them was done and anyone else waited behind them. The workers now
+# take their new prompts in start-time fair queueing order: every user has a virtual finish
+# tag that each dispatched prompt moves on by 1/weight, and the user with the lowest tag
+# goes next. A user who comes back after a break starts at the current virtual time, so they
+# get the next slot without being owed the time they were away. Within a user prompts keep
+# the order the worker had them in (e.g. the ComfyUI worker's model affinity order).
+#
+# Strict turns would undo the ComfyUI worker's model grouping: two users on different models
+# would make ComfyUI swap checkpoints on every job. So the worker can pass a group key, and
+# a user whose next prompt needs what ComfyUI has loaded goes first as long as they are at
+# most FAIR_AFFINITY_SLACK jobs ahead of the user whose turn it is. The users then take
+# turns in runs of a few jobs per model, and nobody falls more than the slack behind.
+#
+# A user who has had prompts waiting on this worker for a while gets their next prompt
+# brought forward, up to one of their jobs once they have waited FAIR_AGE_BOOST_SECONDS.
+# The boost is capped so an old backlog can't push ahead of a user who just arrived.
+#
+# FAIR_USER_MAX_IN_FLIGHT caps the prompts one user has in flight on this worker at once;
+# the rest stay claimed until one of theirs finishes. The cap is off by default: with
+# fair ordering alone a single busy user still gets every slot nobody else wants.
+#
+#   FAIR_USER_WEIGHTS        user_id:weight pairs, comma separated (default weight 1)
+#   FAIR_USER_MAX_IN_FLIGHT  prompts in flight per user at most (default 0, no cap)
+#   FAIR_USER_LIMITS         user_id:cap pairs overriding FAIR_USER_MAX_IN_FLIGHT per user
+#   FAIR_AGE_BOOST_SECONDS   wait for the full one-job boost (default 60, 0 = no boost)
+#   FAIR_AFFINITY_SLACK      jobs a user may run ahead to stay on the loaded model (default 2, 0 = strict turns)
+
+
+def parse_user_values(value, cast=float):
+    """Read a "user_id:value,user_id:value" setting into a dict keyed by user id as a string."""
+    values = {}
+    for entry in (value or "").split(','):
+        user_id, _, number = entry.partition(':')
+        if user_id.strip() and number.strip():
+            values[user_id.strip()] = cast(number.strip())
+    return values
+
+
+def created_at(prompt):
+    """Unix time the prompt was created, or None if the API did not send a usable one."""
+    value = prompt.get('created_at')
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+
+class FairQueue:
+    def __init__(self, weights=None, max_in_flight=None, user_limits=None, age_boost_seconds=None, affinity_slack=None):
+        self.weights = weights if weights is not None else parse_user_values(os.getenv('FAIR_USER_WEIGHTS'))
+        self.max_in_flight = int(max_in_flight if max_in_flight is not None else os.getenv('FAIR_USER_MAX_IN_FLIGHT') or 0)
+        self.user_limits = user_limits if user_limits is not None else parse_user_values(os.getenv('FAIR_USER_LIMITS'), int)
+        self.age_boost = float(age_boost_seconds if age_boost_seconds is not None else os.getenv('FAIR_AGE_BOOST_SECONDS') or 60)
+        self.affinity_slack = float(affinity_slack if affinity_slack is not None else os.getenv('FAIR_AFFINITY_SLACK') or 2)
+        self.lock = threading.Lock()
+
+        self.virtual_time = 0.0
+        # user id -> virtual finish tag of their last dispatched prompt
+        self.finish_tags = {}
+        # prompt id -> wall time the prompt was first seen, for prompts without created_at
+        self.first_seen = {}
+        # user id -> monotonic time since which the user has had new prompts waiting here
+        self.backlogged_since = {}
+        # users exported to the per-user gauges, so they go back to 0 once idle
+        self.known_users = set()
+
+        self.capped = 0
+        self.dispatched_count = 0
+
+    def weight(self, user_id):
+        return max(0.01, self.weights.get(str(user_id), 1.0))
+
+    def limit(self, user_id):
+        """A user's in-flight cap, 0 for none."""
+        return self.user_limits.get(str(user_id), self.max_in_flight)
+
+    def waited(self, prompt, now):
+        started = created_at(prompt) or self.first_seen.get(prompt['id'], now)
+        return max(0.0, now - started)
+
+    def order(self, prompts, busy=(), key=None, current_key=None):
+        """
+        Return (ordered, capped) for a pass's new prompts: ordered in the order to dispatch
+        them, capped held back as their user is at the in-flight cap. busy are the prompts
+        this worker already has in flight, which count against the cap. key(prompt) is what
+        the renderer has to load for a prompt and current_key what it has loaded now; users
+        whose next prompt is on the loaded group go first within the affinity slack.
+        """
+        now = time.time()
+        now_monotonic = time.monotonic()
+        in_flight = {}
+        for prompt in busy:
+            user_id = str(prompt['user_id'])
+            in_flight[user_id] = in_flight.get(user_id, 0) + 1
+
+        queues = {}
+        for prompt in prompts:
+            queues.setdefault(str(prompt['user_id']), []).append(prompt)
+
+        with self.lock:
+            held = {p['id'] for p in prompts}
+            for prompt_id in [i for i in self.first_seen if i not in held]:
+                del self.first_seen[prompt_id]
+            for prompt in prompts:
+                self.first_seen.setdefault(prompt['id'], now)
+            for user_id in [u for u in self.backlogged_since if u not in queues]:
+                del self.backlogged_since[user_id]
+            boosts = {}
+            for user_id in queues:
+                since = self.backlogged_since.setdefault(user_id, now_monotonic)
+                if self.age_boost > 0:
+                    boosts[user_id] = min(1.0, (now_monotonic - since) / self.age_boost) / self.weight(user_id)
+                else:
+                    boosts[user_id] = 0.0
+            # The tags as they will be once this pass's prompts are dispatched
+            tags = {u: max(self.virtual_time, self.finish_tags.get(u, 0.0)) for u in queues}
+            users = set(in_flight) | set(queues) | self.known_users
+            self.known_users = set(in_flight) | set(queues)
+
+        def priority(user_id):
+            return tags[user_id] + 1 / self.weight(user_id) - boosts[user_id], queues[user_id][0]['id']
+
+        ordered = []
+        capped = []
+        last_key = current_key
+        while queues:
+            user_id = min(queues, key=priority)
+            if key is not None and self.affinity_slack > 0:
+                # Stay on the loaded group if a user on it is not too far past their turn
+                slack = priority(user_id)[0] + self.affinity_slack
+                same_group = [u for u in queues if key(queues[u][0]) == last_key and priority(u)[0] <= slack]
+                if same_group:
+                    user_id = min(same_group, key=priority)
+            limit = self.limit(user_id)
+            if limit and in_flight.get(user_id, 0) >= limit:
+                capped.extend(queues.pop(user_id))
+                continue
+            prompt = queues[user_id].pop(0)
+            ordered.append(prompt)
+            if key is not None:
+                last_key = key(prompt)
+            in_flight[user_id] = in_flight.get(user_id, 0) + 1
+            tags[user_id] += 1 / self.weight(user_id)
+            if not queues[user_id]:
+                del queues[user_id]
+
+        with self.lock:
+            self.capped = len(capped)
+
+        waiting = {u: 0 for u in users}
+        for prompt in prompts:
+            waiting[str(prompt['user_id'])] += 1
+        busy_counts = {u: 0 for u in users}
+        for prompt in busy:
+            busy_counts[str(prompt['user_id'])] += 1
+        worker_metrics.set_user_jobs("waiting", waiting)
+        worker_metrics.set_user_jobs("in_flight", busy_counts)
+        return ordered, capped
+
+    def dispatched(self, prompt):
+        """Charge a prompt that was just sent to a renderer to its user."""
+        now = time.time()
+        user_id = str(prompt['user_id'])
+        with self.lock:
+            start = max(self.virtual_time, self.finish_tags.get(user_id, 0.0))
+            self.finish_tags[user_id] = start + 1 / self.weight(user_id)
+            self.virtual_time = start
+            # Users whose tag the clock has passed start from it anyway
+            for idle_user in [u for u, tag in self.finish_tags.items() if tag <= self.virtual_time]:
+                del self.finish_tags[idle_user]
+            waited = self.waited(prompt, now)
+            self.first_seen.pop(prompt['id'], None)
+            self.dispatched_count += 1
+        worker_metrics.observe_user_wait(user_id, waited)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'users': len(self.known_users),
+                'capped': self.capped,
+                'dispatched': self.dispatched_count,
+            }
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import worker_logging
+from worker_http import get_session
+
+# Local cache of the input images of mix, mix-one and kontext jobs.
+#
+# Input images are kept in one directory, named after a hash of their URL, with a small JSON
+# file next to each holding the URL, ETag and Last-Modified of the download. The same source
+# image is often used by many prompts, so it is downloaded once; after
+# INPUT_CACHE_REVALIDATE_SECONDS a conditional GET (If-None-Match / If-Modified-Since) checks
+# it is still current.
+#
+# prefetch() starts downloads on a small thread pool, so the worker can fetch the inputs of
+# claimed prompts while ComfyUI is busy with earlier ones; get() returns the local file,
+# waiting for a running download or starting one. get() pins the image to the job (its
+# owner) before it waits, until release(), so an image ComfyUI still has to load is never
+# evicted. Hits and misses count get() calls only: a hit is an image that was ready, a miss
+# one get() had to wait for.
+# Unpinned files are evicted least recently used first once the directory is over
+# INPUT_CACHE_MAX_MB. Partial downloads are written to .part files and removed on failure
+# and on startup. Only one worker should use a cache directory.
+#
+#   INPUT_CACHE_DIR                 cache directory (default python/input-cache)
+#   INPUT_CACHE_MAX_MB              size cap of the directory (default 1024)
+#   INPUT_CACHE_REVALIDATE_SECONDS  age after which a cached image is revalidated (default 3600)
+#   INPUT_PREFETCH_WORKERS          downloads at once (default 4)
+
+log = worker_logging.get_logger("input_cache")
+
+MB = 1024 * 1024
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class InputImageCache:
+    def __init__(self, cache_dir=None, max_mb=None, revalidate_seconds=None, workers=None):
+        self.cache_dir = Path(cache_dir or os.getenv('INPUT_CACHE_DIR') or Path(__file__).resolve().parent / 'input-cache')
+        self.max_bytes = float(max_mb or os.getenv('INPUT_CACHE_MAX_MB') or 1024) * MB
+        self.revalidate_seconds = float(revalidate_seconds or os.getenv('INPUT_CACHE_REVALIDATE_SECONDS') or 3600)
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(workers or os.getenv('INPUT_PREFETCH_WORKERS') or 4),
+            thread_name_prefix="input-prefetch"
+        )
+
+        self.lock = threading.Lock()
+        # url -> metadata dict, least recently used first
+        self.entries = OrderedDict()
+        # url -> Future of a running download
+        self.downloads = {}
+        # owner (prompt id) -> urls pinned for it
+        self.pins = {}
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def _paths(self, url):
+        key = url_key(url)
+        return self.cache_dir / f"{key}.img", self.cache_dir / f"{key}.json"
+
+    def _load(self):
+        """Rebuild the index from the directory, dropping leftovers of interrupted downloads."""
+        for part in self.cache_dir.glob('*.part'):
+            part.unlink(missing_ok=True)
+        found = []
+        for meta_path in self.cache_dir.glob('*.json'):
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                image_path = meta_path.with_suffix('.img')
+                meta['size'] = image_path.stat().st_size
+                found.append((image_path.stat().st_mtime, meta))
+            except (OSError, ValueError, KeyError):
+                meta_path.unlink(missing_ok=True)
+                meta_path.with_suffix('.img').unlink(missing_ok=True)
+        for _, meta in sorted(found, key=lambda item: item[0]):
+            self.entries[meta['url']] = meta
+            self.size += meta['size']
+        with self.lock:
+            self._evict()
+
+    def prefetch(self, urls):
+        """Start downloading any of these URLs that are not cached yet. Does not wait."""
+        for url in urls:
+            if url:
+                self._future(url, count=False)
+
+    def get(self, url, owner, timeout=120):
+        """
+        Return the local path of an input image, downloading it if needed, and pin it to owner.
+        Returns None if the download failed.
+        """
+        # Pinned first, so the image can't be evicted between its download and ComfyUI loading it
+        with self.lock:
+            self.pins.setdefault(owner, set()).add(url)
+        path = self._future(url).result(timeout)
+        if path is None:
+            with self.lock:
+                self.pins.get(owner, set()).discard(url)
+        return path
+
+    def release(self, owner):
+        """Unpin every image handed out to owner, making it evictable again."""
+        with self.lock:
+            if self.pins.pop(owner, None):
+                self._evict()
+
+    def _future(self, url, count=True):
+        with self.lock:
+            future = self.downloads.get(url)
+            if future is not None:
+                if count:
+                    self.misses += 1
+                return future
+            entry = self.entries.get(url)
+            if entry is not None and time.time() - entry['checked_at'] < self.revalidate_seconds:
+                if count:
+                    self.hits += 1
+                self.entries.move_to_end(url)
+                future = Future()
+                future.set_result(str(self._paths(url)[0]))
+                return future
+            if count:
+                self.misses += 1
+            future = self.executor.submit(self._download, url, entry)
+            self.downloads[url] = future
+            return future
+
+    def _download(self, url, entry):
+        image_path, meta_path = self._paths(url)
+        part_path = image_path.with_name(f"{image_path.name}.{threading.get_ident()}.part")
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = get_session().get(url, stream=True, timeout=60, headers=headers)
+            if entry and response.status_code == 304:
+                response.close()
+                with self.lock:
+                    entry['checked_at'] = time.time()
+                    self.revalidated += 1
+                self._write_meta(meta_path, entry)
+                return str(image_path)
+
+            response.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=256 * 1024):
+                    f.write(chunk)
+            os.replace(part_path, image_path)
+
+            meta = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked_at': time.time(),
+                'size': image_path.stat().st_size,
+            }
+            self._write_meta(meta_path, meta)
+            with self.lock:
+                old = self.entries.pop(url, None)
+                if old:
+                    self.size -= old['size']
+                self.entries[url] = meta
+                self.size += meta['size']
+                self._evict()
+            log.info("Cached input image %s (%d bytes)", url, meta['size'])
+            return str(image_path)
+        except Exception as e:
+            part_path.unlink(missing_ok=True)
+            if entry and image_path.exists():
+                log.warning("Could not revalidate input image %s, using the cached copy: %s", url, e)
+                return str(image_path)
+            log.error("Error downloading input image %s: %s", url, e)
+            return None
+        finally:
+            with self.lock:
+                self.downloads.pop(url, None)
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        tmp_path = meta_path.with_name(f"{meta_path.name}.{threading.get_ident()}.part")
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _evict(self):
+        """Remove least recently used, unpinned images until the cache fits its cap. Call with the lock held."""
+        if self.size <= self.max_bytes:
+            return
+        pinned = set().union(*self.pins.values()) if self.pins else set()
+        for url in list(self.entries):
+            if self.size <= self.max_bytes:
+                break
+            if url in pinned or url in self.downloads:
+                continue
+            meta = self.entries.pop(url)
+            self.size -= meta['size']
+            self.evictions += 1
+            image_path, meta_path = self._paths(url)
+            meta_path.unlink(missing_ok=True)
+            image_path.unlink(missing_ok=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size_mb': round(self.size / MB, 1),
+                'pinned': sum(len(urls) for urls in self.pins.values()),
+                'downloading': len(self.downloads),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'evictions': self.evictions,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import worker_logging
+
+# Small persistent record of the jobs a render worker has started, kept in a local SQLite file
+# so stuck-job detection survives restarts.
+#
+# Each prompt gets a submit time, an attempt count, the last state seen and a wall-clock
+# deadline; a prompt still unfinished after its deadline is considered stuck. Finished
+# entries are compacted away after JOB_STATE_RETENTION_HOURS. A prompt rendered in a batch
+# with others also records the file its image is written to under the batch's name.
+#
+#   JOB_STATE_DB               sqlite file (default python/job-state-<worker>.sqlite3)
+#   JOB_DEADLINE_SECONDS       time a job may take before it is failed (default set per worker)
+#   JOB_STATE_RETENTION_HOURS  how long finished entries are kept (default 24)
+
+log = worker_logging.get_logger("job_state")
+
+COMPACT_INTERVAL = 600
+
+
+class JobStateStore:
+    def __init__(self, worker_name, deadline_seconds, db_path=None):
+        self.db_path = db_path or os.getenv('JOB_STATE_DB', str(Path(__file__).resolve().parent / f"job-state-{worker_name}.sqlite3"))
+        self.deadline_seconds = float(os.getenv('JOB_DEADLINE_SECONDS') or deadline_seconds)
+        self.retention = float(os.getenv('JOB_STATE_RETENTION_HOURS', 24)) * 3600
+        self.last_compacted = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " prompt_id INTEGER PRIMARY KEY,"
+            " submitted_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " deadline REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_state TEXT,"
+            " finished_at REAL,"
+            " instance TEXT,"
+            " batch_output TEXT)"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        # Stores created before jobs were pinned to an instance or rendered in batches
+        for column in ('instance', 'batch_output'):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        self.db.commit()
+
+    def record_submit(self, prompt_id, state, instance=None, batch_output=None):
+        """
+        A new attempt at rendering the prompt has started; restarts its deadline. instance names
+        the backend (e.g. ComfyUI instance) the attempt runs on, batch_output the file the image
+        is saved as when the prompt is rendered in a batch.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (prompt_id, submitted_at, updated_at, deadline, attempts, last_state, instance, batch_output)"
+                " VALUES (?, ?, ?, ?, 1, ?, ?, ?)"
+                " ON CONFLICT(prompt_id) DO UPDATE SET submitted_at = excluded.submitted_at,"
+                " updated_at = excluded.updated_at, deadline = excluded.deadline,"
+                " attempts = attempts + 1, last_state = excluded.last_state, finished_at = NULL,"
+                " instance = excluded.instance, batch_output = excluded.batch_output",
+                (prompt_id, now, now, now + self.deadline_seconds, state, instance, batch_output)
+            )
+            self.db.commit()
+
+    def record_seen(self, prompt_id, state):
+        """
+        The prompt was seen still in progress. Prompts we have no record of (e.g. started before
+        this store existed) get their deadline counted from now.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO jobs (prompt_id, submitted_at, updated_at, deadline, attempts, last_state)"
+                " VALUES (?, ?, ?, ?, 0, ?)"
+                " ON CONFLICT(prompt_id) DO UPDATE SET updated_at = excluded.updated_at,"
+                " last_state = excluded.last_state",
+                (prompt_id, now, now, now + self.deadline_seconds, state)
+            )
+            self.db.commit()
+
+    def is_expired(self, prompt_id):
+        with self.lock:
+            row = self.db.execute("SELECT deadline, finished_at FROM jobs WHERE prompt_id = ?", (prompt_id,)).fetchone()
+        return row is not None and row[1] is None and row[0] < time.time()
+
+    def get(self, prompt_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT submitted_at, deadline, attempts, last_state, finished_at, instance, batch_output"
+                " FROM jobs WHERE prompt_id = ?",
+                (prompt_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('submitted_at', 'deadline', 'attempts', 'last_state', 'finished_at', 'instance', 'batch_output'), row))
+
+    def mark_finished(self, prompt_id, state):
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET finished_at = ?, updated_at = ?, last_state = ? WHERE prompt_id = ?",
+                (now, now, state, prompt_id)
+            )
+            self.db.commit()
+
+    def compact(self):
+        """Drop finished entries past the retention period and unfinished ones nobody has seen in a week."""
+        now = time.time()
+        if now - self.last_compacted < COMPACT_INTERVAL:
+            return
+        self.last_compacted = now
+        with self.lock:
+            removed = self.db.execute(
+                "DELETE FROM jobs WHERE (finished_at IS NOT NULL AND finished_at < ?) OR updated_at < ?",
+                (now - self.retention, now - 7 * 86400)
+            ).rowcount
+            self.db.commit()
+        if removed:
+            log.info("Compacted %d old job state entries", removed)
@@ -0,0 +1,140 @@
+import os
+import socket
+import threading
+import time
+
+import worker_logging
+from worker_http import get_api_session
+
+# Fetching and claiming the pending queue for a render worker.
+#
+# Workers ask /prompts/pending-jobs for only the generation types and models they handle
+# and page through it with the returned cursor, oldest prompt first.
+#
+# To run several workers side by side they claim prompts instead (PromptLeases): a claim
+# gives the worker a lease on the prompts until LEASE_SECONDS from now, a heartbeat keeps
+# extending it for jobs still in progress, and a lease that runs out (crashed worker) lets
+# any other worker claim the prompt again. Claims go round the users first, CLAIM_PER_USER
+# new prompts each, so one user's big batch does not fill every claim (see fair_queue.py).
+#
+#   PENDING_PAGE_SIZE    prompts per request (default 100)
+#   PENDING_MAX_PROMPTS  prompts fetched per pass at most (default 500)
+#   WORKER_ID            claim owner name (default <hostname>-<pid>)
+#   LEASE_SECONDS        lease length (default 120), heartbeats are sent every third of it
+#   CLAIM_PER_USER       new prompts claimed per user before the rest go oldest first (default 1, 0 = oldest first only)
+
+log = worker_logging.get_logger("prompt_queue")
+
+
+def _matches(prompt, generation_types, models):
+    return prompt['generation_type'] in generation_types and prompt['model'] in models
+
+
+def fetch_pending_prompts(api_base_url, generation_types, models, page_size=None, max_prompts=None):
+    """Return pending, rendering and re-check prompts (status 0/1/3) for the given types and models."""
+    page_size = page_size or int(os.getenv('PENDING_PAGE_SIZE', 100))
+    max_prompts = max_prompts or int(os.getenv('PENDING_MAX_PROMPTS', 500))
+    session = get_api_session()
+
+    prompts = []
+    cursor = 0
+    while cursor is not None and len(prompts) < max_prompts:
+        response = session.get(f"{api_base_url}/prompts/pending-jobs", params={
+            'generation_types[]': list(generation_types),
+            'models[]': list(models),
+            'limit': min(page_size, max_prompts - len(prompts)),
+            'cursor': cursor
+        })
+        if response.status_code == 404:
+            # Older API without the lean endpoint: fetch everything and filter here
+            response = session.get(f"{api_base_url}/prompts/pending")
+            response.raise_for_status()
+            return [p for p in response.json()['prompts'] if _matches(p, generation_types, models)][:max_prompts]
+
+        response.raise_for_status()
+        data = response.json()
+        prompts.extend(data['prompts'])
+        cursor = data.get('next_cursor')
+
+    return prompts
+
+
+class PromptLeases:
+    def __init__(self, api_base_url, generation_types, models, worker_id=None, lease_seconds=None):
+        self.api_base_url = api_base_url
+        self.generation_types = list(generation_types)
+        self.models = list(models)
+        self.worker_id = worker_id or os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds or int(os.getenv('LEASE_SECONDS', 120))
+        self.per_user = int(os.getenv('CLAIM_PER_USER') or 1)
+
+        # Prompts this worker is actively working on; their leases are extended by the heartbeat
+        self.active_ids = set()
+        self.lock = threading.Lock()
+        self.claims_supported = True
+        self.heartbeat_thread = None
+
+    def _scope(self):
+        return {
+            'worker_id': self.worker_id,
+            'generation_types': self.generation_types,
+            'models': self.models,
+        }
+
+    def claim(self, limit):
+        """
+        Claim up to `limit` new prompts and return every prompt this worker holds.
+        Falls back to an unclaimed fetch if the API has no claim endpoint.
+        """
+        if self.claims_supported:
+            response = get_api_session().post(f"{self.api_base_url}/prompts/claim", json=dict(
+                self._scope(),
+                limit=max(0, limit),
+                per_user=max(0, self.per_user),
+                lease_seconds=self.lease_seconds
+            ))
+            if response.status_code not in (404, 405):
+                response.raise_for_status()
+                return response.json()['prompts']
+            log.warning("Claim endpoint not available, fetching pending prompts without leases")
+            self.claims_supported = False
+
+        return fetch_pending_prompts(self.api_base_url, self.generation_types, self.models)
+
+    def track(self, prompt_id):
+        with self.lock:
+            self.active_ids.add(prompt_id)
+
+    def untrack(self, prompt_id):
+        with self.lock:
+            self.active_ids.discard(prompt_id)
+
+    def start_heartbeat(self):
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self.lock:
+                ids = list(self.active_ids)
+            if not ids or not self.claims_supported:
+                continue
+            try:
+                get_api_session().post(f"{self.api_base_url}/prompts/heartbeat", json=dict(
+                    self._scope(),
+                    ids=ids,
+                    lease_seconds=self.lease_seconds
+                )).raise_for_status()
+            except Exception as e:
+                log.error("Error extending prompt leases: %s", e)
+
+    def release_all(self):
+        """Release every claim held by this worker so others can pick the prompts up right away."""
+        if not self.claims_supported:
+            return
+        try:
+            get_api_session().post(f"{self.api_base_url}/prompts/release", json=self._scope()).raise_for_status()
+            log.info("Released prompt claims for worker %s", self.worker_id)
+        except Exception as e:
+            log.error("Error releasing prompt claims: %s", e)
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import worker_logging
+
+# Per-provider pacing for the remote worker.
+#
+# Each provider gets a token bucket for its request quota (<PROVIDER>_RATE_PER_MINUTE, with a
+# burst of <PROVIDER>_RATE_BURST) and an adaptive limit on concurrent calls. The limit follows
+# AIMD: every successful call adds 1/limit (about +1 per round of calls) up to the configured
+# maximum, and a throttled call (429, 5xx or a timeout) halves it and empties the bucket so
+# the provider gets a short break.
+#
+#   FAL_RATE_PER_MINUTE, MINIMAX_RATE_PER_MINUTE  requests per minute (default 60 / 20)
+#   FAL_RATE_BURST, MINIMAX_RATE_BURST            bucket size (default 5)
+#   RATE_LIMIT_MIN_CONCURRENCY                    the adaptive limit never drops below this (default 1)
+
+log = worker_logging.get_logger("rate_limit")
+
+OK = "ok"
+THROTTLED = "throttled"
+ERROR = "error"
+
+DEFAULT_RATE_PER_MINUTE = {"fal": 60, "minimax": 20}
+
+
+def outcome_for(exc):
+    """Classify a failed provider call: THROTTLED for rate limits, server errors and timeouts, otherwise ERROR."""
+    if isinstance(exc, (TimeoutError, FutureTimeoutError, asyncio.TimeoutError)):
+        return THROTTLED
+    response = getattr(exc, 'response', None)
+    status = getattr(exc, 'status_code', None) or getattr(response, 'status_code', None)
+    if status is None:
+        # Exceptions re-raised from a pool process lose their response, fall back to the message
+        message = str(exc)
+        return THROTTLED if any(code in message for code in ('429', '502', '503', '504')) else ERROR
+    return THROTTLED if status == 429 or status >= 500 else ERROR
+
+
+class ProviderLimiter:
+    def __init__(self, name, max_concurrency, rate_per_minute=None, burst=None, min_concurrency=None):
+        prefix = name.upper()
+        self.name = name
+        self.rate = float(rate_per_minute or os.getenv(f'{prefix}_RATE_PER_MINUTE', DEFAULT_RATE_PER_MINUTE.get(name, 60))) / 60
+        self.burst = float(burst or os.getenv(f'{prefix}_RATE_BURST', 5))
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(max_concurrency, min_concurrency or int(os.getenv('RATE_LIMIT_MIN_CONCURRENCY', 1)))
+
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.limit = float(max_concurrency)
+        self.active = 0
+
+        self.calls = 0
+        self.throttled = 0
+        self.errors = 0
+
+    @property
+    def concurrency(self):
+        """Current adaptive concurrency limit."""
+        return max(self.min_concurrency, int(self.limit))
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def try_acquire(self):
+        """Take a token and a concurrency slot. Returns 0 on success, otherwise how long to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.active >= self.concurrency:
+                return 0.1
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.active += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(min(wait, 1))
+
+    async def acquire_async(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(min(wait, 1))
+
+    def release(self, outcome):
+        with self.lock:
+            self.active -= 1
+            self.calls += 1
+            if outcome == THROTTLED:
+                self.throttled += 1
+                self.limit = max(float(self.min_concurrency), self.limit / 2)
+                self.tokens = 0
+                log.warning("%s is throttling us, concurrency limit down to %d", self.name, self.concurrency)
+            else:
+                if outcome == ERROR:
+                    self.errors += 1
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+
+    def stats(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return {
+                'limit': self.concurrency,
+                'max_limit': self.max_concurrency,
+                'active': self.active,
+                'tokens': round(self.tokens, 2),
+                'rate_per_minute': self.rate * 60,
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'errors': self.errors,
+            }
@@ -1,23 +1,37 @@
-import json
-from urllib import request
 import time
 import random
 import os
-import requests
-import json
 import boto3
 from dotenv import load_dotenv
 from shutil import copyfile
-import tempfile
 import math
 from pathlib import Path
 import argparse
+import threading
+import uuid
+
+from callback_buffer import CallbackBuffer
+from affinity_scheduler import AffinityScheduler, group_key
+from comfy_pool import ComfyPool
+from fair_queue import FairQueue
+from input_cache import InputImageCache
+from job_state import JobStateStore
+from prompt_queue import PromptLeases
+from result_cache import ResultCache, make_key as result_cache_key
+import s3_transfer
+import variations
+import workflow_templates
+import worker_logging
+import worker_metrics
 
 
 current_dir = Path(__file__).resolve().parent
 env_path = current_dir.parent / '.env'
 load_dotenv(env_path)
 
+worker_logging.setup("comfy")
+log = worker_logging.get_logger("comfy")
+
 parser = argparse.ArgumentParser(description="Run the image generation script.")
 parser.add_argument(
     '--local',
@@ -28,13 +42,20 @@ args = parser.parse_args()
 
 if args.local:
     API_BASE_URL = "http://localhost:8011/api"
-    print(f"--- Running in LOCAL mode. API endpoint set to: {API_BASE_URL} ---")
+    log.info("Running in LOCAL mode, API endpoint set to %s", API_BASE_URL)
 else:
     API_BASE_URL = os.getenv('API_BASE_URL')
-    print(f"--- Running in DEFAULT mode. API endpoint from .env: {API_BASE_URL} ---")
+    log.info("Running in DEFAULT mode, API endpoint from .env: %s", API_BASE_URL)
+
+callback_buffer = CallbackBuffer(API_BASE_URL)
+result_cache = ResultCache()
 
 OUTPUT_DIR = os.getenv('OUTPUT_DIR')
 COMFY_DEFAULT_OUTPUT_DIR = os.getenv('COMFY_DEFAULT_OUTPUT_DIR')
+# Single ComfyUI instance, unless COMFY_INSTANCES lists several (see comfy_pool.py)
+COMFY_URL = os.getenv('COMFY_URL', 'http://127.0.0.1:8188')
+# Number of prompts to keep waiting in each ComfyUI's queue behind the one that is executing
+COMFY_QUEUE_DEPTH = int(os.getenv('COMFY_QUEUE_DEPTH', 2))
 MOVE_TO_DIR = os.getenv('MOVE_TO_DIR')
 OPENROUTER_API_KEY = os.getenv('OPEN_ROUTER_API_KEY')
 YOUR_SITE_URL = "http://localhost:8011" # os.getenv('OPEN_ROUTER_YOUR_SITE_URL')
@@ -80,394 +101,561 @@ def get_aspect_ratio(width, height):
 
     return closest_ratio[0]
 
-def download_image(url, output_path):
-    """Download an image from a URL to a local path"""
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
 
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+def update_image_filename(id, file_path, is_s3_url=True):
+    """Queue the final image path or URL for a prompt; sent with the next batch callback."""
+    callback_buffer.set_filename(id, file_path)
+    log.info("Queued filename update for prompt %s with path %s", id, file_path)
 
-        print(f"Successfully downloaded image from {url} to {output_path}")
-        return output_path
-    except Exception as e:
-        print(f"Error downloading image from {url}: {e}")
-        return None
 
+def update_render_status(id, status):
+    """Queue a render status change for a prompt; sent with the next batch callback."""
+    callback_buffer.set_status(id, status)
+    log.info("Queued render status %s for prompt %s", status, id)
+
+
+# mix-one input_image_1_strength -> StyleModelApplySimple image_strength
+IMAGE_STRENGTH_NAMES = {
+    1: "highest",
+    2: "high",
+    3: "medium",
+    4: "low",
+    5: "lowest",
+}
+
+
+# Generation types whose workflows load input images, and the prompt fields holding their URLs
+INPUT_IMAGE_FIELDS = {
+    "mix": ('input_image_1', 'input_image_2'),
+    "mix-one": ('input_image_1',),
+    "kontext-basic": ('input_image_1',),
+    "kontext-lora": ('input_image_1',),
+}
+
+
+def input_image_urls(prompt):
+    return [prompt[field] for field in INPUT_IMAGE_FIELDS.get(prompt['generation_type'], ()) if prompt.get(field)]
+
+
+def prepare_job_values(prompt):
+    """Fetch the input images for a prompt from the input cache and collect the values its workflow plan needs."""
+    prompt_id = prompt['id']
+    generation_type = prompt['generation_type']
+    model = prompt['model']
+
+    values = dict(prompt)
+    values['generated_prompt'] = prompt['generated_prompt'] or ""
+    values['seed'] = random.randint(1, 2**32)
+    values['output_filename'] = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
+
+    # Usually already prefetched; the files stay pinned in the cache until the job is done
+    for number, field in enumerate(INPUT_IMAGE_FIELDS.get(generation_type, ()), start=1):
+        path = input_cache.get(prompt[field], prompt_id)
+        if not path:
+            raise Exception(f"Failed to download image {number} from {prompt[field]}")
+        values[f'input_image_{number}_path'] = path
+
+    if generation_type == "mix":
+        log.debug(
+            "Mix prompt images %s and %s with strengths %s and %s, %sx%s: %.200s",
+            prompt.get('input_image_1'), prompt.get('input_image_2'),
+            prompt.get('input_image_1_strength', 1), prompt.get('input_image_2_strength', 1),
+            prompt['width'], prompt['height'], values['generated_prompt']
+        )
+    elif generation_type == "mix-one":
+        values['image_strength_name'] = IMAGE_STRENGTH_NAMES[prompt.get('input_image_1_strength', 1)]
+        log.debug(
+            "Mix-one prompt image %s with strength %s, %sx%s: %.200s",
+            prompt.get('input_image_1'), prompt.get('input_image_1_strength', 1),
+            prompt['width'], prompt['height'], values['generated_prompt']
+        )
+    elif generation_type == "kontext-lora":
+        values['lora_name'] = prompt['lora_name'] or ""
+        values['strength_model'] = float(prompt['strength_model'] or 1.0)
+        values['guidance'] = float(prompt['guidance'] or 7.5)
+
+    return values
+
+
+# Generation types and models rendered on the local ComfyUI by this worker
+LOCAL_GENERATION_TYPES = ["prompt", "mix", "mix-one", "kontext-basic", "kontext-lora"]
+LOCAL_MODELS = ["schnell", "dev"]
+
+# Kontext workflows end in a plain SaveImage node that picks its own file name, so the
+# rendered file has to be read from that node's outputs.
+KONTEXT_OUTPUT_NODES = {
+    "kontext-basic": "136",
+    "kontext-lora": "180",
+}
+
+# Each worker run gets its own ComfyUI client id (shared by all instances) so execution events are only sent to us
+COMFY_CLIENT_ID = str(uuid.uuid4())
+
+# prompt id (str) -> prompt, for jobs queued on ComfyUI whose completion we are waiting for
+active_jobs = {}
+active_jobs_lock = threading.Lock()
+# ComfyUI prompt id (str) -> the prompts it renders, for variations rendered as one batch.
+# The batch is queued under its first prompt's id, every prompt also has its own active job.
+batches = {}
+# prompt ids whose finished image is being uploaded to S3
+uploading_prompts = set()
+upload_executor = s3_transfer.UploadExecutor(s3_client, AWS_BUCKET, AWS_CLOUDFRONT_URL)
+# prompt id (str) -> {'queued': ..., 'started': ...} monotonic times, for the queue wait and generation timings
+render_timings = {}
+# Set when ComfyUI finishes one of our prompts, so the main loop can top the queue up right away
+queue_slot_freed = threading.Event()
+
+# Wall-clock time a prompt may stay queued or rendering on ComfyUI before it is marked as failed
+JOB_DEADLINE_SECONDS = 1800
+job_state = JobStateStore("comfy", JOB_DEADLINE_SECONDS)
+# Input images of claimed prompts, fetched ahead of submitting them
+input_cache = InputImageCache()
+# Orders new prompts by model/LoRA so ComfyUI swaps checkpoints as rarely as possible
+scheduler = AffinityScheduler()
+# Takes new prompts from the users in turn and caps each user's prompts in flight
+fair_queue = FairQueue()
+# Claimed status 0 prompts left waiting for a ComfyUI queue slot on the last pass
+claimed_waiting = 0
+
+prompt_leases = PromptLeases(API_BASE_URL, LOCAL_GENERATION_TYPES, LOCAL_MODELS)
+
+
+def instance_for(prompt):
+    """The ComfyUI instance a prompt was submitted to, from the active job or the job state."""
+    name = prompt.get('comfy_instance')
+    if name is None:
+        record = job_state.get(prompt['id'])
+        name = record and record['instance']
+    return comfy_pool.get(name)
+
+
+def batch_filename_template(prompt):
+    """FL_SaveImages file name template for a batch queued under prompt; {index} counts its images from 1."""
+    return f"{prompt['generation_type']}_{prompt['model']}_{prompt['id']}_{prompt['user_id']}_batch_{{index}}.png"
+
+
+def variation_limit(prompt):
+    """Only workflows that start from an empty latent can render a prompt's variations in one run."""
+    try:
+        return variations.batch_max() if workflow_templates.supports_batches(prompt['generation_type'], prompt['model']) else 1
+    except ValueError:
+        return 1
+
+
+def get_output_file(prompt, outputs=None, instance=None):
+    """
+    Where the rendered image for a prompt ends up. For kontext prompts this comes from the
+    ComfyUI node outputs and is None until ComfyUI has reported the saved image.
+    """
+    instance = instance or instance_for(prompt)
+    generation_type = prompt['generation_type']
+    if generation_type in KONTEXT_OUTPUT_NODES:
+        images = (outputs or {}).get(KONTEXT_OUTPUT_NODES[generation_type], {}).get('images', [])
+        if not images or not images[0].get('filename'):
+            return None
+        image_data = images[0]
+        return str(Path(instance.comfy_output_dir) / image_data.get('subfolder', '') / image_data['filename'])
+
+    output_filename = f"{generation_type}_{prompt['model']}_{prompt['id']}_{prompt['user_id']}.png"
+    return str(Path(instance.output_dir) / output_filename)
+
+
+def collect_batch_output(prompt, instance=None):
+    """Give a prompt rendered in a batch its own file name, once ComfyUI has saved the batch."""
+    record = job_state.get(prompt['id'])
+    batch_output = record and record['batch_output']
+    if batch_output and os.path.exists(batch_output):
+        os.replace(batch_output, get_output_file(prompt, instance=instance))
+
+
+def finalize_prompt(prompt, output_file):
+    """
+    Upload a rendered image (if requested) and report its location back to the API.
+    The upload runs on the upload executor; the filename callback is sent once it is done.
+    """
+    prompt_id = prompt['id']
+    s3_file_path = f"images/{Path(output_file).name}"
+    if not prompt['upload_to_s3']:
+        update_image_filename(prompt_id, output_file, False)
+        job_state.mark_finished(prompt_id, "done")
+        worker_metrics.job_finished(prompt, "done")
+        return
+
+    with active_jobs_lock:
+        if prompt_id in uploading_prompts:
+            return
+        uploading_prompts.add(prompt_id)
+    prompt_leases.track(prompt_id)
+
+    def on_uploaded(s3_url):
+        try:
+            if s3_url:
+                update_image_filename(prompt_id, s3_url)
+                if prompt.get('cache_key'):
+                    result_cache.store(prompt['cache_key'], s3_url)
+                job_state.mark_finished(prompt_id, "done")
+                worker_metrics.job_finished(prompt, "done")
+            else:
+                log.warning("S3 upload failed for prompt %s, will retry on the next pass", prompt_id)
+        finally:
+            prompt_leases.untrack(prompt_id)
+            with active_jobs_lock:
+                uploading_prompts.discard(prompt_id)
 
-def upload_to_s3(local_file, s3_file):
-    """Upload a file to S3"""
     try:
-        s3_client.upload_file(local_file, AWS_BUCKET, s3_file)
-        s3_url = f"{AWS_CLOUDFRONT_URL}/{s3_file}"
-        return s3_url
-    except NoCredentialsError:
-        print("AWS credentials not available")
-        return None
-    except Exception as e:
-        print(f"Error uploading to S3: {e}")
-        return None
+        upload_executor.submit_file(output_file, s3_file_path, on_uploaded, prompt)
+    except Exception:
+        prompt_leases.untrack(prompt_id)
+        with active_jobs_lock:
+            uploading_prompts.discard(prompt_id)
+        raise
+
+
+def claim_active_job(prompt_id):
+    """Remove a job from the active set. Only the caller that gets the prompt back may finalize it."""
+    comfy_pool.forget(prompt_id)
+    prompt_leases.untrack(int(prompt_id))
+    input_cache.release(int(prompt_id))
+    with active_jobs_lock:
+        batches.pop(str(prompt_id), None)
+        return active_jobs.pop(str(prompt_id), None)
+
+
+def claim_batch(prompt_id):
+    """Claim the active jobs of everything a ComfyUI prompt renders: the prompt itself or its whole batch."""
+    with active_jobs_lock:
+        members = batches.get(str(prompt_id))
+    prompt_ids = [member['id'] for member in members] if members else [prompt_id]
+    return [prompt for prompt in map(claim_active_job, prompt_ids) if prompt is not None]
+
+
+def observe_render(prompt, outcome):
+    """Record how long ComfyUI took to render a prompt, from the start event if we got one, else from queueing."""
+    timings = render_timings.pop(str(prompt['id']), None)
+    if timings:
+        started = timings.get('started') or timings['queued']
+        worker_metrics.observe("generation", time.monotonic() - started, prompt, outcome)
+
+
+def on_comfy_started(prompt_id):
+    timings = render_timings.get(str(prompt_id))
+    if timings is None:
+        return
+    timings['started'] = time.monotonic()
+    with active_jobs_lock:
+        prompt = active_jobs.get(str(prompt_id))
+    worker_metrics.observe("queue_wait", timings['started'] - timings['queued'], prompt)
+
+
+def on_comfy_finished(prompt_id, outputs):
+    """Called from the websocket listener as soon as ComfyUI has finished one of our prompts."""
+    queue_slot_freed.set()
+    prompts = claim_batch(prompt_id)
+    if not prompts:
+        return
+    observe_render(prompts[0], "ok")
+
+    for prompt in prompts:
+        with worker_logging.job(prompt):
+            collect_batch_output(prompt)
+            output_file = get_output_file(prompt, outputs)
+            if output_file and os.path.exists(output_file):
+                log.info("ComfyUI finished prompt %s, output: %s", prompt['id'], output_file)
+                finalize_prompt(prompt, output_file)
+            else:
+                # Leave it to the polling pass, which re-checks status 3 prompts
+                log.warning("ComfyUI finished prompt %s but the output file was not found", prompt['id'])
+                update_render_status(prompt['id'], 3)
+
+
+def on_comfy_failed(prompt_id, data):
+    queue_slot_freed.set()
+    prompts = claim_batch(prompt_id)
+    if not prompts:
+        return
+    observe_render(prompts[0], "error")
+    for prompt in prompts:
+        with worker_logging.job(prompt):
+            log.error("ComfyUI failed to render prompt %s: %s", prompt_id, data.get('exception_message', 'interrupted'))
+            update_render_status(prompt['id'], 4)
+            job_state.mark_finished(prompt['id'], "failed")
+            worker_metrics.job_finished(prompt, "failed")
+
+
+comfy_pool = ComfyPool(
+    COMFY_CLIENT_ID, on_comfy_finished, on_comfy_failed, on_comfy_started,
+    COMFY_QUEUE_DEPTH, COMFY_URL, OUTPUT_DIR, COMFY_DEFAULT_OUTPUT_DIR
+)
 
 
-def update_image_filename(id, file_path, is_s3_url=True):
-    """Update record via API with S3 URL"""
-    try:
-        response = requests.post(f"{API_BASE_URL}/prompts/update-filename", json={
-            'id': id,
-            'filename': file_path
-        })
-        if response.status_code == 200:
-            print(f"Updated prompts table for id {id} with path {file_path}")
-        else:
-            print(f"Error updating prompt: {response.json()}")
-    except Exception as err:
-        print(f"Error updating prompt via API: {err}")
-
-
-def queue_prompt(prompt, prompt_id):
-    p = {"prompt": prompt, "prompt_id": prompt_id}
-    data = json.dumps(p).encode('utf-8')
-    req = request.Request("http://127.0.0.1:8188/prompt", data=data)
-    request.urlopen(req)
-
-def get_history(prompt_id):
-    with request.urlopen("http://127.0.0.1:8188/history/{}".format(prompt_id)) as response:
-        return json.loads(response.read())
-
-
-def get_workflow_file(generation_type, model):
-    """Get the appropriate workflow file based on type"""
-    workflow_file = ""
-    if generation_type == "prompt":
-        if model == "schnell":
-            workflow_file = "flux_schnell_for_image_gen.json"
-        elif model == "dev":
-            workflow_file = "flux_dev_for_image_gen.json"
-    elif generation_type == "outpaint":
-        workflow_file = "flux_outpaint_for_image_gen.json"
-    elif generation_type == "mix-one":
-        workflow_file = "flux_one_image_mix_for_image_gen.json"
-    elif generation_type == "mix":
-        workflow_file = "flux_two_image_mix_for_image_gen.json"
-    elif generation_type == "kontext-basic":
-        workflow_file = "flux_kontext_basic.json"
-    elif generation_type == "kontext-lora":
-        workflow_file = "flix_kontext_lora.json"
-    else:
-        raise ValueError(f"Unknown generation type: {generation_type}")
+def check_running_prompt(prompt):
+    """Handle a prompt that is already rendering (status 1) or waiting to be re-checked (status 3)."""
+    prompt_id = prompt['id']
+    prompt_id_str = str(prompt_id)
 
-    file_path = os.path.join(current_dir, workflow_file)
-    with open(file_path, 'r') as file:
-        return json.load(file)
+    with active_jobs_lock:
+        if prompt_id in uploading_prompts:
+            # Rendered, the filename callback follows once the upload is done
+            return
 
+    job_state.record_seen(prompt_id, f"status {prompt['render_status']}")
+    if job_state.is_expired(prompt_id):
+        log.warning("Prompt %s passed its %.0fs deadline, marking as failed", prompt_id, job_state.deadline_seconds)
+        claim_active_job(prompt_id)
+        render_timings.pop(prompt_id_str, None)
+        update_render_status(prompt_id, 4)
+        job_state.mark_finished(prompt_id, "expired")
+        worker_metrics.job_finished(prompt, "expired")
+        return
+
+    with active_jobs_lock:
+        active_prompt = active_jobs.get(prompt_id_str)
+    waiting_for_event = active_prompt is not None
+    instance = instance_for(prompt)
+    if waiting_for_event and instance.listener.will_report(active_prompt.get('comfy_job', prompt_id)):
+        # The websocket listener will finalize this one as soon as ComfyUI reports it
+        return
+
+    outputs = None
+    if prompt['generation_type'] in KONTEXT_OUTPUT_NODES:
+        prompt_history = instance.history(prompt_id)
+        # The full history holds the whole workflow, only worth it when debugging
+        log.debug("Prompt history: %.500s", prompt_history)
+        outputs = prompt_history.get(prompt_id_str, {}).get('outputs', {})
+    else:
+        collect_batch_output(prompt, instance)
 
-def update_render_status(id, status):
-    """Update render status via API"""
-    try:
-        response = requests.post(f"{API_BASE_URL}/prompts/update-status", json={
-            'id': id,
-            'status': status
-        })
-        if response.status_code == 200:
-            print(f"Updated render status for prompt {id} to {status}")
+    output_file = get_output_file(prompt, outputs, instance)
+    if output_file and os.path.exists(output_file):
+        log.info("Found existing image for prompt %s", prompt_id)
+        if waiting_for_event and claim_active_job(prompt_id) is None:
+            # The listener got there first
+            return
+        observe_render(prompt, "ok")
+        finalize_prompt(prompt, output_file)
+
+
+def submit_prompts(prompts):
+    """
+    Build the workflow for a new prompt and queue it on ComfyUI. Several variations of a prompt
+    (see variations.py) are queued as one batch, under the id of the first one.
+    Returns True if a job was queued, False if every image already existed.
+    """
+    waiting = []
+    for prompt in prompts:
+        output_file = get_output_file(prompt)
+        if output_file and os.path.exists(output_file):
+            with worker_logging.job(prompt):
+                log.info("Image exists for prompt %s, uploading to S3", prompt['id'])
+                finalize_prompt(prompt, output_file)
         else:
-            print(f"Error updating render status: {response.json()}")
-    except Exception as err:
-        print(f"Error updating render status via API: {err}")
+            waiting.append(prompt)
+    if not waiting:
+        return False
+
+    prompt = waiting[0]
+    prompt_id = prompt['id']
+    generation_type = prompt['generation_type']
+    model = prompt['model']
+    # Input images are pinned from here on, until the job leaves active_jobs
+    try:
+        with worker_metrics.timed("input_download", prompt):
+            values = prepare_job_values(prompt)
+        values['batch_size'] = len(waiting)
+        if len(waiting) > 1:
+            values['output_filename'] = batch_filename_template(prompt)
+
+        cache_key = None
+        # Variations differ only in their seed, which the cache key leaves out
+        if result_cache.enabled and prompt['upload_to_s3'] and len(waiting) == 1:
+            input_files = [values[k] for k in ('input_image_1_path', 'input_image_2_path') if k in values]
+            workflow_file = workflow_templates.get_plan(generation_type, model)['file']
+            cache_key = result_cache_key(workflow_file, prompt, input_files)
+            cached_url = result_cache.lookup(cache_key)
+            if cached_url:
+                log.info("Result cache hit for prompt %s, reusing %s", prompt_id, cached_url)
+                update_image_filename(prompt_id, cached_url)
+                job_state.mark_finished(prompt_id, "cached")
+                worker_metrics.job_finished(prompt, "cached")
+                input_cache.release(prompt_id)
+                return False
+            waiting[0] = dict(prompt, cache_key=cache_key)
+
+        with worker_metrics.timed("workflow_build", prompt):
+            workflow = workflow_templates.build_workflow(generation_type, model, values)
+    except Exception:
+        input_cache.release(prompt_id)
+        raise
+
+    instance = comfy_pool.pick(group_key(prompt))
+    if instance is None:
+        log.warning("No ComfyUI instance has room for prompt %s, leaving it for a later pass", prompt_id)
+        input_cache.release(prompt_id)
+        return False
+    prompts = [dict(p, comfy_instance=instance.name, comfy_job=prompt_id) for p in waiting]
+
+    if len(prompts) > 1:
+        log.info(
+            "Rendering %d variations of prompt %s in one batch on %s: prompts %s",
+            len(prompts), prompt_id, instance.name, [p['id'] for p in prompts]
+        )
+    else:
+        log.info("Rendering image for prompt %s on %s", prompt_id, instance.name)
+    # Register and mark as rendering before queueing, so an instant (fully cached) result
+    # isn't missed and its filename callback can't be overtaken by the status 1 update
+    with active_jobs_lock:
+        for p in prompts:
+            active_jobs[str(p['id'])] = p
+        if len(prompts) > 1:
+            batches[str(prompt_id)] = prompts
+    instance.listener.watch(prompt_id)
+    for index, p in enumerate(prompts, start=1):
+        batch_output = None
+        if len(prompts) > 1:
+            batch_output = str(Path(instance.output_dir) / values['output_filename'].replace('{index}', str(index)))
+        prompt_leases.track(p['id'])
+        job_state.record_submit(p['id'], "queued", instance.name, batch_output)
+        update_render_status(p['id'], 1)
+    render_timings[str(prompt_id)] = {'queued': time.monotonic(), 'started': None}
+    try:
+        instance.queue_prompt(workflow, prompt_id, COMFY_CLIENT_ID)
+    except Exception:
+        claim_batch(prompt_id)
+        comfy_pool.unpick(instance)
+        render_timings.pop(str(prompt_id), None)
+        raise
+    for p in prompts:
+        scheduler.submitted(p)
+        fair_queue.dispatched(p)
+    log.debug("Queued prompt for: %.200s", prompt['generated_prompt'])
+    return True
 
-prompt_status_counter = {}
 
 def generate_images_from_api():
-    global prompt_status_counter
+    global claimed_waiting
 
     try:
-        print("Starting image generation from API (Local Jobs)...")
-        response = requests.get(f"{API_BASE_URL}/prompts/pending")
-        if response.status_code != 200:
-            print(f"Error fetching prompts: {response.status_code} {response.json()}")
+        log.debug("Starting image generation from API (Local Jobs)")
+        # Make sure queued callbacks are applied before we look at the queue again
+        callback_buffer.flush()
+        # Only top the ComfyUI queues up to the target depth, the rest waits for the next pass
+        free_slots = comfy_pool.refresh()
+        if upload_executor.full:
+            # S3 is falling behind, uploading prompts keep their slots until the backlog drains
+            with active_jobs_lock:
+                free_slots = max(0, free_slots - len(uploading_prompts))
+        log.info("ComfyUI instances: %s, %d free slots", comfy_pool.stats(), free_slots)
+        for name, instance_stats in comfy_pool.stats().items():
+            worker_metrics.set_in_flight(f"comfy_running_{name}", instance_stats['running'])
+            worker_metrics.set_queue_depth(f"comfy_pending_{name}", instance_stats['pending'])
+            worker_metrics.set_state({'healthy': int(instance_stats['healthy'])}, f"comfy_{name}_")
+
+        # Claim only as many new prompts as ComfyUI has room for, plus a few for the scheduler to choose from
+        try:
+            with worker_metrics.timed("fetch"):
+                prompts = prompt_leases.claim(free_slots + scheduler.lookahead - claimed_waiting)
+        except Exception as e:
+            log.error("Error fetching prompts: %s", e)
             return
-
-        prompts = response.json()['prompts']
-
-        for idx, prompt in enumerate(prompts):
-
+        claimed_waiting = 0
+
+        # Start fetching the input images of every new prompt we hold, so they download in
+        # parallel (and while ComfyUI renders) instead of one by one as each prompt is submitted
+        for prompt in prompts:
+            if prompt['render_status'] == 0 and prompt['generation_type'] in INPUT_IMAGE_FIELDS:
+                input_cache.prefetch(input_image_urls(prompt))
+
+        Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+        if result_cache.enabled:
+            log.info("Result cache: %s", result_cache.stats())
+            worker_metrics.set_state(result_cache.stats(), "result_cache_")
+        log.info("S3 uploads: %s", upload_executor.stats())
+        worker_metrics.set_state(upload_executor.stats(), "s3_upload_")
+        log.info("Input cache: %s", input_cache.stats())
+        worker_metrics.set_state(input_cache.stats(), "input_cache_")
+        job_state.compact()
+
+        prompts = scheduler.order(prompts)
+        log.info("Scheduler: %s", scheduler.stats())
+        worker_metrics.set_state(scheduler.stats(), "scheduler_")
+
+        with active_jobs_lock:
+            # Prompts on ComfyUI or still uploading, they count against their user's in-flight cap
+            busy = [p for p in prompts if p['render_status'] in (1, 3) or str(p['id']) in active_jobs]
+            # New prompts queued by us whose status 1 callback just hasn't landed yet
+            prompts = [p for p in prompts if not (p['render_status'] == 0 and str(p['id']) in active_jobs)]
+
+        # Users take turns on the free slots, each user's prompts staying in the scheduler's order.
+        # Within the fair queue's affinity slack the turns follow the scheduler's model groups.
+        new_prompts, capped = fair_queue.order(
+            [p for p in prompts if p['render_status'] == 0], busy, key=group_key, current_key=scheduler.current_key
+        )
+        prompts = [p for p in prompts if p['render_status'] != 0] + new_prompts
+        claimed_waiting += len(capped)
+        log.info("Fair queue: %s", fair_queue.stats())
+        worker_metrics.set_state(fair_queue.stats(), "fair_queue_")
+
+        # Variations of the same prompt are submitted together as one ComfyUI batch
+        for group in variations.group(prompts, variation_limit):
+
+            prompt = group[0]
             prompt_id = prompt['id']
-            prompt_id_str = str(prompt_id)
             render_status = prompt['render_status']
             generation_type = prompt['generation_type']
             model = prompt['model']
 
-            if generation_type in ["prompt", "mix", "mix-one", "kontext-basic", "kontext-lora"] and model in ["schnell", "dev"]:
+            if generation_type in LOCAL_GENERATION_TYPES and model in LOCAL_MODELS:
                 pass
             else:
-                print(f"Skipping prompt {prompt_id} - not local model")
+                log.debug("Skipping prompt %s - not local model", prompt_id)
                 continue
 
+            if render_status not in (1, 3) and free_slots <= 0:
+                # ComfyUI already has enough work queued, pick this one up on a later pass
+                claimed_waiting += len(group)
+                continue
 
-            print(f"Processing prompt {idx + 1} id: {prompt_id} - type: {prompt['generation_type']} - model: {prompt['model']} - status: {render_status} - user id: {prompt['user_id']}")
-
-            try:
-                if generation_type in ["kontext-basic", "kontext-lora"]:
-                    prompt_history = get_history(prompt_id)
-                    print(f"Prompt History: {prompt_history}")
-                    if prompt_history and generation_type == "kontext-basic":
-                        node_info = prompt_history.get(prompt_id_str, {})
-                        outputs = node_info.get('outputs', {})
-                        output_136 = outputs.get('136', {})
-                        images = output_136.get('images', []) # Default to an empty list for the images
-
-                        # Now, check if the 'images' list is not empty before accessing the first element
-                        if images:
-                            # We can now safely access the first element and its 'filename' key
-                            image_data = images[0]
-                            output_filename = image_data.get('filename')
-
-                            if output_filename:
-                                output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                                print(f"Successfully found output file: {output_file}")
-                            else:
-                                print("Image data found, but 'filename' key is missing.")
-                                output_filename = "kontext-not-ready.png"
-                                output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                        else:
-                            print("Could not find the required path or the 'images' list was empty.")
-                            output_filename = "kontext-not-ready.png"
-                            output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                    elif prompt_history and generation_type == "kontext-lora":
-                        node_info = prompt_history.get(prompt_id_str, {})
-                        outputs = node_info.get('outputs', {})
-                        output_180 = outputs.get('180', {})
-                        images = output_180.get('images', []) # Default to an empty list for the images
-
-                        # Now, check if the 'images' list is not empty before accessing the first element
-                        if images:
-                            # We can now safely access the first element and its 'filename' key
-                            image_data = images[0]
-                            output_filename = image_data.get('filename')
-
-                            if output_filename:
-                                output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                                print(f"Successfully found output file: {output_file}")
-                            else:
-                                print("Image data found, but 'filename' key is missing.")
-                                output_filename = "kontext-not-ready.png"
-                                output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                        else:
-                            print("Could not find the required path or the 'images' list was empty.")
-                            output_filename = "kontext-not-ready.png"
-                            output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                    else:
-                        print(f"No history found for prompt {prompt_id}, skipping...")
-                        output_filename = "kontext-not-ready.png"
-                        output_file = str(Path(COMFY_DEFAULT_OUTPUT_DIR) / output_filename)
-                else:
-                    output_filename = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
-                    output_file = str(Path(OUTPUT_DIR) / output_filename)
-
-                s3_file_path = f"images/{output_filename}"
-
-                Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-
-                if render_status in (1, 3):
-
-                    skip_continue = False
-                    prompt_status_counter[prompt_id] = prompt_status_counter.get(prompt_id, 0) + 1
-                    if prompt_status_counter[prompt_id] > 60:
-                        # skip_continue = True
-                        print(f"Skipping prompt {prompt_id} - seen with status 1 more than 60 times, try render again")
-                        update_render_status(prompt_id, 4)
-                        del prompt_status_counter[prompt_id]
-
-                    if os.path.exists(output_file):
-                        print(f"Found existing image for prompt {prompt_id}")
-                        if prompt['upload_to_s3']:
-                            s3_url = upload_to_s3(output_file, s3_file_path)
-                            if s3_url:
-                                update_image_filename(prompt_id, s3_url)
-                        else:
-                            update_image_filename(prompt_id, output_file, False)
-
-                    if not skip_continue:
-                        continue
-
-
-                workflow = {}
-                if generation_type == "prompt":
-                    if model == "schnell":
-                        workflow = get_workflow_file(generation_type,model)
-                        workflow["6"]["inputs"]["text"] = prompt['generated_prompt']
-                        workflow["25"]["inputs"]["noise_seed"] = random.randint(1, 2**32)
-                        workflow["31"]["inputs"]["file_name_template"] = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
-                        workflow["5"]["inputs"]["width"] = prompt['width']
-                        workflow["5"]["inputs"]["height"] = prompt['height']
-
-                    elif model == "dev":
-                        workflow = get_workflow_file(generation_type,model)
-                        workflow["6"]["inputs"]["text"] = prompt['generated_prompt']
-                        workflow["25"]["inputs"]["noise_seed"] = random.randint(1, 2**32)
-                        workflow["41"]["inputs"]["file_name_template"] = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
-                        workflow["27"]["inputs"]["width"] = prompt['width']
-                        workflow["27"]["inputs"]["height"] = prompt['height']
-                        workflow["30"]["inputs"]["width"] = prompt['width']
-                        workflow["30"]["inputs"]["height"] = prompt['height']
-                elif generation_type == "mix":
-                    temp_dir = tempfile.mkdtemp()
-
-                    # Download images
-                    image1_path = os.path.join(temp_dir, "image1.png")
-                    image2_path = os.path.join(temp_dir, "image2.png")
-
-                    # Download image 1
-                    if not download_image(prompt['input_image_1'], image1_path):
-                        raise Exception(f"Failed to download image 1 from {prompt['input_image_1']}")
-
-                    # Download image 2
-                    if not download_image(prompt['input_image_2'], image2_path):
-                        raise Exception(f"Failed to download image 2 from {prompt['input_image_2']}")
-
-                    workflow = get_workflow_file(generation_type,model)
-
-                    # load source image from absolute path
-                    workflow["40"]["inputs"]["image"] = image1_path
-                    workflow["56"]["inputs"]["image"] = image2_path
-
-                    workflow["54"]["inputs"]["downsampling_factor"] = prompt.get('input_image_1_strength', 1)
-                    workflow["55"]["inputs"]["downsampling_factor"] = prompt.get('input_image_2_strength', 1)
-
-                    workflow["6"]["inputs"]["text"] = prompt['generated_prompt']
-                    workflow["25"]["inputs"]["noise_seed"] = random.randint(1, 2**32)
-                    workflow["57"]["inputs"]["file_name_template"] = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
-
-                    # postprocessing resize width and height (proportional)
-                    workflow["27"]["inputs"]["width"] = prompt['width']
-                    workflow["27"]["inputs"]["height"] = prompt['height']
-
-                    workflow["30"]["inputs"]["width"] = prompt['width']
-                    workflow["30"]["inputs"]["height"] = prompt['height']
-
-                    print("Debugging mix prompt:")
-                    print (f"Using images with strengths: {prompt.get('input_image_1', 1)} and {prompt.get('input_image_2', 1)} :: {prompt.get('input_image_1_strength', 1)} and {prompt.get('input_image_2_strength', 1)}")
-                    print (f"Prompt and width and height: {prompt['generated_prompt']} :: {prompt['width']} and {prompt['height']}")
-                elif generation_type == "mix-one":
-                    temp_dir = tempfile.mkdtemp()
-
-                    # Download images
-                    image1_path = os.path.join(temp_dir, "image1.png")
-
-                    # Download image 1
-                    if not download_image(prompt['input_image_1'], image1_path):
-                        raise Exception(f"Failed to download image 1 from {prompt['input_image_1']}")
-
-                    workflow = get_workflow_file(generation_type,model)
-
-                    # load source image from absolute path
-                    workflow["40"]["inputs"]["image"] = image1_path
-
-                    strength_int = prompt.get('input_image_1_strength', 1)
-                    if strength_int == 1:
-                        strength_str = "highest"
-                    elif strength_int == 2:
-                        strength_str = "high"
-                    elif strength_int == 3:
-                        strength_str = "medium"
-                    elif strength_int == 4:
-                        strength_str = "low"
-                    elif strength_int == 5:
-                        strength_str = "lowest"
-                    workflow["54"]["inputs"]["image_strength"] = strength_str
-
-                    workflow["6"]["inputs"]["text"] = prompt['generated_prompt']
-                    workflow["25"]["inputs"]["noise_seed"] = random.randint(1, 2**32)
-                    workflow["56"]["inputs"]["file_name_template"] = f"{generation_type}_{model}_{prompt_id}_{prompt['user_id']}.png"
-
-                    # postprocessing resize width and height (proportional)
-                    workflow["27"]["inputs"]["width"] = prompt['width']
-                    workflow["27"]["inputs"]["height"] = prompt['height']
-
-                    workflow["30"]["inputs"]["width"] = prompt['width']
-                    workflow["30"]["inputs"]["height"] = prompt['height']
-
-                    print("Debugging mix-one prompt:")
-                    print (f"Using image with strength: {prompt.get('input_image_1', 1)} :: {prompt.get('input_image_1_strength', 1)}")
-                    print (f"Prompt and width and height: {prompt['generated_prompt']} :: {prompt['width']} and {prompt['height']}")
-                elif generation_type == "kontext-basic":
-                    temp_dir = tempfile.mkdtemp()
-
-                    # Download images
-                    image1_path = os.path.join(temp_dir, "image1.png")
-
-                    # Download image 1
-                    if not download_image(prompt['input_image_1'], image1_path):
-                        raise Exception(f"Failed to download image 1 from {prompt['input_image_1']}")
-
-                    workflow = get_workflow_file(generation_type,model)
-
-                    # load source image from absolute path
-                    workflow["142"]["inputs"]["image"] = image1_path
-
-                    workflow["6"]["inputs"]["text"] = prompt['generated_prompt']
-                    workflow["31"]["inputs"]["seed"] = random.randint(1, 2**32)
-                elif generation_type == "kontext-lora":
-                    temp_dir = tempfile.mkdtemp()
-
-                    # Download images
-                    image1_path = os.path.join(temp_dir, "image1.png")
-
-                    # Download image 1
-                    if not download_image(prompt['input_image_1'], image1_path):
-                        raise Exception(f"Failed to download image 1 from {prompt['input_image_1']}")
-
-                    workflow = get_workflow_file(generation_type,model)
-
-                    workflow["133"]["inputs"]["image"] = image1_path
-
-                    workflow["186"]["inputs"]["lora_name"] = prompt['lora_name'] or ""
-                    strength_model = float(prompt['strength_model'] or 1.0)
-                    workflow["186"]["inputs"]["strength_model"] = strength_model
-                    guidance = float(prompt['guidance'] or 7.5)
-                    workflow["179"]["inputs"]["guidance"] = guidance
-                    workflow["181"]["inputs"]["text"] = prompt['generated_prompt'] or ""
-                    workflow["178"]["inputs"]["seed"] = random.randint(1, 2**32)
-
-                if os.path.exists(output_file):
-                    print(f"Image exists for prompt {prompt_id}, uploading to S3...")
-                    if prompt['upload_to_s3']:
-                        s3_url = upload_to_s3(output_file, s3_file_path)
-                        if s3_url:
-                            update_image_filename(prompt_id, s3_url)
-                    else:
-                        update_image_filename(prompt_id, output_file, False)
-                else:
-                    print(f"Rendering image for prompt {prompt_id}")
-                    queue_prompt(workflow, prompt_id)
-                    update_render_status(prompt_id, 1)
-                    print(f"Queued prompt for: {prompt['generated_prompt']}...")
-
-                    time.sleep(5)
-
-
-                    if os.path.exists(output_file):
-                        if prompt['upload_to_s3']:
-                            s3_url = upload_to_s3(output_file, s3_file_path)
-                            if s3_url:
-                                update_image_filename(prompt_id, s3_url)
-                        else:
-                            update_image_filename(prompt_id, output_file, False)
-                    else:
-                        print(f"Image generation not yet ready for prompt {prompt_id}")
-                        update_render_status(prompt_id, 3)
-
-            except Exception as e:
-                print(f"Error processing prompt {prompt_id}: {e}")
-                update_render_status(prompt_id, 4)
+            # Everything logged for this prompt (also on the listener and upload threads) carries its ids
+            with worker_logging.job(prompt):
+                log.info("Processing prompt %s with status %s", prompt_id, render_status)
+
+                try:
+                    if render_status in (1, 3):
+                        check_running_prompt(prompt)
+                    elif submit_prompts(group):
+                        free_slots -= 1
+
+                except Exception as e:
+                    log.exception("Error processing prompt %s: %s", prompt_id, e)
+                    for p in group:
+                        update_render_status(p['id'], 4)
+                        worker_metrics.job_finished(p, "failed")
+
+        worker_metrics.set_queue_depth("claimed_waiting", claimed_waiting)
+        with active_jobs_lock:
+            worker_metrics.set_in_flight("active_jobs", len(active_jobs))
+            worker_metrics.set_in_flight("uploading", len(uploading_prompts))
 
     except Exception as e:
-        print(f"Error in generate_images_from_api: {e}")
+        log.exception("Error in generate_images_from_api: %s", e)
 
 
 if __name__ == "__main__":
-    while True:
-        generate_images_from_api()
-        time.sleep(5)
+    workflow_templates.validate_plans()
+    comfy_pool.start()
+    worker_logging.set_worker_id(prompt_leases.worker_id)
+    log.info("Claiming prompts as worker %s", prompt_leases.worker_id)
+    prompt_leases.start_heartbeat()
+    worker_metrics.start("comfy", 9102)
+    try:
+        while True:
+            queue_slot_freed.clear()
+            generate_images_from_api()
+            # Poll again after 5 seconds, or as soon as ComfyUI finishes one of our prompts
+            queue_slot_freed.wait(5)
+    finally:
+        upload_executor.shutdown()
+        input_cache.shutdown()
+        callback_buffer.flush()
+        prompt_leases.release_all()
+        worker_logging.shutdown()
@@ -1,22 +1,18 @@
-import json
-from urllib import request
+import argparse
+import contextvars
+import sys
 import mysql.connector
 import time
 import random
 import os
-import requests
-import json
 import boto3
-from botocore.exceptions import NoCredentialsError
 from dotenv import load_dotenv
 from pathlib import Path
 from shutil import copyfile
 import tempfile
 import math
-
-# New import for cross-platform timeouts
-from pebble import ProcessPool
-from concurrent.futures import TimeoutError
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 #import vertexai
 #from vertexai.preview.vision_models import ImageGenerationModel
@@ -24,13 +20,26 @@ from concurrent.futures import TimeoutError
 #from google.api_core.exceptions import GoogleAPIError
 #import traceback
 
-import fal_client
+from callback_buffer import CallbackBuffer
+from fair_queue import FairQueue
+from job_state import JobStateStore
+from prompt_queue import PromptLeases
+import rate_limit
+import render_backends
+from result_cache import ResultCache, make_key as result_cache_key
+import s3_transfer
+import variations
+from worker_http import get_session
+import worker_logging
+import worker_metrics
 
 # --- Environment Variable Loading ---
 current_dir = Path(__file__).resolve().parent
 env_path = current_dir.parent / '.env'
 load_dotenv(env_path)
 
+log = worker_logging.get_logger("remote")
+
 # Existing environment variables
 API_BASE_URL = os.getenv('API_BASE_URL')
 OUTPUT_DIR = os.getenv('OUTPUT_DIR')
@@ -50,6 +59,9 @@ AWS_CLOUDFRONT_URL = os.getenv('AWS_CLOUDFRONT_URL')
 # Configurable timeout for Fal.ai calls
 FAL_TIMEOUT = int(os.getenv('FAL_TIMEOUT', 180)) # Timeout in seconds (e.g., 3 minutes)
 
+# Wall-clock time a prompt may stay in a rendering state before it is marked as failed
+JOB_DEADLINE_SECONDS = 600
+
 # --- S3 Client Initialization ---
 s3_client = boto3.client(
     's3',
@@ -58,227 +70,440 @@ s3_client = boto3.client(
     region_name=AWS_REGION
 )
 
-# --- Helper Functions ---
+# Status/filename callbacks are batched; created in __main__ so importing this module starts no flusher
+callback_buffer = None
+result_cache = None
+prompt_leases = None
+job_state = None
+upload_executor = None
 
-def get_aspect_ratio(width, height):
-    """Find the closest standard aspect ratio string."""
-    standard_ratios = {
-        "1:1": 1.0, "16:9": 16/9, "4:3": 4/3, "3:2": 3/2,
-        "2:3": 2/3, "3:4": 3/4, "9:16": 9/16, "21:9": 21/9
-    }
-    if height == 0:
-        return "1:1"
-    actual_ratio = width / height
-    closest_ratio = min(standard_ratios.items(), key=lambda x: abs(x[1] - actual_ratio))
-    return closest_ratio[0]
+# --- Helper Functions ---
 
 def download_image(url, output_path):
     """Download an image from a URL to a local path."""
     try:
-        response = requests.get(url, stream=True, timeout=60) # Add timeout to download
+        local_path = render_backends.file_url_path(url)
+        if local_path:
+            copyfile(local_path, output_path)
+            return output_path
+        response = get_session().get(url, stream=True, timeout=60) # Add timeout to download
         response.raise_for_status()
         with open(output_path, 'wb') as f:
             for chunk in response.iter_content(chunk_size=8192):
                 f.write(chunk)
-        print(f"Successfully downloaded image from {url} to {output_path}")
+        log.info("Downloaded image from %s to %s", url, output_path)
         return output_path
     except Exception as e:
-        print(f"Error downloading image from {url}: {e}")
+        log.error("Error downloading image from %s: %s", url, e)
+        return None
+
+def update_image_filename(id, file_path, is_s3_url=True):
+    """Queue the final image path or URL for a prompt; sent with the next batch callback."""
+    callback_buffer.set_filename(id, file_path)
+    log.info("Queued filename update for prompt %s with path %s", id, file_path)
+
+def update_render_status(id, status):
+    """Queue a render status change for a prompt; sent with the next batch callback."""
+    callback_buffer.set_status(id, status)
+    log.info("Queued render status %s for prompt %s", status, id)
+
+# --- Main Processing Logic ---
+
+# Remote models handled by this script, see render_backends.py for how each one is rendered
+REMOTE_MODELS = render_backends.models_for("fal", "minimax", "vertex")
+# Providers rendering at least one of them, the slots of the others can't take a prompt
+REMOTE_PROVIDERS = {render_backends.backend_for(model).provider for model in REMOTE_MODELS}
+
+# Maximum number of jobs in flight at once for each provider
+PROVIDER_CONCURRENCY = {
+    "fal": int(os.getenv('FAL_CONCURRENCY', 4)),
+    "minimax": int(os.getenv('MINIMAX_CONCURRENCY', 2)),
+    "vertex": int(os.getenv('VERTEX_CONCURRENCY', 1)),
+}
+
+# Request pacing and adaptive concurrency per provider, PROVIDER_CONCURRENCY is the upper bound
+rate_limiters = {
+    provider: rate_limit.ProviderLimiter(provider, limit)
+    for provider, limit in PROVIDER_CONCURRENCY.items()
+}
+
+provider_executors = {
+    provider: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"{provider}-worker")
+    for provider, limit in PROVIDER_CONCURRENCY.items()
+}
+
+# prompt id -> provider, for every prompt currently being worked on by an executor thread
+in_flight_prompts = {}
+in_flight_lock = threading.Lock()
+# prompt id -> time its job finished, so a pending list fetched before the callback landed is ignored
+finished_at = {}
+# Set whenever a job finishes so the main loop can hand out the freed slot straight away
+slot_freed = threading.Event()
+
+# Takes new prompts from the users in turn and caps each user's prompts in flight
+fair_queue = FairQueue()
+
+# Claimed status 0 prompts left waiting for a provider slot on the last pass
+claimed_waiting = 0
+
+
+def get_provider(model):
+    """Return the provider that renders the given model, or None if this worker does not handle it."""
+    if model not in REMOTE_MODELS:
         return None
+    return render_backends.backend_for(model).provider
+
+
+def provider_in_flight(provider):
+    with in_flight_lock:
+        return sum(1 for p in in_flight_prompts.values() if p == provider)
 
-def upload_to_s3(local_file, s3_file):
-    """Upload a file to S3 and return the CloudFront URL."""
+
+def variation_limit(prompt):
+    return render_backends.backend_for(prompt['model']).max_variations
+
+
+def generate_image(prompt, queued_at):
+    """
+    Render a prompt on its backend, paced by the provider's rate limiter. Returns the image URLs
+    (one per prompt['variations']) or None.
+    """
+    backend = render_backends.backend_for(prompt['model'])
+    limiter = rate_limiters[backend.provider]
+    limiter.acquire()
+    started = time.monotonic()
+    # Time from dispatch until the provider call could start (executor and rate limiter)
+    worker_metrics.observe("queue_wait", started - queued_at, prompt)
+    outcome = rate_limit.ERROR
     try:
-        s3_client.upload_file(local_file, AWS_BUCKET, s3_file)
-        s3_url = f"{AWS_CLOUDFRONT_URL}/{s3_file}"
-        return s3_url
-    except NoCredentialsError:
-        print("AWS credentials not available")
+        result = backend.generate(prompt, FAL_TIMEOUT)
+        outcome = rate_limit.OK
+        log.info("%s rendered prompt %s in %.1fs (~$%.4f)", backend.name, prompt['id'], result['latency'], result['cost'])
+        return result['urls']
+    except TimeoutError as e:
+        log.error("Timeout calling %s after %s seconds", backend.model_name(prompt['model']), FAL_TIMEOUT)
+        outcome = rate_limit.outcome_for(e)
         return None
     except Exception as e:
-        print(f"Error uploading to S3: {e}")
+        log.error("%s failed to render prompt %s: %s", backend.name, prompt['id'], e)
+        outcome = rate_limit.outcome_for(e)
         return None
+    finally:
+        limiter.release(outcome)
+        worker_metrics.observe("generation", time.monotonic() - started, prompt, "ok" if outcome == rate_limit.OK else outcome)
 
-def update_image_filename(id, file_path, is_s3_url=True):
-    """Update record via API with the final image path or URL."""
+
+def process_prompts(prompts, queued_at):
+    """
+    Generate the images of one or more pending prompts with a single provider call, the variations
+    of a prompt (see variations.py) together, then download, upload and report each of them.
+    Runs on a provider executor thread.
+    """
+    prompt = prompts[0]
+    prompt_id = prompt['id']
+    model = prompt['model']
+
+    cache_key = None
+    image_urls = []
     try:
-        response = requests.post(f"{API_BASE_URL}/prompts/update-filename", json={
-            'id': id,
-            'filename': file_path
-        })
-        if response.status_code == 200:
-            print(f"Updated prompts table for id {id} with path {file_path}")
+        # Variations differ only in their seed, which the cache key leaves out
+        if result_cache.enabled and prompt['upload_to_s3'] and len(prompts) == 1:
+            cache_key = result_cache_key(render_backends.backend_for(model).model_name(model), prompt)
+            cached_url = result_cache.lookup(cache_key)
+            if cached_url:
+                log.info("Result cache hit for prompt %s, reusing %s", prompt_id, cached_url)
+                update_image_filename(prompt_id, cached_url)
+                finish_prompt(prompt, "cached")
+                return
+
+        # --- Image Generation Logic ---
+        if len(prompts) > 1:
+            log.info("Generating %d variations of prompt %s in one call: prompts %s", len(prompts), prompt_id, [p['id'] for p in prompts])
+        image_urls = generate_image(variations.as_batch(prompts), queued_at) or []
+        if image_urls and len(image_urls) < len(prompts):
+            log.warning("Got %d images for %d variations of prompt %s", len(image_urls), len(prompts), prompt_id)
+    except Exception as e:
+        log.exception("Error generating prompt %s: %s", prompt_id, e)
+
+    for prompt, image_url in zip(prompts, image_urls + [None] * len(prompts)):
+        with worker_logging.job(prompt):
+            deliver_image(prompt, image_url, cache_key)
+
+
+def deliver_image(prompt, image_url, cache_key):
+    """Download, upload and report the generated image of a prompt; a missing image_url fails the prompt."""
+    prompt_id = prompt['id']
+    generation_type = prompt['generation_type']
+    model = prompt['model']
+
+    # Set once the image is handed to the upload executor, which then finishes the prompt
+    uploading = False
+    outcome = "failed"
+    try:
+        output_filename = f"{generation_type}_{model.replace('/', '-')}_{prompt_id}_{prompt['user_id']}.png"
+        output_file = str(Path(OUTPUT_DIR) / output_filename)
+        s3_file_path = f"images/{output_filename}"
+
+        if not image_url:
+            log.error("Generation failed or returned no images for model %s", model)
+            update_render_status(prompt_id, 4)
+            return
+
+        # --- Download, Save, and Upload ---
+        on_uploaded = lambda s3_url: finish_upload(prompt, cache_key, s3_url)
+        if prompt['upload_to_s3'] and s3_transfer.STREAM_UPLOADS:
+            # No local copy is needed when the image only ends up on S3
+            start_upload(prompt_id)
+            upload_executor.submit_url(image_url, s3_file_path, on_uploaded, prompt)
+            uploading = True
         else:
-            print(f"Error updating prompt filename: {response.json()}")
-    except Exception as err:
-        print(f"Error updating prompt filename via API: {err}")
+            download_started = time.monotonic()
+            downloaded = download_image(image_url, output_file)
+            worker_metrics.observe("output_download", time.monotonic() - download_started, prompt, "ok" if downloaded else "error")
+            if downloaded:
+                if prompt['upload_to_s3']:
+                    start_upload(prompt_id)
+                    upload_executor.submit_file(output_file, s3_file_path, on_uploaded, prompt)
+                    uploading = True
+                else:
+                    update_image_filename(prompt_id, output_file, False)
+                    outcome = "done"
+            else:
+                log.error("Failed to download the generated image for prompt %s", prompt_id)
+                update_render_status(prompt_id, 4)
 
-def update_render_status(id, status):
-    """Update render status via API (e.g., pending, failed)."""
+    except Exception as e:
+        log.exception("Error processing prompt %s: %s", prompt_id, e)
+        update_render_status(prompt_id, 4)
+    finally:
+        if not uploading:
+            finish_prompt(prompt, outcome)
+
+
+def start_upload(prompt_id):
+    """Free the prompt's provider slot while its image uploads; it stays in flight until the upload is done."""
+    with in_flight_lock:
+        in_flight_prompts[prompt_id] = "upload"
+    slot_freed.set()
+
+
+def finish_upload(prompt, cache_key, s3_url):
+    """Called on an upload thread once the image of a prompt is on S3 (or the upload failed)."""
+    outcome = "failed"
     try:
-        response = requests.post(f"{API_BASE_URL}/prompts/update-status", json={
-            'id': id,
-            'status': status
-        })
-        if response.status_code == 200:
-            print(f"Updated render status for prompt {id} to {status}")
+        if s3_url:
+            update_image_filename(prompt['id'], s3_url)
+            if cache_key:
+                result_cache.store(cache_key, s3_url)
+            outcome = "done"
         else:
-            print(f"Error updating render status: {response.json()}")
-    except Exception as err:
-        print(f"Error updating render status via API: {err}")
-
-# This is the target function that will run in a separate process
-def fal_subscribe_task(model_name, arguments):
-    """Wrapper for the blocking fal_client call."""
-    return fal_client.subscribe(
-        model_name,
-        arguments=arguments,
-        with_logs=False,
-    )
+            log.error("S3 upload failed for prompt %s", prompt['id'])
+            update_render_status(prompt['id'], 4)
+    finally:
+        finish_prompt(prompt, outcome)
+
+
+def finish_prompt(prompt, outcome):
+    prompt_id = prompt['id']
+    with in_flight_lock:
+        in_flight_prompts.pop(prompt_id, None)
+        finished_at[prompt_id] = time.time()
+    prompt_leases.untrack(prompt_id)
+    job_state.mark_finished(prompt_id, outcome)
+    worker_metrics.job_finished(prompt, outcome)
+    slot_freed.set()
 
-def generate_with_fal(model_name, arguments):
+
+def dispatch_prompts(provider, prompts):
     """
-    Calls fal_client.subscribe in a separate process with a timeout.
-    This is cross-platform compatible (works on Windows, Linux, macOS).
+    Hand prompts rendered by one provider call to the provider executor and mark them as in flight.
+    Only the first takes a provider slot, the other variations ride along with it.
     """
-    print(f"Sending to Fal/{model_name} with a {FAL_TIMEOUT}s timeout...")
-    with ProcessPool() as pool:
-        # Schedule the task to run in the background process pool
-        future = pool.schedule(fal_subscribe_task, args=[model_name, arguments])
-        try:
-            # Wait for the result, with a timeout
-            result = future.result(timeout=FAL_TIMEOUT)
-            return result
-        except TimeoutError:
-            print(f"ERROR: Timeout calling {model_name} after {FAL_TIMEOUT} seconds.")
-            return None
-        except Exception as e:
-            print(f"ERROR: An unexpected error occurred in the fal_client process for {model_name}: {e}")
-            return None
+    with in_flight_lock:
+        for prompt in prompts:
+            in_flight_prompts[prompt['id']] = provider if prompt is prompts[0] else "variation"
+    for prompt in prompts:
+        prompt_leases.track(prompt['id'])
+        job_state.record_submit(prompt['id'], provider)
+        fair_queue.dispatched(prompt)
+    provider_executors[provider].submit(contextvars.copy_context().run, process_prompts, prompts, time.monotonic())
 
-# --- Main Processing Logic ---
 
-prompt_status_counter = {}
+def dispatch_upload(prompt, output_file, s3_file_path):
+    """Re-upload an image left behind by an earlier run, keeping the prompt in flight until it is done."""
+    with in_flight_lock:
+        in_flight_prompts[prompt['id']] = "upload"
+    prompt_leases.track(prompt['id'])
+    upload_executor.submit_file(output_file, s3_file_path, lambda s3_url: finish_upload(prompt, None, s3_url), prompt)
+
 
 def generate_images_from_api():
-    global prompt_status_counter
+    global claimed_waiting
 
     try:
-        print("Starting image generation from API (Remote Jobs)...")
-        response = requests.get(f"{API_BASE_URL}/prompts/pending")
-        if response.status_code != 200:
-            print(f"Error fetching prompts: {response.json()}")
+        log.debug("Starting image generation from API (Remote Jobs)")
+        # Make sure callbacks from finished jobs are applied before we look at the queue again
+        callback_buffer.flush()
+        fetch_started_at = time.time()
+        with in_flight_lock:
+            for prompt_id in [p for p, t in finished_at.items() if t < fetch_started_at - 60]:
+                del finished_at[prompt_id]
+
+        # Only claim as many new prompts as there are free provider slots
+        free_slots = sum(
+            max(0, limiter.concurrency - provider_in_flight(provider))
+            for provider, limiter in rate_limiters.items() if provider in REMOTE_PROVIDERS
+        )
+        if upload_executor.full:
+            # S3 is falling behind, uploading prompts keep their slots until the backlog drains
+            free_slots = max(0, free_slots - provider_in_flight("upload"))
+        try:
+            with worker_metrics.timed("fetch"):
+                prompts = prompt_leases.claim(free_slots - claimed_waiting)
+        except Exception as e:
+            log.error("Error fetching prompts: %s", e)
             return
-
-        prompts = response.json()['prompts']
-
-        for idx, prompt in enumerate(prompts):
+        claimed_waiting = 0
+        Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+        if result_cache.enabled:
+            log.info("Result cache: %s", result_cache.stats())
+            worker_metrics.set_state(result_cache.stats(), "result_cache_")
+        log.info("S3 uploads: %s", upload_executor.stats())
+        worker_metrics.set_state(upload_executor.stats(), "s3_upload_")
+        for provider, limiter in rate_limiters.items():
+            log.info("Rate limit %s: %s", provider, limiter.stats())
+            worker_metrics.set_state(limiter.stats(), f"rate_limit_{provider}_")
+        job_state.compact()
+
+        # Prompts for this worker that no executor thread is working on yet
+        candidates = []
+        # Prompts an executor thread is working on, they count against their user's in-flight cap
+        busy = []
+        for prompt in prompts:
             prompt_id = prompt['id']
-            render_status = prompt['render_status']
-            generation_type = prompt['generation_type']
-            model = prompt['model']
-
-            # Define remote models handled by this script
-            remote_fal_models = {
-                "imagen3": "fal-ai/imagen4/preview/ultra",
-            }
-            remote_other_models = ["minimax", "minimax-expand"]
-
-            if generation_type != "prompt" or (model not in remote_fal_models and model not in remote_other_models):
+            if prompt['generation_type'] != "prompt" or get_provider(prompt['model']) is None:
                 # This print can be noisy, optionally comment it out
                 # print(f"Skipping prompt {prompt_id} - not a remote model for this worker.")
                 continue
 
-            print(f"Processing prompt {idx + 1} id: {prompt_id} - type: {generation_type} - model: {model} - status: {render_status} - user id: {prompt['user_id']}")
-
-            try:
-                output_filename = f"{generation_type}_{model.replace('/', '-')}_{prompt_id}_{prompt['user_id']}.png"
-                output_file = str(Path(OUTPUT_DIR) / output_filename)
-                s3_file_path = f"images/{output_filename}"
-                Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
-
-                if render_status in (1, 3):
-                    prompt_status_counter[prompt_id] = prompt_status_counter.get(prompt_id, 0) + 1
-                    if prompt_status_counter[prompt_id] > 20:
-                        print(f"Prompt {prompt_id} has been stuck for too long. Marking as failed.")
-                        update_render_status(prompt_id, 4)
-                        del prompt_status_counter[prompt_id]
-                        continue
-
-                    if os.path.exists(output_file):
-                        print(f"Found existing image for prompt {prompt_id}, attempting re-upload.")
-                        if prompt['upload_to_s3']:
-                            s3_url = upload_to_s3(output_file, s3_file_path)
-                            if s3_url:
-                                update_image_filename(prompt_id, s3_url)
-                        else:
-                            update_image_filename(prompt_id, output_file, False)
+            with in_flight_lock:
+                if prompt_id in in_flight_prompts:
+                    # Still being generated by an executor thread from an earlier pass
+                    busy.append(prompt)
                     continue
+                if finished_at.get(prompt_id, 0) >= fetch_started_at:
+                    # Finished while this list was being fetched, its callback is still on the way
+                    continue
+            candidates.append(prompt)
+
+        # Users take turns on the free slots
+        new_prompts, capped = fair_queue.order([p for p in candidates if p['render_status'] == 0], busy)
+        candidates = [p for p in candidates if p['render_status'] != 0] + new_prompts
+        claimed_waiting += len(capped)
+        log.info("Fair queue: %s", fair_queue.stats())
+        worker_metrics.set_state(fair_queue.stats(), "fair_queue_")
+
+        # Variations of the same prompt are generated together, with one provider call
+        for group in variations.group(candidates, variation_limit):
+            prompt = group[0]
+            prompt_id = prompt['id']
+            render_status = prompt['render_status']
+            generation_type = prompt['generation_type']
+            model = prompt['model']
+            provider = get_provider(model)
+
+            # Everything logged for this prompt (also on the executor and upload threads) carries its ids
+            with worker_logging.job(prompt):
+                try:
+                    if render_status in (1, 3):
+                        output_filename = f"{generation_type}_{model.replace('/', '-')}_{prompt_id}_{prompt['user_id']}.png"
+                        output_file = str(Path(OUTPUT_DIR) / output_filename)
+                        s3_file_path = f"images/{output_filename}"
+
+                        job_state.record_seen(prompt_id, f"status {render_status}")
+                        if job_state.is_expired(prompt_id):
+                            log.warning("Prompt %s has been stuck for too long, marking as failed", prompt_id)
+                            update_render_status(prompt_id, 4)
+                            job_state.mark_finished(prompt_id, "expired")
+                            worker_metrics.job_finished(prompt, "expired")
+                            continue
+
+                        if os.path.exists(output_file):
+                            log.info("Found existing image for prompt %s, attempting re-upload", prompt_id)
+                            if prompt['upload_to_s3']:
+                                dispatch_upload(prompt, output_file, s3_file_path)
+                            else:
+                                update_image_filename(prompt_id, output_file, False)
+                        continue
 
-                # --- Image Generation Logic ---
-                first_image_url = None
-
-                if model in remote_fal_models:
-                    fal_model_name = remote_fal_models[model]
-                    arguments = {"prompt": prompt['generated_prompt']}
-                    if model == "fal-ai/qwen-image":
-                        arguments["image_size"] = {"width": prompt['width'], "height": prompt['height']}
+                    if free_slots <= 0 or provider_in_flight(provider) >= rate_limiters[provider].concurrency:
+                        # No free slot for this provider, leave the prompt for a later pass
+                        claimed_waiting += len(group)
+                        continue
 
-                    fal_result = generate_with_fal(fal_model_name, arguments)
+                    log.info("Dispatching prompt %s to %s", prompt_id, provider)
+                    dispatch_prompts(provider, group)
+                    free_slots -= 1
 
-                    if fal_result and "images" in fal_result and len(fal_result["images"]) > 0:
-                        first_image_url = fal_result["images"][0]["url"]
-                    else:
-                        print(f"Fal.ai call failed or returned no images for model {model}.")
-                        update_render_status(prompt_id, 4)
-                        continue
+                except Exception as e:
+                    log.exception("Error processing prompt %s: %s", prompt_id, e)
+                    for p in group:
+                        update_render_status(p['id'], 4)
 
-                elif model in ["minimax", "minimax-expand"]:
-                    print(f"Sending to Minimax: {prompt['generated_prompt']}...")
-                    payload = json.dumps({
-                        "model": "image-01",
-                        "prompt": prompt['generated_prompt'],
-                        "aspect_ratio": get_aspect_ratio(prompt['width'], prompt['height']),
-                        "response_format": "url",
-                        "n": 1,
-                        "prompt_optimizer": (model == "minimax-expand")
-                    })
-                    headers = {
-                        'Authorization': f'Bearer {os.getenv("MINIMAX_KEY")}',
-                        'Content-Type': 'application/json'
-                    }
-                    response = requests.post(os.getenv("MINIMAX_KEY_URL"), headers=headers, data=payload, timeout=120)
-                    response.raise_for_status()
-                    response_json = response.json()
-                    first_image_url = response_json["data"]["image_urls"][0]
-
-                # --- Download, Save, and Upload ---
-                if first_image_url:
-                    if download_image(first_image_url, output_file):
-                        if prompt['upload_to_s3']:
-                            s3_url = upload_to_s3(output_file, s3_file_path)
-                            if s3_url:
-                                update_image_filename(prompt_id, s3_url)
-                            else:
-                                print(f"S3 upload failed for prompt {prompt_id}.")
-                                update_render_status(prompt_id, 4)
-                        else:
-                            update_image_filename(prompt_id, output_file, False)
-                    else:
-                        print(f"Failed to download the generated image for prompt {prompt_id}.")
-                        update_render_status(prompt_id, 4)
-
-                time.sleep(6) # Keep a small delay between jobs
-
-            except Exception as e:
-                print(f"CRITICAL ERROR processing prompt {prompt_id}: {e}")
-                update_render_status(prompt_id, 4)
+        worker_metrics.set_queue_depth("claimed_waiting", claimed_waiting)
+        for provider in PROVIDER_CONCURRENCY:
+            worker_metrics.set_in_flight(provider, provider_in_flight(provider))
 
     except Exception as e:
-        print(f"CRITICAL ERROR in main loop generate_images_from_api: {e}")
+        log.exception("Error in main loop generate_images_from_api: %s", e)
 
 
 if __name__ == "__main__":
-    while True:
-        generate_images_from_api()
-        time.sleep(5)
+    parser = argparse.ArgumentParser(description="Render remote (fal, Minimax) image jobs.")
+    parser.add_argument(
+        '--async-pipeline',
+        action='store_true',
+        help='Run the asyncio pipeline (see async_pipeline.py) instead of the provider thread pools.'
+    )
+    args = parser.parse_args()
+
+    worker_logging.setup("remote")
+
+    # Created once here rather than at import time, so importing this module has no side effects
+    callback_buffer = CallbackBuffer(API_BASE_URL)
+    result_cache = ResultCache()
+    job_state = JobStateStore("remote", JOB_DEADLINE_SECONDS)
+    prompt_leases = PromptLeases(API_BASE_URL, ["prompt"], REMOTE_MODELS)
+    worker_logging.set_worker_id(prompt_leases.worker_id)
+    log.info("Claiming prompts as worker %s", prompt_leases.worker_id)
+    prompt_leases.start_heartbeat()
+    worker_metrics.start("remote", 9101)
+    Path(OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+
+    if args.async_pipeline:
+        import asyncio
+        from async_pipeline import AsyncRemotePipeline
+
+        pipeline = AsyncRemotePipeline(sys.modules[__name__], REMOTE_MODELS)
+        try:
+            asyncio.run(pipeline.run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            callback_buffer.flush()
+            prompt_leases.release_all()
+            worker_logging.shutdown()
+        sys.exit(0)
+
+    upload_executor = s3_transfer.UploadExecutor(s3_client, AWS_BUCKET, AWS_CLOUDFRONT_URL)
+    try:
+        while True:
+            slot_freed.clear()
+            generate_images_from_api()
+            # Poll again after 5 seconds, or as soon as a running job frees up its slot
+            slot_freed.wait(5)
+    finally:
+        upload_executor.shutdown()
+        callback_buffer.flush()
+        prompt_leases.release_all()
+        worker_logging.shutdown()
@@ -0,0 +1,391 @@
+import asyncio
+import json
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from pathlib import Path
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import worker_logging
+from worker_http import get_session
+
+# Image generation backends behind one interface, plus mock backends for offline load tests.
+#
+# A backend turns a prompt row into images:
+#
+#   handle = backend.submit(prompt)       start a generation
+#   result = backend.poll(handle)         None while it is still running, raises if it failed
+#   result = backend.generate(prompt, timeout)        submit and wait
+#   result = await backend.generate_async(prompt, timeout, http)
+#
+# A result is a dict with 'urls' (http(s) or file:// image URLs), 'backend', 'model',
+# 'latency' in seconds and the estimated 'cost' in USD. Backends are registered per site
+# model name; backend_for(model) returns the one that renders it. VertexBackend is not
+# registered for any model, as no site model renders on Vertex at the moment.
+#
+# generate() polls a running job every RENDER_POLL_INTERVAL seconds, backing off by half
+# each time up to RENDER_POLL_MAX_INTERVAL, so long fal jobs don't poll once a second.
+#
+#   RENDER_POLL_INTERVAL      first wait between two polls (default 1)
+#   RENDER_POLL_MAX_INTERVAL  longest wait between two polls (default 5)
+#
+# prompt['variations'] (default 1) asks for that many images of the prompt in one call, up
+# to the backend's max_variations; the result then has one URL per image.
+#
+# RENDER_BACKEND_OVERRIDE=mock swaps every backend for a MockBackend with the same provider
+# name, so the whole worker (leases, rate limits, uploads, callbacks) can be load tested
+# without calling a real provider:
+#
+#   MOCK_LATENCY_SECONDS  mean generation time (default 2)
+#   MOCK_LATENCY_JITTER   +/- random part of it (default 0.5)
+#   MOCK_FAILURE_RATE     share of generations that fail, 0..1 (default 0)
+#   MOCK_IMAGE_SIZE       WIDTHxHEIGHT of the images written, default the prompt's size
+#   MOCK_SEED             makes latencies and failures repeatable (default 0)
+
+log = worker_logging.get_logger("render_backends")
+
+
+class BackendError(Exception):
+    pass
+
+
+class Backend:
+    name = None
+    # Rate limiter / executor this backend's calls count against
+    provider = None
+    cost_per_image = 0.0
+    # Images one call can return
+    max_variations = 1
+
+    def __init__(self, models):
+        # site model name -> provider model name
+        self.models = dict(models)
+
+    def model_name(self, model):
+        return self.models.get(model, model)
+
+    def submit(self, prompt):
+        raise NotImplementedError
+
+    def poll(self, handle):
+        raise NotImplementedError
+
+    def cancel(self, handle):
+        pass
+
+    def result(self, prompt, urls, started):
+        return {
+            'urls': urls,
+            'backend': self.name,
+            'model': self.model_name(prompt['model']),
+            'latency': time.monotonic() - started,
+            'cost': self.cost_per_image * len(urls),
+        }
+
+    def generate(self, prompt, timeout):
+        started = time.monotonic()
+        handle = self.submit(prompt)
+        deadline = started + timeout
+        interval = float(os.getenv('RENDER_POLL_INTERVAL') or 1)
+        max_interval = float(os.getenv('RENDER_POLL_MAX_INTERVAL') or 5)
+        while True:
+            urls = self.poll(handle)
+            if urls is not None:
+                return self.result(prompt, urls, started)
+            now = time.monotonic()
+            if now > deadline:
+                self.cancel(handle)
+                raise TimeoutError(f"{self.name} did not finish within {timeout}s")
+            time.sleep(max(0.0, min(interval, deadline - now)))
+            interval = min(interval * 1.5, max_interval)
+
+    async def generate_async(self, prompt, timeout, http=None):
+        """Run generate() on a thread; backends with an async API override this. http is a shared httpx.AsyncClient."""
+        return await asyncio.wait_for(asyncio.to_thread(self.generate, prompt, timeout), timeout)
+
+
+class FalBackend(Backend):
+    name = "fal"
+    provider = "fal"
+    cost_per_image = 0.06
+    max_variations = 4
+
+    def arguments(self, prompt):
+        arguments = {"prompt": prompt['generated_prompt']}
+        if self.model_name(prompt['model']) == "fal-ai/qwen-image":
+            arguments["image_size"] = {"width": prompt['width'], "height": prompt['height']}
+        if prompt.get('variations', 1) > 1:
+            arguments["num_images"] = prompt['variations']
+        return arguments
+
+    def submit(self, prompt):
+        import fal_client
+        log.info("Sending to Fal/%s", self.model_name(prompt['model']))
+        return fal_client.submit(self.model_name(prompt['model']), arguments=self.arguments(prompt))
+
+    def poll(self, handle):
+        import fal_client
+        if not isinstance(handle.status(), fal_client.Completed):
+            return None
+        return self.image_urls(handle.get())
+
+    def cancel(self, handle):
+        try:
+            handle.cancel()
+        except Exception as e:
+            log.warning("Could not cancel fal request: %s", e)
+
+    @staticmethod
+    def image_urls(result):
+        urls = [image["url"] for image in (result or {}).get("images") or []]
+        if not urls:
+            raise BackendError("fal returned no images")
+        return urls
+
+    async def generate_async(self, prompt, timeout, http=None):
+        import fal_client
+        started = time.monotonic()
+        log.info("Sending to Fal/%s with a %ss timeout", self.model_name(prompt['model']), timeout)
+        result = await asyncio.wait_for(
+            fal_client.subscribe_async(self.model_name(prompt['model']), arguments=self.arguments(prompt), with_logs=False),
+            timeout
+        )
+        return self.result(prompt, self.image_urls(result), started)
+
+
+class MinimaxBackend(Backend):
+    """Minimax answers synchronously, so submit() does the whole call and poll() hands back its result."""
+    name = "minimax"
+    provider = "minimax"
+    cost_per_image = 0.0035
+    max_variations = 9
+
+    def payload(self, prompt):
+        return {
+            "model": "image-01",
+            "prompt": prompt['generated_prompt'],
+            "aspect_ratio": get_aspect_ratio(prompt['width'], prompt['height']),
+            "response_format": "url",
+            "n": prompt.get('variations', 1),
+            "prompt_optimizer": (prompt['model'] == "minimax-expand")
+        }
+
+    def headers(self):
+        return {
+            'Authorization': f'Bearer {os.getenv("MINIMAX_KEY")}',
+            'Content-Type': 'application/json'
+        }
+
+    def submit(self, prompt):
+        log.info("Sending to Minimax")
+        log.debug("Minimax prompt: %.200s", prompt['generated_prompt'])
+        response = get_session().post(os.getenv("MINIMAX_KEY_URL"), headers=self.headers(), data=json.dumps(self.payload(prompt)), timeout=120)
+        response.raise_for_status()
+        return response.json()["data"]["image_urls"]
+
+    def poll(self, handle):
+        return handle
+
+    async def generate_async(self, prompt, timeout, http=None):
+        if http is None:
+            return await super().generate_async(prompt, timeout)
+        started = time.monotonic()
+        log.info("Sending to Minimax")
+        log.debug("Minimax prompt: %.200s", prompt['generated_prompt'])
+        response = await http.post(os.getenv("MINIMAX_KEY_URL"), headers=self.headers(), content=json.dumps(self.payload(prompt)), timeout=timeout)
+        response.raise_for_status()
+        return self.result(prompt, response.json()["data"]["image_urls"], started)
+
+
+class VertexBackend(Backend):
+    """Imagen on Vertex AI (see vertex-test.py). The SDK returns image bytes, which are written to a temp file."""
+    name = "vertex"
+    provider = "vertex"
+    cost_per_image = 0.04
+    max_variations = 4
+
+    def __init__(self, models):
+        super().__init__(models)
+        self.generation_models = {}
+        self.lock = threading.Lock()
+
+    def generation_model(self, model_name):
+        import vertexai
+        from vertexai.preview.vision_models import ImageGenerationModel
+        from google.oauth2 import service_account
+
+        with self.lock:
+            if not self.generation_models:
+                credentials = service_account.Credentials.from_service_account_file(
+                    os.getenv('GOOGLE_AUTH_KEY_PATH', "google.json"),
+                    scopes=["https://www.googleapis.com/auth/cloud-platform"],
+                )
+                vertexai.init(project=os.getenv('GOOGLE_PROJECT_ID', ""), location="us-central1", credentials=credentials)
+            if model_name not in self.generation_models:
+                self.generation_models[model_name] = ImageGenerationModel.from_pretrained(model_name)
+            return self.generation_models[model_name]
+
+    def submit(self, prompt):
+        images = self.generation_model(self.model_name(prompt['model'])).generate_images(
+            prompt=prompt['generated_prompt'],
+            number_of_images=prompt.get('variations', 1),
+            language="en",
+            add_watermark=False,
+            aspect_ratio=get_aspect_ratio(prompt['width'], prompt['height']),
+            safety_filter_level="block_only_high",
+            person_generation="allow_adult",
+        )
+        if not images:
+            raise BackendError("Vertex returned no images")
+        urls = []
+        for image in images:
+            output_file = Path(tempfile.gettempdir()) / f"vertex_{prompt['id']}_{uuid.uuid4().hex}.png"
+            image.save(location=str(output_file), include_generation_parameters=False)
+            urls.append(output_file.as_uri())
+        return urls
+
+    def poll(self, handle):
+        return handle
+
+
+class MockBackend(Backend):
+    """Deterministic stand-in for a real backend: sleeps, maybe fails, then writes a solid PNG."""
+    name = "mock"
+
+    def __init__(self, provider, models=None, latency=None, jitter=None, failure_rate=None, image_size=None, seed=None, max_variations=1):
+        super().__init__(models or {})
+        self.provider = provider
+        self.max_variations = max_variations
+        self.latency = float(latency if latency is not None else os.getenv('MOCK_LATENCY_SECONDS', 2))
+        self.jitter = float(jitter if jitter is not None else os.getenv('MOCK_LATENCY_JITTER', 0.5))
+        self.failure_rate = float(failure_rate if failure_rate is not None else os.getenv('MOCK_FAILURE_RATE', 0))
+        self.image_size = image_size or os.getenv('MOCK_IMAGE_SIZE') or None
+        self.seed = int(seed if seed is not None else os.getenv('MOCK_SEED', 0))
+        self.output_dir = Path(tempfile.gettempdir()) / "render-mock-images"
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def plan(self, prompt):
+        """Latency and outcome for a prompt; the same prompt id always gets the same plan."""
+        rng = random.Random(f"{self.seed}-{self.provider}-{prompt['id']}")
+        latency = max(0.0, self.latency + rng.uniform(-self.jitter, self.jitter))
+        return latency, rng.random() < self.failure_rate, rng
+
+    def size(self, prompt):
+        if self.image_size:
+            width, height = self.image_size.lower().split('x')
+            return int(width), int(height)
+        return int(prompt.get('width') or 512), int(prompt.get('height') or 512)
+
+    def submit(self, prompt):
+        latency, fails, rng = self.plan(prompt)
+        return {'prompt': prompt, 'ready_at': time.monotonic() + latency, 'fails': fails, 'rng': rng}
+
+    def poll(self, handle):
+        if time.monotonic() < handle['ready_at']:
+            return None
+        return self.finish(handle)
+
+    def finish(self, handle):
+        prompt = handle['prompt']
+        if handle['fails']:
+            raise BackendError(f"mock {self.provider} failure for prompt {prompt['id']}")
+        width, height = self.size(prompt)
+        urls = []
+        for _ in range(prompt.get('variations', 1)):
+            color = tuple(handle['rng'].randrange(256) for _ in range(3))
+            output_file = self.output_dir / f"{self.provider}_{prompt['id']}_{uuid.uuid4().hex[:8]}.png"
+            output_file.write_bytes(solid_png(width, height, color))
+            urls.append(output_file.as_uri())
+        return urls
+
+    def generate(self, prompt, timeout):
+        started = time.monotonic()
+        handle = self.submit(prompt)
+        wait = handle['ready_at'] - started
+        if wait > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"mock {self.provider} did not finish within {timeout}s")
+        time.sleep(max(0.0, wait))
+        return self.result(prompt, self.finish(handle), started)
+
+    async def generate_async(self, prompt, timeout, http=None):
+        started = time.monotonic()
+        handle = self.submit(prompt)
+        wait = handle['ready_at'] - started
+        if wait > timeout:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(max(0.0, wait))
+        return self.result(prompt, await asyncio.to_thread(self.finish, handle), started)
+
+
+def file_url_path(url):
+    """Local path of a file:// URL (as returned by the mock and Vertex backends), else None."""
+    if not url.startswith('file://'):
+        return None
+    return url2pathname(urlparse(url).path)
+
+
+def solid_png(width, height, color):
+    """Encode a single-colour RGB PNG."""
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    row = b'\x00' + bytes(color) * width
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(row * height, 6))
+        + chunk(b'IEND', b'')
+    )
+
+
+def get_aspect_ratio(width, height):
+    """Find the closest standard aspect ratio string."""
+    standard_ratios = {
+        "1:1": 1.0, "16:9": 16/9, "4:3": 4/3, "3:2": 3/2,
+        "2:3": 2/3, "3:4": 3/4, "9:16": 9/16, "21:9": 21/9
+    }
+    if height == 0:
+        return "1:1"
+    actual_ratio = width / height
+    closest_ratio = min(standard_ratios.items(), key=lambda x: abs(x[1] - actual_ratio))
+    return closest_ratio[0]
+
+
+# --- Registry ---
+
+BACKENDS = {}
+_mocks = {}
+
+
+def register(backend):
+    for model in backend.models:
+        BACKENDS[model] = backend
+    return backend
+
+
+def models_for(*providers):
+    """Site model names rendered by backends of the given providers."""
+    return [model for model, backend in BACKENDS.items() if backend.provider in providers]
+
+
+def backend_for(model):
+    """The backend that renders a site model, or None. Honours RENDER_BACKEND_OVERRIDE=mock."""
+    backend = BACKENDS.get(model)
+    if backend is None or os.getenv('RENDER_BACKEND_OVERRIDE', '').lower() != 'mock':
+        return backend
+    if backend.provider not in _mocks:
+        _mocks[backend.provider] = MockBackend(backend.provider, backend.models, max_variations=backend.max_variations)
+    return _mocks[backend.provider]
+
+
+register(FalBackend({"imagen3": "fal-ai/imagen4/preview/ultra"}))
+register(MinimaxBackend({"minimax": "minimax", "minimax-expand": "minimax-expand"}))
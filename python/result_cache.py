@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Content-addressed cache of finished renders.
+#
+# A job's key is a hash of everything that determines the image: workflow/model, prompt
+# text, size, the bytes of any input images, LoRA name/strength and guidance. A hit maps
+# straight to the S3 URL of an earlier render, so the prompt can be completed with one
+# filename callback and no GPU time or paid API call.
+#
+# Prompts don't carry a seed (every render picks a random one), so the key leaves it out and
+# a cached prompt comes back as the same image. Users ask for renders of the same prompt to
+# get new images ("regenerate", variations), so the cache is off unless
+# RESULT_CACHE_ENABLED=true. Jobs rendering several variations at once are never cached.
+#
+#   RESULT_CACHE_DB            sqlite file (default python/result-cache.sqlite3)
+#   RESULT_CACHE_MAX_ENTRIES   entries kept, least recently used are evicted first (default 10000)
+#   RESULT_CACHE_MAX_AGE_DAYS  entries older than this are evicted (default 30)
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(workflow, prompt, input_files=()):
+    """Build the cache key for a job. input_files are local paths of already downloaded input images."""
+    parts = {
+        'workflow': workflow,
+        'generation_type': prompt.get('generation_type'),
+        'model': prompt.get('model'),
+        'prompt': prompt.get('generated_prompt') or "",
+        'width': prompt.get('width'),
+        'height': prompt.get('height'),
+        'inputs': [hash_file(path) for path in input_files],
+        'input_strengths': [prompt.get('input_image_1_strength'), prompt.get('input_image_2_strength')],
+        'lora_name': prompt.get('lora_name'),
+        'strength_model': prompt.get('strength_model'),
+        'guidance': prompt.get('guidance'),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, db_path=None, max_entries=None, max_age_days=None):
+        self.enabled = os.getenv('RESULT_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.db_path = db_path or os.getenv('RESULT_CACHE_DB', str(Path(__file__).resolve().parent / 'result-cache.sqlite3'))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 10000))
+        self.max_age = (max_age_days if max_age_days is not None else float(os.getenv('RESULT_CACHE_MAX_AGE_DAYS', 30))) * 86400
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.db = None
+        if self.enabled:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " cache_key TEXT PRIMARY KEY,"
+                " filename TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used_at REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    def lookup(self, key):
+        """Return the stored filename/URL for a key, or None."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT filename FROM results WHERE cache_key = ? AND created_at >= ?",
+                (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE results SET last_used_at = ? WHERE cache_key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def store(self, key, filename):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (cache_key, filename, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, filename, now, now)
+            )
+            self.stores += 1
+            self._evict(now)
+            self.db.commit()
+
+    def _evict(self, now):
+        evicted = self.db.execute("DELETE FROM results WHERE created_at < ?", (now - self.max_age,)).rowcount
+        evicted += self.db.execute(
+            "DELETE FROM results WHERE cache_key IN ("
+            " SELECT cache_key FROM results ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        ).rowcount
+        self.evictions += evicted
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / total) if total else 0.0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,237 @@
+import collections
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+from render_backends import file_url_path
+import worker_logging
+import worker_metrics
+from worker_http import get_session
+
+# S3 transfer settings shared by the render workers, a streaming upload that pipes a remote
+# image straight into S3 without staging it on disk first, and an executor that runs uploads
+# in the background. ChunkPipe does the same piping for the async pipeline, whose downloads
+# run on the event loop while boto3 uploads on a thread.
+#
+# Files at or above S3_MULTIPART_THRESHOLD_MB are sent as a multipart upload in parts of
+# S3_MULTIPART_CHUNKSIZE_MB, up to S3_MAX_CONCURRENCY parts at a time.
+#
+#   S3_STREAM_UPLOADS           stream provider images to S3 instead of downloading them first (default false)
+#   S3_MULTIPART_THRESHOLD_MB   default 8
+#   S3_MULTIPART_CHUNKSIZE_MB   default 8
+#   S3_MAX_CONCURRENCY          parts uploaded at once per file (default 4)
+#   S3_UPLOAD_WORKERS           files uploaded at once (default 4)
+#   S3_UPLOAD_QUEUE             uploads waiting or running before the workers stop taking new work (default 32)
+
+log = worker_logging.get_logger("s3_transfer")
+
+MB = 1024 * 1024
+
+STREAM_UPLOADS = os.getenv('S3_STREAM_UPLOADS', 'false').lower() in ('1', 'true', 'yes')
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(float(os.getenv('S3_MULTIPART_THRESHOLD_MB', 8)) * MB),
+    multipart_chunksize=int(float(os.getenv('S3_MULTIPART_CHUNKSIZE_MB', 8)) * MB),
+    max_concurrency=int(os.getenv('S3_MAX_CONCURRENCY', 4)),
+    # Streamed bodies are read in chunks of this size
+    io_chunksize=256 * 1024,
+)
+
+
+def stream_url_to_s3(s3_client, url, bucket, s3_file):
+    """Upload the body of an HTTP response to S3 as it is downloaded. Returns the number of bytes sent."""
+    local_path = file_url_path(url)
+    if local_path:
+        s3_client.upload_file(local_path, bucket, s3_file, Config=TRANSFER_CONFIG)
+        return os.path.getsize(local_path)
+
+    response = get_session().get(url, stream=True, timeout=60)
+    response.raise_for_status()
+    # Let urllib3 undo any transfer compression so the stored object is the image itself
+    response.raw.decode_content = True
+
+    sent = 0
+
+    def count(bytes_transferred):
+        nonlocal sent
+        sent += bytes_transferred
+
+    try:
+        s3_client.upload_fileobj(
+            response.raw, bucket, s3_file,
+            ExtraArgs={'ContentType': response.headers.get('Content-Type', 'image/png')},
+            Config=TRANSFER_CONFIG,
+            Callback=count
+        )
+    finally:
+        response.close()
+    return sent
+
+
+class ChunkPipe:
+    """
+    File-like object an upload thread reads while another thread (or the event loop, through
+    asyncio.to_thread) writes the body as it is downloaded. write() blocks while max_bytes are
+    buffered, or the size of the read waiting for data if that is larger: boto3 reads whole
+    multipart parts. finish() ends the body, with an error the reader then raises; close() is
+    called by the reader and makes further writes fail.
+    """
+
+    def __init__(self, max_bytes=MB):
+        self.max_bytes = max_bytes
+        self.chunks = collections.deque()
+        self.size = 0
+        self.wanted = 0
+        self.finished = False
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, chunk):
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.size < max(self.max_bytes, self.wanted))
+            if self.closed:
+                raise ValueError("write to a closed pipe, the upload stopped reading")
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify_all()
+
+    def read(self, size=-1):
+        with self.cond:
+            if size is None or size < 0:
+                self.cond.wait_for(lambda: self.finished)
+            else:
+                self.wanted = size
+                # A writer waiting for room may go on now
+                self.cond.notify_all()
+                self.cond.wait_for(lambda: self.finished or self.size >= size)
+                self.wanted = 0
+            if self.error is not None:
+                raise self.error
+            data = b"".join(self.chunks)
+            if size is not None and 0 <= size < len(data):
+                data, rest = data[:size], data[size:]
+                self.chunks = collections.deque([rest])
+            else:
+                self.chunks = collections.deque()
+            self.size -= len(data)
+            self.cond.notify_all()
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class UploadExecutor:
+    """
+    Runs S3 uploads on their own threads so a worker can carry on rendering while they finish.
+
+    Submitting never blocks: it is called from the ComfyUI websocket listener, which must keep
+    handling events while S3 is slow. Instead, once S3_UPLOAD_QUEUE uploads are waiting or
+    running the executor is full and the workers count their uploading prompts against their
+    free render slots, so rendering slows down to what S3 keeps up with. on_done is called on
+    the upload thread with the CloudFront URL, or None if the upload failed.
+    """
+
+    def __init__(self, s3_client, bucket, public_url, max_workers=None, max_queue=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.public_url = public_url
+        max_workers = max_workers or int(os.getenv('S3_UPLOAD_WORKERS', 4))
+        max_queue = max_queue or int(os.getenv('S3_UPLOAD_QUEUE', 32))
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-upload")
+        self.max_queue = max(max_queue, max_workers)
+        self.backlogged = False
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.uploads = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+
+    @property
+    def full(self):
+        with self.lock:
+            return self.pending >= self.max_queue
+
+    def submit_file(self, local_file, s3_file, on_done, prompt=None):
+        def upload():
+            self.s3_client.upload_file(local_file, self.bucket, s3_file, Config=TRANSFER_CONFIG)
+            return os.path.getsize(local_file)
+        return self._submit(upload, s3_file, on_done, prompt)
+
+    def submit_url(self, url, s3_file, on_done, prompt=None):
+        """Stream an image URL to S3; the time includes the download, as the two overlap."""
+        return self._submit(lambda: stream_url_to_s3(self.s3_client, url, self.bucket, s3_file), s3_file, on_done, prompt)
+
+    def _submit(self, upload, s3_file, on_done, prompt):
+        with self.lock:
+            self.pending += 1
+            worker_metrics.set_in_flight("s3_upload", self.pending)
+            if self.pending > self.max_queue and not self.backlogged:
+                log.warning("S3 uploads are falling behind, %d waiting or running", self.pending)
+            self.backlogged = self.pending > self.max_queue
+        try:
+            # Run in a copy of the caller's context so log records keep the job's ids
+            return self.executor.submit(contextvars.copy_context().run, self._run, upload, s3_file, on_done, prompt)
+        except Exception:
+            self._release()
+            raise
+
+    def _release(self):
+        with self.lock:
+            self.pending -= 1
+            worker_metrics.set_in_flight("s3_upload", self.pending)
+
+    def _run(self, upload, s3_file, on_done, prompt):
+        started = time.monotonic()
+        s3_url = None
+        try:
+            size = upload()
+            elapsed = time.monotonic() - started
+            s3_url = f"{self.public_url}/{s3_file}"
+            with self.lock:
+                self.uploads += 1
+                self.bytes_sent += size
+                self.seconds += elapsed
+            worker_metrics.observe("s3_upload", elapsed, prompt)
+            log.info("Uploaded %s (%d bytes) in %.2fs", s3_file, size, elapsed)
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+            worker_metrics.observe("s3_upload", time.monotonic() - started, prompt, "error")
+            log.error("Error uploading %s to S3: %s", s3_file, e)
+        finally:
+            self._release()
+
+        try:
+            on_done(s3_url)
+        except Exception as e:
+            log.exception("Error handling finished upload of %s: %s", s3_file, e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'uploads': self.uploads,
+                'failures': self.failures,
+                'avg_seconds': (self.seconds / self.uploads) if self.uploads else 0.0,
+                'mb_per_second': (self.bytes_sent / MB / self.seconds) if self.seconds else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The worker modules are imported the way the workers import them, from the python directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
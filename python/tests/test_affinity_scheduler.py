@@ -0,0 +1,57 @@
+import affinity_scheduler
+from affinity_scheduler import AffinityScheduler, group_key
+
+
+def prompt(prompt_id, model, text="a fox", status=0, generation_type="prompt"):
+    return {'id': prompt_id, 'render_status': status, 'generation_type': generation_type, 'model': model, 'generated_prompt': text}
+
+
+def fake_clock(monkeypatch, start=1000.0):
+    clock = {'now': start}
+    monkeypatch.setattr(affinity_scheduler.time, 'monotonic', lambda: clock['now'])
+    return clock
+
+
+def test_group_key_includes_lora_for_kontext_lora_only():
+    assert group_key(prompt(1, "schnell")) == ("flux_schnell_for_image_gen.json", "schnell", "")
+    lora = dict(prompt(1, "dev", generation_type="kontext-lora"), lora_name="style.safetensors")
+    assert group_key(lora)[2] == "style.safetensors"
+
+
+def test_running_prompts_first_then_groups():
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    prompts = [prompt(1, "schnell"), prompt(2, "dev"), prompt(3, "schnell"), prompt(4, "dev", status=1)]
+    assert [p['id'] for p in scheduler.order(prompts)] == [4, 1, 3, 2]
+
+
+def test_current_group_is_kept_until_empty():
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    scheduler.submitted(prompt(9, "dev"))
+    prompts = [prompt(1, "schnell"), prompt(2, "dev"), prompt(3, "schnell")]
+    assert [p['id'] for p in scheduler.order(prompts)] == [2, 1, 3]
+
+
+def test_same_text_is_kept_together():
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    prompts = [prompt(1, "schnell", "a"), prompt(2, "schnell", "b"), prompt(3, "schnell", "a")]
+    assert [p['id'] for p in scheduler.order(prompts)] == [1, 3, 2]
+
+
+def test_starved_prompt_skips_the_grouping(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    scheduler.submitted(prompt(9, "dev"))
+    scheduler.order([prompt(1, "schnell")])
+    clock['now'] += 200
+    ordered = scheduler.order([prompt(1, "schnell"), prompt(2, "dev")])
+    assert [p['id'] for p in ordered] == [1, 2]
+
+    scheduler.submitted(ordered[0])
+    assert scheduler.stats()['starved'] == 1
+    assert scheduler.stats()['group_switches'] == 1
+
+
+def test_lookahead_zero_keeps_api_order():
+    scheduler = AffinityScheduler(lookahead=0)
+    prompts = [prompt(1, "schnell"), prompt(2, "dev"), prompt(3, "schnell")]
+    assert [p['id'] for p in scheduler.order(prompts)] == [1, 2, 3]
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import callback_buffer
+from callback_buffer import CallbackBuffer
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = ""
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def post(self, url, json):
+        if self.fail:
+            raise ConnectionError("API down")
+        self.batches.append(json['updates'])
+        return FakeResponse(200, {'updated': [u['id'] for u in json['updates']]})
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(callback_buffer, 'get_api_session', lambda: session)
+    return session
+
+
+def test_updates_are_coalesced_per_prompt(session):
+    buffer = CallbackBuffer("http://api", flush_interval=60)
+    buffer.set_status(1, 1)
+    buffer.set_status(2, 1)
+    buffer.set_filename(1, "images/1.png")
+    assert buffer.flush()
+    assert session.batches == [[{'id': 1, 'filename': "images/1.png"}, {'id': 2, 'status': 1}]]
+
+
+def test_failed_flush_requeues_without_holding_the_lock(session):
+    buffer = CallbackBuffer("http://api", flush_interval=0.5)
+    session.fail = True
+    buffer.set_status(1, 4)
+    # Let the flusher thread fail and go into its backoff
+    time.sleep(0.6)
+
+    session.fail = False
+    done = threading.Event()
+    threading.Thread(target=lambda: (buffer.flush(), done.set()), daemon=True).start()
+    assert done.wait(0.2)
+    assert {'id': 1, 'status': 4} in [u for batch in session.batches for u in batch]
@@ -0,0 +1,39 @@
+from comfy_events import ComfyEventListener
+
+
+def make_listener():
+    finished = []
+    listener = ComfyEventListener(
+        "http://127.0.0.1:8188", "client", lambda prompt_id, outputs: finished.append(prompt_id), lambda prompt_id, data: None
+    )
+    return listener, finished
+
+
+def test_prompts_watched_after_connecting_are_reported():
+    listener, _ = make_listener()
+    assert not listener.will_report("a")
+    listener._connected()
+    listener.watch("a")
+    assert listener.will_report("a")
+
+
+def test_prompts_in_flight_over_a_reconnect_are_polled():
+    listener, finished = make_listener()
+    listener._connected()
+    listener.watch("a")
+    listener.connected.clear()
+    # Watched while the socket was down, its events may be lost as well
+    listener.watch("b")
+    listener._connected()
+    listener.watch("c")
+    assert not listener.will_report("a")
+    assert not listener.will_report("b")
+    assert listener.will_report("c")
+
+    # A late event for a polled prompt is still handled
+    listener._handle({'type': 'execution_success', 'data': {'prompt_id': "a"}})
+    assert finished == ["a"]
+    assert "a" not in listener.missed
+
+    listener.forget("b")
+    assert listener.missed == set()
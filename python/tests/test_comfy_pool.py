@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("requests")
+
+from comfy_pool import ComfyPool, parse_instances
+
+
+def make_pool(monkeypatch, urls, queue_depth=2):
+    monkeypatch.setenv('COMFY_INSTANCES', ",".join(urls))
+    noop = lambda *args, **kwargs: None
+    return ComfyPool("client", noop, noop, noop, queue_depth, urls[0], "/out", "/comfy-out")
+
+
+def test_parse_instances_defaults():
+    assert parse_instances(None, "http://a:8188", "/out", "/comfy") == [("http://a:8188", "/out", "/comfy")]
+    assert parse_instances("http://a|/a-out, http://b||/b-comfy", "x", "/out", "/comfy") == [
+        ("http://a", "/a-out", "/comfy"),
+        ("http://b", "/out", "/b-comfy"),
+    ]
+
+
+def test_pick_prefers_least_loaded(monkeypatch):
+    pool = make_pool(monkeypatch, ["http://a", "http://b"])
+    pool.instances["a"].running = 1
+    assert pool.pick().name == "b"
+
+
+def test_idle_instance_wins_over_affinity(monkeypatch):
+    pool = make_pool(monkeypatch, ["http://a", "http://b"])
+    pool.instances["a"].running = 1
+    pool.instances["a"].last_key = "flux"
+    assert pool.pick("flux").name == "b"
+
+
+def test_affinity_breaks_ties(monkeypatch):
+    pool = make_pool(monkeypatch, ["http://a", "http://b"])
+    pool.instances["b"].last_key = "flux"
+    assert pool.pick("flux").name == "b"
+
+
+def test_full_and_unhealthy_instances_are_skipped(monkeypatch):
+    pool = make_pool(monkeypatch, ["http://a", "http://b"], queue_depth=0)
+    pool.instances["a"].running = 1
+    pool.instances["b"].healthy = False
+    assert pool.pick() is None
+    assert pool.free_slots() == 0
+
+    pool.instances["b"].healthy = True
+    instance = pool.pick()
+    assert instance.name == "b"
+    assert pool.free_slots() == 0
+    pool.unpick(instance)
+    assert pool.free_slots() == 1
@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta, timezone
+
+import fair_queue
+from affinity_scheduler import AffinityScheduler, group_key
+from fair_queue import FairQueue, parse_user_values
+
+
+def make_prompts(user_id, ids, age_seconds=0):
+    created = (datetime.now(timezone.utc) - timedelta(seconds=age_seconds)).isoformat().replace('+00:00', 'Z')
+    return [{'id': i, 'user_id': user_id, 'render_status': 0, 'created_at': created} for i in ids]
+
+
+def fake_clock(monkeypatch, start=1000.0):
+    clock = {'now': start}
+    monkeypatch.setattr(fair_queue.time, 'monotonic', lambda: clock['now'])
+    return clock
+
+
+def test_parse_user_values():
+    assert parse_user_values("12:2, 15:0.5,bad,:3") == {'12': 2.0, '15': 0.5}
+    assert parse_user_values("7:3", int) == {'7': 3}
+    assert parse_user_values(None) == {}
+
+
+def test_users_take_turns():
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0)
+    ordered, capped = queue.order(make_prompts(1, range(1, 5)) + make_prompts(2, range(10, 12)))
+    assert [p['user_id'] for p in ordered] == [1, 2, 1, 2, 1, 1]
+    assert capped == []
+
+
+def test_weights_share_slots():
+    queue = FairQueue(weights={'2': 2}, max_in_flight=0, user_limits={}, age_boost_seconds=0)
+    ordered, _ = queue.order(make_prompts(1, range(1, 7)) + make_prompts(2, range(10, 22)))
+    first_nine = [p['user_id'] for p in ordered[:9]]
+    assert first_nine.count(2) == 6
+    assert first_nine.count(1) == 3
+
+
+def test_in_flight_cap_holds_prompts_back():
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={'1': 2}, age_boost_seconds=0)
+    bulk = make_prompts(1, range(1, 6))
+    ordered, capped = queue.order(bulk[1:], busy=bulk[:1])
+    assert [p['id'] for p in ordered] == [2]
+    assert [p['id'] for p in capped] == [3, 4, 5]
+
+
+def test_returning_user_is_not_owed_idle_time():
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0)
+    for prompt in make_prompts(1, range(1, 21)):
+        queue.dispatched(prompt)
+    ordered, _ = queue.order(make_prompts(1, range(21, 31)) + make_prompts(2, range(100, 110)))
+    # User 2 gets the next slot but then alternates, it does not get 20 slots in a row
+    assert [p['user_id'] for p in ordered[:4]] == [2, 1, 2, 1]
+
+
+def test_old_backlog_does_not_starve_new_user(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=60)
+    bulk = make_prompts(1, range(1, 201), age_seconds=1800)
+    queue.order(bulk)
+
+    clock['now'] += 1800
+    ordered, _ = queue.order(bulk + make_prompts(2, [1000]))
+    position = [p['id'] for p in ordered].index(1000)
+    assert position <= 2
+
+
+def test_age_boost_is_bounded_to_one_job(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=60)
+    queue.order(make_prompts(1, range(1, 5)))
+    clock['now'] += 3600
+    ordered, _ = queue.order(make_prompts(1, range(1, 5)) + make_prompts(2, range(10, 14)))
+    # The waiting user goes first, then the two alternate
+    assert [p['user_id'] for p in ordered[:5]] == [1, 1, 2, 1, 2]
+
+
+def model_prompts(user_id, ids, model):
+    return [dict(p, generation_type="prompt", model=model, generated_prompt="a fox") for p in make_prompts(user_id, ids)]
+
+
+def test_turns_follow_the_affinity_groups():
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0, affinity_slack=2)
+    prompts = scheduler.order(model_prompts(1, range(1, 5), "schnell") + model_prompts(2, range(10, 14), "dev"))
+    ordered, _ = queue.order(prompts, key=group_key, current_key=scheduler.current_key)
+    models = [p['model'] for p in ordered]
+    # One model swap per few jobs instead of one per job
+    assert models == ["schnell"] * 3 + ["dev"] * 4 + ["schnell"]
+
+
+def test_turns_start_on_the_loaded_model():
+    scheduler = AffinityScheduler(lookahead=8, max_wait_seconds=120)
+    scheduler.submitted(model_prompts(3, [99], "dev")[0])
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0, affinity_slack=2)
+    prompts = scheduler.order(model_prompts(1, range(1, 5), "schnell") + model_prompts(2, range(10, 14), "dev"))
+    ordered, _ = queue.order(prompts, key=group_key, current_key=scheduler.current_key)
+    assert ordered[0]['model'] == "dev"
+
+
+def test_affinity_slack_bounds_the_lead():
+    queue = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0, affinity_slack=2)
+    prompts = model_prompts(1, range(1, 21), "schnell") + model_prompts(2, range(100, 120), "dev")
+    ordered, _ = queue.order(prompts, key=group_key)
+    for count in range(1, len(ordered) + 1):
+        users = [p['user_id'] for p in ordered[:count]]
+        assert abs(users.count(1) - users.count(2)) <= 3
+
+    strict = FairQueue(weights={}, max_in_flight=0, user_limits={}, age_boost_seconds=0, affinity_slack=0)
+    ordered, _ = strict.order(prompts[:2] + prompts[20:22], key=group_key)
+    assert [p['model'] for p in ordered] == ["schnell", "dev", "schnell", "dev"]
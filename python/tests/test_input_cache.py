@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+
+import input_cache
+from input_cache import InputImageCache
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+        self.status_code = 200
+        self.headers = {'ETag': '"v1"'}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, size):
+        self.size = size
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        return FakeResponse(b"x" * self.size)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession(600 * 1024)
+    monkeypatch.setattr(input_cache, 'get_session', lambda: session)
+    return session
+
+
+def make_cache(tmp_path, max_mb=1):
+    return InputImageCache(cache_dir=tmp_path, max_mb=max_mb, revalidate_seconds=3600, workers=2)
+
+
+def test_image_is_downloaded_once(tmp_path, session):
+    cache = make_cache(tmp_path)
+    first = cache.get("http://img/a.png", owner=1)
+    assert cache.get("http://img/a.png", owner=2) == first
+    assert session.requests == ["http://img/a.png"]
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_prefetch_does_not_count_hits(tmp_path, session):
+    cache = make_cache(tmp_path)
+    for _ in range(5):
+        cache.prefetch(["http://img/a.png"])
+        while cache.stats()['downloading']:
+            time.sleep(0.01)
+    cache.get("http://img/a.png", owner=1)
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 0
+
+
+def test_pinned_images_are_not_evicted(tmp_path, session):
+    cache = make_cache(tmp_path)
+    path_a = cache.get("http://img/a.png", owner=1)
+    # Over the 1 MB cap, but a.png is pinned to prompt 1
+    path_b = cache.get("http://img/b.png", owner=2)
+    assert path_a and path_b
+    assert (tmp_path / path_a.split('/')[-1]).exists()
+
+    cache.release(1)
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['entries'] == 1
+
+
+def test_index_is_rebuilt_from_disk(tmp_path, session):
+    make_cache(tmp_path, max_mb=10).get("http://img/a.png", owner=1)
+    cache = make_cache(tmp_path, max_mb=10)
+    assert cache.stats()['entries'] == 1
+    cache.get("http://img/a.png", owner=1)
+    assert session.requests == ["http://img/a.png"]
@@ -0,0 +1,58 @@
+import job_state
+from job_state import JobStateStore
+
+
+def make_store(tmp_path, deadline=60):
+    return JobStateStore("test", deadline, db_path=str(tmp_path / "jobs.sqlite3"))
+
+
+def test_submit_counts_attempts_and_keeps_instance(tmp_path):
+    store = make_store(tmp_path)
+    store.record_submit(1, "queued", "gpu-a")
+    store.record_submit(1, "queued", "gpu-b", "/out/batch_1.png")
+    entry = store.get(1)
+    assert entry['attempts'] == 2
+    assert entry['instance'] == "gpu-b"
+    assert entry['batch_output'] == "/out/batch_1.png"
+    assert entry['finished_at'] is None
+
+
+def test_deadline_expires_unfinished_jobs_only(tmp_path, monkeypatch):
+    store = make_store(tmp_path, deadline=60)
+    store.record_submit(1, "queued")
+    store.record_submit(2, "queued")
+    store.mark_finished(2, "done")
+    assert not store.is_expired(1)
+
+    later = job_state.time.time() + 120
+    monkeypatch.setattr(job_state.time, 'time', lambda: later)
+    assert store.is_expired(1)
+    assert not store.is_expired(2)
+    assert not store.is_expired(3)
+
+
+def test_seen_prompts_get_a_deadline_from_now(tmp_path):
+    store = make_store(tmp_path)
+    store.record_seen(5, "status 1")
+    entry = store.get(5)
+    assert entry['attempts'] == 0
+    assert entry['last_state'] == "status 1"
+    assert not store.is_expired(5)
+
+
+def test_state_survives_a_restart(tmp_path):
+    make_store(tmp_path).record_submit(1, "queued", "gpu-a")
+    assert make_store(tmp_path).get(1)['instance'] == "gpu-a"
+
+
+def test_compact_drops_old_finished_entries(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    store.record_submit(1, "queued")
+    store.mark_finished(1, "done")
+    store.record_submit(2, "queued")
+
+    later = job_state.time.time() + 2 * 86400
+    monkeypatch.setattr(job_state.time, 'time', lambda: later)
+    store.compact()
+    assert store.get(1) is None
+    assert store.get(2) is not None
@@ -0,0 +1,52 @@
+import rate_limit
+from rate_limit import ProviderLimiter, outcome_for
+
+
+class HttpError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def test_outcome_for():
+    assert outcome_for(TimeoutError()) == rate_limit.THROTTLED
+    assert outcome_for(HttpError(429)) == rate_limit.THROTTLED
+    assert outcome_for(HttpError(503)) == rate_limit.THROTTLED
+    assert outcome_for(HttpError(400)) == rate_limit.ERROR
+    assert outcome_for(Exception("upstream said 502")) == rate_limit.THROTTLED
+    assert outcome_for(ValueError("bad prompt")) == rate_limit.ERROR
+
+
+def test_concurrency_and_tokens_are_enforced():
+    limiter = ProviderLimiter("fal", 2, rate_per_minute=60, burst=3)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    # Both slots taken
+    assert limiter.try_acquire() > 0
+
+    limiter.release(rate_limit.OK)
+    assert limiter.try_acquire() == 0
+    limiter.release(rate_limit.OK)
+    # Out of tokens now, about a second until the next one
+    assert 0 < limiter.try_acquire() <= 1
+
+
+def test_throttling_halves_the_limit_and_success_grows_it_back():
+    limiter = ProviderLimiter("fal", 8, rate_per_minute=6000, burst=100, min_concurrency=1)
+    limiter.try_acquire()
+    limiter.release(rate_limit.THROTTLED)
+    assert limiter.concurrency == 4
+    assert limiter.stats()['throttled'] == 1
+
+    for _ in range(40):
+        limiter.try_acquire()
+        limiter.release(rate_limit.OK)
+    assert limiter.concurrency == 8
+
+
+def test_limit_never_drops_below_the_minimum():
+    limiter = ProviderLimiter("minimax", 4, rate_per_minute=6000, burst=100, min_concurrency=2)
+    for _ in range(5):
+        limiter.try_acquire()
+        limiter.release(rate_limit.THROTTLED)
+    assert limiter.concurrency == 2
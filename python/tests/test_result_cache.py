@@ -0,0 +1,64 @@
+from result_cache import ResultCache, make_key
+
+# A prompt as claimPrompts sends it (PromptApiController::WORKER_PROMPT_COLUMNS)
+PROMPT = {
+    'id': 101, 'user_id': 7, 'render_status': 0, 'prompt_setting_id': 3, 'generated_prompt': "a red fox",
+    'width': 1024, 'height': 768, 'model': "schnell", 'lora_name': None, 'strength_model': None,
+    'guidance': 3.5, 'upload_to_s3': 1, 'generation_type': "prompt", 'input_image_1': None,
+    'input_image_1_strength': None, 'input_image_2': None, 'input_image_2_strength': None,
+    'created_at': "2026-10-18T08:00:00.000000Z",
+}
+
+
+def make_cache(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setenv('RESULT_CACHE_ENABLED', 'true')
+    return ResultCache(db_path=str(tmp_path / "cache.sqlite3"), **kwargs)
+
+
+def test_rerendered_prompt_row_hits_the_cache(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+    cache.store(make_key("flux.json", PROMPT), "https://cdn/images/prompt_schnell_101_7.png")
+
+    # The same prompt queued again later has its own id, status and timestamp
+    again = dict(PROMPT, id=205, render_status=3, created_at="2026-10-18T09:30:00.000000Z")
+    assert cache.lookup(make_key("flux.json", again)) == "https://cdn/images/prompt_schnell_101_7.png"
+
+
+def test_key_depends_on_render_settings_and_inputs(tmp_path):
+    image = tmp_path / "input.png"
+    image.write_bytes(b"one")
+    key = make_key("flux.json", PROMPT, [str(image)])
+    assert key == make_key("flux.json", dict(PROMPT), [str(image)])
+    assert key != make_key("flux.json", dict(PROMPT, generated_prompt="a blue fox"), [str(image)])
+    assert key != make_key("flux.json", dict(PROMPT, width=768), [str(image)])
+    assert key != make_key("flux-dev.json", PROMPT, [str(image)])
+
+    image.write_bytes(b"two")
+    assert key != make_key("flux.json", PROMPT, [str(image)])
+
+
+def test_lookup_and_store(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch)
+    assert cache.lookup("k") is None
+    cache.store("k", "https://cdn/images/k.png")
+    assert cache.lookup("k") == "https://cdn/images/k.png"
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, monkeypatch, max_entries=2)
+    cache.store("a", "a.png")
+    cache.store("b", "b.png")
+    cache.lookup("a")
+    cache.store("c", "c.png")
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") == "a.png"
+    assert cache.lookup("c") == "c.png"
+
+
+def test_disabled_cache_does_nothing(tmp_path, monkeypatch):
+    monkeypatch.setenv('RESULT_CACHE_ENABLED', 'false')
+    cache = ResultCache(db_path=str(tmp_path / "cache.sqlite3"))
+    cache.store("k", "k.png")
+    assert cache.lookup("k") is None
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+pytest.importorskip("requests")
+
+from s3_transfer import ChunkPipe, UploadExecutor
+
+
+class SlowS3:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def upload_file(self, local_file, bucket, s3_file, Config=None):
+        self.release.wait(5)
+
+
+def test_full_executor_does_not_block_submit(tmp_path):
+    image = tmp_path / "image.png"
+    image.write_bytes(b"png")
+    s3 = SlowS3()
+    executor = UploadExecutor(s3, "bucket", "https://cdn", max_workers=1, max_queue=2)
+    done = []
+    finished = threading.Event()
+
+    def on_done(url):
+        done.append(url)
+        if len(done) == 3:
+            finished.set()
+
+    executor.submit_file(str(image), "images/1.png", on_done)
+    assert not executor.full
+    executor.submit_file(str(image), "images/2.png", on_done)
+    executor.submit_file(str(image), "images/3.png", on_done)
+    # Past the queue size submit still returns straight away, the workers see the executor is full
+    assert executor.full
+
+    s3.release.set()
+    assert finished.wait(5)
+    assert not executor.full
+    assert sorted(done) == ["https://cdn/images/1.png", "https://cdn/images/2.png", "https://cdn/images/3.png"]
+    executor.shutdown()
+
+
+def write_in_thread(pipe, chunks, error=None):
+    def run():
+        try:
+            for chunk in chunks:
+                pipe.write(chunk)
+        except ValueError:
+            return
+        pipe.finish(error)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_chunk_pipe_reads_whole_parts_larger_than_its_buffer():
+    pipe = ChunkPipe(max_bytes=4)
+    writer = write_in_thread(pipe, [b"abc"] * 5)
+    # A read waits for the full size (boto3 reads whole multipart parts) or the end of the body
+    assert pipe.read(10) == b"abcabcabca"
+    assert pipe.read(10) == b"bcabc"
+    assert pipe.read(10) == b""
+    writer.join(5)
+
+
+def test_chunk_pipe_hands_download_errors_to_the_reader():
+    pipe = ChunkPipe()
+    write_in_thread(pipe, [b"abc"], error=IOError("connection reset"))
+    with pytest.raises(IOError, match="connection reset"):
+        pipe.read()
+
+
+def test_closed_chunk_pipe_stops_the_writer():
+    pipe = ChunkPipe(max_bytes=2)
+    writer = write_in_thread(pipe, [b"ab"] * 10)
+    pipe.read(2)
+    pipe.close()
+    writer.join(5)
+    assert not writer.is_alive()
+    assert not pipe.finished
@@ -0,0 +1,36 @@
+import variations
+
+
+def prompt(prompt_id, text="a fox", status=0, setting=7, **extra):
+    return dict({
+        'id': prompt_id, 'render_status': status, 'user_id': 1, 'prompt_setting_id': setting,
+        'generation_type': "prompt", 'model': "schnell", 'generated_prompt': text, 'width': 1024, 'height': 768,
+    }, **extra)
+
+
+def ids(groups):
+    return [[p['id'] for p in group] for group in groups]
+
+
+def test_identical_new_prompts_are_grouped(monkeypatch):
+    monkeypatch.setenv('VARIATION_BATCH_MAX', '4')
+    prompts = [prompt(1), prompt(2, "a cat"), prompt(3), prompt(4, status=1), prompt(5)]
+    assert ids(variations.group(prompts)) == [[1, 3, 5], [2], [4]]
+
+
+def test_batches_are_capped(monkeypatch):
+    monkeypatch.setenv('VARIATION_BATCH_MAX', '2')
+    assert ids(variations.group([prompt(i) for i in range(1, 6)])) == [[1, 2], [3, 4], [5]]
+    monkeypatch.setenv('VARIATION_BATCH_MAX', '4')
+    assert ids(variations.group([prompt(i) for i in range(1, 4)], limit=lambda p: 1)) == [[1], [2], [3]]
+
+
+def test_prompts_without_a_setting_are_never_grouped(monkeypatch):
+    monkeypatch.setenv('VARIATION_BATCH_MAX', '4')
+    assert ids(variations.group([prompt(1, setting=None), prompt(2, setting=None)])) == [[1], [2]]
+
+
+def test_as_batch():
+    batch = variations.as_batch([prompt(1), prompt(2)])
+    assert batch['id'] == 1
+    assert batch['variations'] == 2
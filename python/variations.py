@@ -0,0 +1,64 @@
+import os
+
+# Renders the variations of a prompt together.
+#
+# Users ask for several variations of a prompt by rendering it more than once
+# (render_each_prompt_times), which creates identical prompt rows under the same prompt
+# setting. New prompts that differ in nothing but their id are grouped into one batch: the
+# ComfyUI worker renders a batch as one workflow run with a latent batch of N, the remote
+# worker as one provider call asking for N images. Each image then goes to its own prompt's
+# upload and callback, exactly as if the prompt had been rendered alone.
+#
+# Batches are further capped by what the renderer takes at once (a backend's max_variations,
+# workflows without a batch size input render one image per run).
+#
+#   VARIATION_BATCH_MAX  prompts rendered together at most (default 4, 1 turns batching off)
+
+# Everything besides the id that goes into rendering a prompt
+VARIATION_FIELDS = (
+    'user_id', 'prompt_setting_id', 'generation_type', 'model', 'generated_prompt', 'width', 'height',
+    'input_image_1', 'input_image_1_strength', 'input_image_2', 'input_image_2_strength',
+    'lora_name', 'strength_model', 'guidance', 'upload_to_s3',
+)
+
+
+def batch_max():
+    return max(1, int(os.getenv('VARIATION_BATCH_MAX') or 4))
+
+
+def variation_key(prompt):
+    """Prompts with the same key render the same image up to the seed; None for prompts that are never grouped."""
+    if prompt.get('render_status') != 0 or prompt.get('prompt_setting_id') is None:
+        return None
+    return tuple(str(prompt.get(field)) for field in VARIATION_FIELDS)
+
+
+def group(prompts, limit=None):
+    """
+    Split prompts into lists to render together, ordered by each list's first prompt.
+    Prompts that are not new stay on their own. limit(prompt) caps the size of a batch
+    further, it is asked for the first prompt of each batch.
+    """
+    batch_size = batch_max()
+    groups = []
+    # variation key -> (members, size cap) of the batch still taking prompts
+    open_batches = {}
+    for prompt in prompts:
+        key = variation_key(prompt)
+        members, size = open_batches.get(key, (None, 0))
+        if members is not None and len(members) < size:
+            members.append(prompt)
+            continue
+
+        members = [prompt]
+        groups.append(members)
+        if key is not None:
+            size = min(batch_size, limit(prompt)) if limit else batch_size
+            if size > 1:
+                open_batches[key] = (members, size)
+    return groups
+
+
+def as_batch(prompts):
+    """The first prompt of a batch standing in for all of it, with 'variations' set to the number of images."""
+    return dict(prompts[0], variations=len(prompts))
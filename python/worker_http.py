@@ -0,0 +1,72 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared, connection-pooled HTTP sessions for the render workers.
+#
+# Every call site in render-jobs.py and render-jobs-comfy-only.py goes through one of
+# these sessions so connections to the Laravel API, ComfyUI and the image CDNs are kept
+# alive and reused instead of paying a TCP/TLS handshake per request.
+#
+#   HTTP_POOL_SIZE   connections kept open per host (default 20)
+#   HTTP_RETRIES     retries on connection errors and 502/503/504 responses (default 3)
+#   HTTP_BACKOFF     backoff factor between retries in seconds (default 0.5)
+#   HTTP_TIMEOUT     default timeout in seconds for calls that don't pass one (default 30)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """A requests session that applies a default timeout to every call."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.default_timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _build_session(retry_post):
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', 20))
+    retry = Retry(
+        total=int(os.getenv('HTTP_RETRIES', 3)),
+        backoff_factor=float(os.getenv('HTTP_BACKOFF', 0.5)),
+        status_forcelist=(502, 503, 504),
+        allowed_methods=(Retry.DEFAULT_ALLOWED_METHODS | {"POST"}) if retry_post else Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = TimeoutSession(float(os.getenv('HTTP_TIMEOUT', 30)))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _get(name, retry_post):
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = _build_session(retry_post)
+        return _sessions[name]
+
+
+def get_api_session():
+    """
+    Session for the Laravel API. Status and filename callbacks are idempotent,
+    so POSTs are retried as well.
+    """
+    return _get('api', retry_post=True)
+
+
+def get_session():
+    """
+    Session for everything else (image downloads, providers, ComfyUI).
+    Only idempotent methods are retried so a paid generation request is never sent twice.
+    """
+    return _get('default', retry_post=False)
@@ -0,0 +1,215 @@
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Logging for the render workers.
+#
+# Records are written as one JSON object per line (or plain text with LOG_FORMAT=text) and
+# carry the worker name and id plus, inside a job(prompt) block, the prompt_id, user_id,
+# model and generation_type of the job being worked on. The job fields live in a context
+# variable, so they follow a job through asyncio tasks and s3_transfer's upload threads.
+#
+# Handlers never block a render thread: records go onto a bounded queue that a single
+# listener thread writes out, and when the queue is full they are dropped and counted.
+# To keep the volume bounded at high job rates every INFO/DEBUG message template may log
+# LOG_RATE_LIMIT times per minute (per logger); the rest is suppressed and summed up in a
+# single line once a minute. DEBUG records are additionally sampled with LOG_DEBUG_SAMPLE_RATE.
+#
+#   LOG_LEVEL              DEBUG, INFO (default), WARNING or ERROR
+#   LOG_FORMAT             json (default) or text
+#   LOG_RATE_LIMIT         INFO/DEBUG records per message template and minute (default 60, 0 = no limit)
+#   LOG_DEBUG_SAMPLE_RATE  share of DEBUG records kept (default 1)
+#   LOG_QUEUE_SIZE         records waiting for the writer thread at most (default 10000)
+
+JOB_FIELDS = ('prompt_id', 'user_id', 'model', 'generation_type')
+
+_job = contextvars.ContextVar('render_job', default=None)
+_worker = {'worker': None, 'worker_id': None}
+_listener = None
+
+
+def get_logger(name):
+    return logging.getLogger(f"render.{name}")
+
+
+def set_worker_id(worker_id):
+    _worker['worker_id'] = worker_id
+
+
+@contextmanager
+def job(prompt):
+    """Attach a prompt's ids to every record logged inside the block."""
+    token = _job.set({
+        'prompt_id': prompt.get('id'),
+        'user_id': prompt.get('user_id'),
+        'model': prompt.get('model'),
+        'generation_type': prompt.get('generation_type'),
+    })
+    try:
+        yield
+    finally:
+        _job.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the worker and job fields onto each record, in the logging thread before it is queued."""
+
+    def filter(self, record):
+        record.worker = _worker['worker']
+        record.worker_id = _worker['worker_id']
+        fields = _job.get() or {}
+        for name in JOB_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, fields.get(name))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets each INFO/DEBUG message template through `per_minute` times a minute and samples DEBUG."""
+
+    def __init__(self, per_minute, debug_sample_rate):
+        super().__init__()
+        self.per_minute = per_minute
+        self.debug_sample_rate = debug_sample_rate
+        self.lock = threading.Lock()
+        self.window_started = time.monotonic()
+        self.counts = {}
+        self.suppressed = 0
+        self.debug_seen = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            if record.levelno < logging.INFO and self.debug_sample_rate < 1:
+                # Deterministic sampling, cheaper than a random draw per record
+                self.debug_seen += 1
+                if int(self.debug_seen * self.debug_sample_rate) == int((self.debug_seen - 1) * self.debug_sample_rate):
+                    return False
+            if not self.per_minute:
+                return True
+            now = time.monotonic()
+            if now - self.window_started >= 60:
+                self._summarize()
+                self.window_started = now
+                self.counts.clear()
+            key = (record.name, record.msg)
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+            if count > self.per_minute:
+                self.suppressed += 1
+                return False
+            return True
+
+    def _summarize(self):
+        if self.suppressed:
+            noisy = sorted(((c, k) for k, c in self.counts.items() if c > self.per_minute), reverse=True)[:3]
+            logging.getLogger("render.logging").warning(
+                "Suppressed %d log records in the last minute, noisiest: %s",
+                self.suppressed, [f"{name}: {str(msg)[:60]} ({count})" for count, (name, msg) in noisy]
+            )
+            self.suppressed = 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that drops records instead of blocking or raising when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Format the message here so the record no longer holds its (possibly large) args,
+        # the traceback is kept apart so the JSON output can put it in its own field
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.dropped:
+            record.dropped_records, self.dropped = self.dropped, 0
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'worker': getattr(record, 'worker', None),
+            'worker_id': getattr(record, 'worker_id', None),
+        }
+        for name in JOB_FIELDS + ('dropped_records',):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s%(job)s %(message)s")
+
+    def format(self, record):
+        prompt_id = getattr(record, 'prompt_id', None)
+        record.job = f" [prompt {prompt_id}]" if prompt_id is not None else ""
+        return super().format(record)
+
+
+def setup(worker, worker_id=None):
+    """Route the render.* loggers through the queue to stdout. Call once, early in the worker's startup."""
+    global _listener
+    _worker['worker'] = worker
+    _worker['worker_id'] = worker_id or os.getenv('WORKER_ID')
+    if _listener is not None:
+        return
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    log_queue = queue.Queue(int(os.getenv('LOG_QUEUE_SIZE') or 10000))
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(TextFormatter() if os.getenv('LOG_FORMAT', 'json') == 'text' else JsonFormatter())
+
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(
+        int(os.getenv('LOG_RATE_LIMIT') or 60),
+        float(os.getenv('LOG_DEBUG_SAMPLE_RATE') or 1),
+    ))
+
+    root = logging.getLogger("render")
+    root.setLevel(level)
+    root.addHandler(handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+
+
+def shutdown():
+    """Write out whatever is still queued. Called on the way out of a worker."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
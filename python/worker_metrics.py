@@ -0,0 +1,128 @@
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+import worker_logging
+
+# Per-stage job timings and worker gauges, exported for Prometheus.
+#
+# Every job records how long it spent in each stage (fetch, input_download, workflow_build,
+# queue_wait, generation, output_download, s3_upload, callback) in the render_stage_seconds
+# histogram, labelled by model, generation_type and outcome, and counts finished jobs in
+# render_jobs_total. Queue depths and in-flight counts are gauges. How long each user's
+# prompts waited before they were sent to a renderer goes to render_user_wait_seconds, and
+# render_user_jobs counts each user's waiting and in-flight prompts (see fair_queue.py).
+#
+# start() serves them on METRICS_PORT (0 turns the endpoint off). Without prometheus_client
+# installed all calls are no-ops, so the workers run the same either way.
+#
+#   METRICS_PORT  port of the /metrics endpoint (default 9101 remote worker, 9102 ComfyUI worker)
+
+log = worker_logging.get_logger("worker_metrics")
+
+STAGES = (
+    "fetch", "input_download", "workflow_build", "queue_wait",
+    "generation", "output_download", "s3_upload", "callback",
+)
+
+# Render times range from a fraction of a second (cache hits, callbacks) to several minutes
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+if prometheus_client:
+    stage_seconds = prometheus_client.Histogram(
+        'render_stage_seconds', 'Time spent in each stage of a render job',
+        ['worker', 'stage', 'model', 'generation_type', 'outcome'], buckets=BUCKETS
+    )
+    jobs_total = prometheus_client.Counter(
+        'render_jobs_total', 'Render jobs finished', ['worker', 'model', 'generation_type', 'outcome']
+    )
+    queue_depth = prometheus_client.Gauge('render_queue_depth', 'Jobs waiting in a queue', ['worker', 'queue'])
+    in_flight = prometheus_client.Gauge('render_in_flight', 'Jobs currently being worked on', ['worker', 'kind'])
+    user_wait_seconds = prometheus_client.Histogram(
+        'render_user_wait_seconds', 'Time from prompt creation to dispatch, per user', ['worker', 'user'], buckets=BUCKETS
+    )
+    user_jobs = prometheus_client.Gauge('render_user_jobs', 'Prompts held per user', ['worker', 'user', 'state'])
+    worker_state = prometheus_client.Gauge('render_worker_state', 'Other worker state (rate limits, caches)', ['worker', 'name'])
+
+worker_name = "worker"
+
+
+def start(name, default_port):
+    """Set the worker label and start the /metrics endpoint."""
+    global worker_name
+    worker_name = name
+    port = int(os.getenv('METRICS_PORT') or default_port)
+    if prometheus_client is None:
+        log.warning("prometheus_client is not installed, metrics are disabled")
+        return
+    if port:
+        prometheus_client.start_http_server(port)
+        log.info("Serving metrics on port %d", port)
+
+
+def _job_labels(prompt):
+    prompt = prompt or {}
+    return str(prompt.get('model') or ""), str(prompt.get('generation_type') or "")
+
+
+def observe(stage, seconds, prompt=None, outcome="ok"):
+    if prometheus_client is None:
+        return
+    model, generation_type = _job_labels(prompt)
+    stage_seconds.labels(worker_name, stage, model, generation_type, outcome).observe(seconds)
+
+
+@contextmanager
+def timed(stage, prompt=None):
+    """Time a block as one stage of a job; an exception records it with outcome "error"."""
+    started = time.monotonic()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe(stage, time.monotonic() - started, prompt, outcome)
+
+
+def job_finished(prompt, outcome):
+    if prometheus_client is None:
+        return
+    model, generation_type = _job_labels(prompt)
+    jobs_total.labels(worker_name, model, generation_type, outcome).inc()
+
+
+def set_queue_depth(queue, value):
+    if prometheus_client is not None:
+        queue_depth.labels(worker_name, queue).set(value)
+
+
+def set_in_flight(kind, value):
+    if prometheus_client is not None:
+        in_flight.labels(worker_name, kind).set(value)
+
+
+def observe_user_wait(user_id, seconds):
+    if prometheus_client is not None:
+        user_wait_seconds.labels(worker_name, str(user_id)).observe(seconds)
+
+
+def set_user_jobs(state, counts):
+    """Set the per-user gauge for one state ("waiting", "in_flight") from a user id -> count dict."""
+    if prometheus_client is None:
+        return
+    for user_id, value in counts.items():
+        user_jobs.labels(worker_name, str(user_id), state).set(value)
+
+
+def set_state(values, prefix=""):
+    """Export a stats() dict (upload executor, rate limiter, result cache) as gauges; non-numbers are skipped."""
+    if prometheus_client is None:
+        return
+    for name, value in values.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            worker_state.labels(worker_name, f"{prefix}{name}").set(value)
@@ -0,0 +1,178 @@
+import copy
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import worker_logging
+
+# In-memory cache of the ComfyUI workflow templates plus a declarative patch plan for each
+# generation type.
+#
+# A plan names the workflow file (relative to python/) and lists which job value goes into
+# which node input. Building a job is then a deep copy of the cached template with those
+# inputs filled in; adding a workflow only needs a new entry in WORKFLOW_PLANS. A plan whose
+# workflow starts from an empty latent names that node's batch size input under "batch", so
+# several variations of a prompt can be rendered in one run (see variations.py).
+#
+# Templates are loaded once and re-read when the file's mtime changes, checked at most every
+# WORKFLOW_RELOAD_INTERVAL seconds (default 5), so edited workflows are picked up without a restart.
+
+log = worker_logging.get_logger("workflow_templates")
+
+WORKFLOW_DIR = Path(__file__).resolve().parent
+
+# Plans are looked up as "<generation_type>/<model>" first, then "<generation_type>".
+# Each input is (node id, input name, job value key).
+WORKFLOW_PLANS = {
+    "prompt/schnell": {
+        "file": "flux_schnell_for_image_gen.json",
+        "batch": ("5", "batch_size"),
+        "inputs": [
+            ("6", "text", "generated_prompt"),
+            ("25", "noise_seed", "seed"),
+            ("31", "file_name_template", "output_filename"),
+            ("5", "width", "width"),
+            ("5", "height", "height"),
+        ],
+    },
+    "prompt/dev": {
+        "file": "flux_dev_for_image_gen.json",
+        "batch": ("27", "batch_size"),
+        "inputs": [
+            ("6", "text", "generated_prompt"),
+            ("25", "noise_seed", "seed"),
+            ("41", "file_name_template", "output_filename"),
+            ("27", "width", "width"),
+            ("27", "height", "height"),
+            ("30", "width", "width"),
+            ("30", "height", "height"),
+        ],
+    },
+    "mix": {
+        "file": "flux_two_image_mix_for_image_gen.json",
+        "batch": ("27", "batch_size"),
+        "inputs": [
+            ("40", "image", "input_image_1_path"),
+            ("56", "image", "input_image_2_path"),
+            ("54", "downsampling_factor", "input_image_1_strength"),
+            ("55", "downsampling_factor", "input_image_2_strength"),
+            ("6", "text", "generated_prompt"),
+            ("25", "noise_seed", "seed"),
+            ("57", "file_name_template", "output_filename"),
+            # postprocessing resize width and height (proportional)
+            ("27", "width", "width"),
+            ("27", "height", "height"),
+            ("30", "width", "width"),
+            ("30", "height", "height"),
+        ],
+    },
+    "mix-one": {
+        "file": "flux_one_image_mix_for_image_gen.json",
+        "batch": ("27", "batch_size"),
+        "inputs": [
+            ("40", "image", "input_image_1_path"),
+            ("54", "image_strength", "image_strength_name"),
+            ("6", "text", "generated_prompt"),
+            ("25", "noise_seed", "seed"),
+            ("56", "file_name_template", "output_filename"),
+            ("27", "width", "width"),
+            ("27", "height", "height"),
+            ("30", "width", "width"),
+            ("30", "height", "height"),
+        ],
+    },
+    "kontext-basic": {
+        "file": "flux_kontext_basic.json",
+        "inputs": [
+            ("142", "image", "input_image_1_path"),
+            ("6", "text", "generated_prompt"),
+            ("31", "seed", "seed"),
+        ],
+    },
+    "kontext-lora": {
+        "file": "flix_kontext_lora.json",
+        "inputs": [
+            ("133", "image", "input_image_1_path"),
+            ("186", "lora_name", "lora_name"),
+            ("186", "strength_model", "strength_model"),
+            ("179", "guidance", "guidance"),
+            ("181", "text", "generated_prompt"),
+            ("178", "seed", "seed"),
+        ],
+    },
+}
+
+
+class WorkflowCache:
+    def __init__(self, base_dir=WORKFLOW_DIR, reload_interval=None):
+        self.base_dir = Path(base_dir)
+        self.reload_interval = reload_interval if reload_interval is not None else float(os.getenv('WORKFLOW_RELOAD_INTERVAL', 5))
+        # file name -> (template, mtime, time of last mtime check)
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, file_name):
+        """Return the cached template for a workflow file, re-reading it if it changed on disk."""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.templates.get(file_name)
+            if cached and now - cached[2] < self.reload_interval:
+                return cached[0]
+
+            path = self.base_dir / file_name
+            mtime = path.stat().st_mtime
+            if cached and cached[1] == mtime:
+                self.templates[file_name] = (cached[0], mtime, now)
+                return cached[0]
+
+            with open(path, 'r') as file:
+                template = json.load(file)
+            if cached:
+                log.info("Reloaded changed workflow %s", file_name)
+            self.templates[file_name] = (template, mtime, now)
+            return template
+
+
+workflow_cache = WorkflowCache()
+
+
+def get_plan(generation_type, model):
+    plan = WORKFLOW_PLANS.get(f"{generation_type}/{model}") or WORKFLOW_PLANS.get(generation_type)
+    if plan is None:
+        raise ValueError(f"Unknown generation type: {generation_type} (model {model})")
+    return plan
+
+
+def supports_batches(generation_type, model):
+    """Whether the workflow of a job can render several images in one run."""
+    return "batch" in get_plan(generation_type, model)
+
+
+def validate_plans():
+    """Load every template and check each planned input exists, so a bad plan fails at startup."""
+    for name, plan in WORKFLOW_PLANS.items():
+        template = workflow_cache.get(plan["file"])
+        inputs = plan["inputs"] + ([plan["batch"] + (None,)] if "batch" in plan else [])
+        for node_id, input_name, _ in inputs:
+            if input_name not in template.get(node_id, {}).get("inputs", {}):
+                raise ValueError(f"Workflow plan {name}: node {node_id} in {plan['file']} has no input '{input_name}'")
+
+
+def build_workflow(generation_type, model, values):
+    """
+    Copy the cached template for a job and apply its plan using the given job values.
+    values['batch_size'] (default 1) sets the number of images for plans that support batches.
+    """
+    plan = get_plan(generation_type, model)
+    workflow = copy.deepcopy(workflow_cache.get(plan["file"]))
+    for node_id, input_name, value_key in plan["inputs"]:
+        workflow[node_id]["inputs"][input_name] = values[value_key]
+    batch_size = values.get('batch_size', 1)
+    if batch_size > 1:
+        if "batch" not in plan:
+            raise ValueError(f"Workflow {plan['file']} renders one image per run, not {batch_size}")
+        node_id, input_name = plan["batch"]
+        workflow[node_id]["inputs"][input_name] = batch_size
+    return workflow
@@ -22,8 +22,13 @@
 	});
 
 	Route::get('/prompts/pending', [PromptApiController::class, 'getPendingPrompts'])->withoutMiddleware([ThrottleRequests::class]);
+	Route::get('/prompts/pending-jobs', [PromptApiController::class, 'getPendingJobs'])->withoutMiddleware([ThrottleRequests::class]);
+	Route::post('/prompts/claim', [PromptApiController::class, 'claimPrompts'])->withoutMiddleware([ThrottleRequests::class]);
+	Route::post('/prompts/heartbeat', [PromptApiController::class, 'heartbeatPrompts'])->withoutMiddleware([ThrottleRequests::class]);
+	Route::post('/prompts/release', [PromptApiController::class, 'releasePrompts'])->withoutMiddleware([ThrottleRequests::class]);
 	Route::post('/prompts/update-filename', [PromptApiController::class, 'updateFilename'])->withoutMiddleware([ThrottleRequests::class]);
 	Route::post('/prompts/update-status', [PromptApiController::class, 'updateRenderStatus'])->withoutMiddleware([ThrottleRequests::class]);
+	Route::post('/prompts/update-batch', [PromptApiController::class, 'updateBatch'])->withoutMiddleware([ThrottleRequests::class]);
 	Route::get('/prompts/queue-count', [PromptApiController::class, 'getQueueCount'])->withoutMiddleware([ThrottleRequests::class]);
 
 